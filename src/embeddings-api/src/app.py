@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from typing import Any, Dict
 from json import dumps as json_dumps
@@ -21,9 +22,13 @@ from core import (
     process_embed_cmd,
     process_rm_clone_embed_cmd,
     process_qry_cmd,
+    parse_qry_options,
+    process_qry_batch_cmd,
+    parse_qry_batch_cmd,
+    warm_up,
     LxiEmbeddingActor,
 )
-from endpoints import healthz
+from endpoints import healthz, metrics
 
 
 app = FastAPI()
@@ -34,6 +39,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.include_router(healthz.router)
+app.include_router(metrics.router)
 
 dapr_app = DaprApp(app)
 dapr_actor = DaprActor(app)
@@ -54,6 +60,13 @@ async def startup_event():
     logging.info("Registering actors...")
     await dapr_actor.register_actor(LxiEmbeddingActor)
 
+    logging.info("Warming up embedding model and chroma client...")
+    try:
+        await asyncio.to_thread(warm_up)
+    except Exception as e:
+        # not fatal, the first request loads whatever is still missing...
+        logging.warning(f"startup_event <SKIPPING> warm up. err: {e}")
+
 
 @app.post("/clone")
 async def handle_clone_cmd(cmd: RootCmd):
@@ -85,7 +98,30 @@ async def handle_rm_clone_embed_evt(evt: CloudEvt):
 @app.post("/qry")
 async def handle_qry_cmd(cmd: Dict[str, Any]):
     logging.info(f"{handle_qry_cmd.__name__} START.")
+
+    try:
+        parse_qry_options(cmd)
+    except (ValueError, TypeError) as e:
+        logging.warning(f"{handle_qry_cmd.__name__} <SKIPPING>, invalid options. err: {e}")
+        return Response(content=json_dumps({"error": str(e)}), status_code=status.HTTP_400_BAD_REQUEST)
+
     output = await process_qry_cmd(cmd)
     resp = json_dumps({"output": output})
     logging.info(f"{handle_qry_cmd.__name__} END.")
     return Response(content=resp, status_code=status.HTTP_200_OK)
+
+
+@app.post("/qry/batch")
+async def handle_qry_batch_cmd(cmd: Dict[str, Any]):
+    logging.info(f"{handle_qry_batch_cmd.__name__} START.")
+
+    try:
+        parse_qry_batch_cmd(cmd)
+    except (ValueError, TypeError) as e:
+        logging.warning(f"{handle_qry_batch_cmd.__name__} <SKIPPING>, invalid cmd. err: {e}")
+        return Response(content=json_dumps({"error": str(e)}), status_code=status.HTTP_400_BAD_REQUEST)
+
+    output = await process_qry_batch_cmd(cmd)
+    resp = json_dumps({"output": output})
+    logging.info(f"{handle_qry_batch_cmd.__name__} END.")
+    return Response(content=resp, status_code=status.HTTP_200_OK)
@@ -1,3 +1,12 @@
 from .actors import *
+from .cache import *
+from .pipeline import *
+from .upsert import *
+from .registry import *
+from .local_store import *
+from .batcher import *
+from .qry_cache import *
+from .lexical import *
+from .filters import *
 from .procs import *
 from .embed import *
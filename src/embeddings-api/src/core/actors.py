@@ -20,10 +20,23 @@ class LxiEmbeddingActorInterface(ActorInterface):
     @actormethod(name="clear_state")
     async def clear_state(self) -> Awaitable: ...
 
+    @abstractmethod
+    @actormethod(name="set_metadata")
+    async def set_metadata(self, data: T) -> Awaitable: ...
+
+    @abstractmethod
+    @actormethod(name="get_metadata")
+    async def get_metadata(self) -> Awaitable[T]: ...
+
+    @abstractmethod
+    @actormethod(name="set_state_and_metadata")
+    async def set_state_and_metadata(self, data: T) -> Awaitable: ...
+
 
 class LxiEmbeddingActor(Actor, LxiEmbeddingActorInterface):
 
     _state_key = "embeddings"
+    _metadata_key = "metadata"
     _actor_id: str
 
     def __init__(self, ctx, actor_id):
@@ -59,6 +72,36 @@ class LxiEmbeddingActor(Actor, LxiEmbeddingActorInterface):
     async def clear_state(self) -> Awaitable:
         logging.info(f"{self.__class__.__name__} clear_state!")
         await self._state_manager.remove_state(self._state_key)
+        # the last embedded commit is meaningless without the embeddings state...
+        await self._state_manager.try_remove_state(self._metadata_key)
+        await self._state_manager.save_state()
+
+    async def set_metadata(self, data: T) -> Awaitable:
+        logging.info(f"{self.__class__.__name__} set_metadata!")
+
+        if not isinstance(data, dict):
+          raise ValueError("Data must be a dictionary")
+
+        await self._state_manager.set_state(self._metadata_key, data)
+        await self._state_manager.save_state()
+
+    async def get_metadata(self) -> Awaitable[T]:
+        logging.info(f"{self.__class__.__name__} get_metadata!")
+        has_value, val = await self._state_manager.try_get_state(self._metadata_key)
+        if not has_value:
+            return {}
+
+        return val
+
+    async def set_state_and_metadata(self, data: T) -> Awaitable:
+        logging.info(f"{self.__class__.__name__} set_state_and_metadata!")
+
+        if not isinstance(data, dict) or not isinstance(data.get("state", None), dict) or not isinstance(data.get("metadata", None), dict):
+          raise ValueError("Data must be a dictionary with state and metadata dictionaries")
+
+        # one save, both keys land in the same state store transaction...
+        await self._state_manager.set_state(self._state_key, compress(data["state"]))
+        await self._state_manager.set_state(self._metadata_key, data["metadata"])
         await self._state_manager.save_state()
 
 
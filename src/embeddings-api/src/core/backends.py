@@ -0,0 +1,226 @@
+import os
+import json
+import shutil
+import tempfile
+from typing import List, Any, Dict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from agntsmth_core.core.utls import log
+
+
+DEFAULT_ONNX_CACHE_DIR = os.path.expanduser("~/.cache/lxi/onnx")
+DEFAULT_ONNX_OPSET = 17
+
+ONNX_MODEL_FILE_NAME = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE_NAME = "model.int8.onnx"
+ONNX_CONFIG_FILE_NAME = "lxi_onnx.json"
+ONNX_INPUT_NAMES = ("input_ids", "attention_mask", "token_type_ids")
+
+
+def export_onnx_model(
+    model: Any,
+    tokenizer: Any,
+    dir_path: str,
+    max_seq_length: int,
+    pooling: str = "mean",
+    normalize: bool = True,
+) -> None:
+    """
+    Exports a transformers encoder to ONNX, with an int8 dynamically quantized copy, next to its tokenizer.
+
+    :param model: transformers model returning last_hidden_state first.
+    :param tokenizer: Fast tokenizer of the model.
+    :param dir_path: Target directory.
+    :param max_seq_length: Inputs are truncated to this many tokens.
+    :param pooling: "mean" or "cls" pooling of the last hidden state.
+    :param normalize: Whether vectors are L2 normalized.
+    """
+
+    import torch
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    if pooling not in ("mean", "cls"):
+        raise ValueError(f"Unsupported pooling: {pooling}.")
+
+    os.makedirs(dir_path, exist_ok=True)
+
+    # a padded batch, so the traced graph sees a real attention mask...
+    sample = tokenizer(["export sample", "export a longer sample text"], padding=True, return_tensors="pt")
+    input_names = [name for name in ONNX_INPUT_NAMES if name in sample]
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, encoder):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, *inputs):
+            return self.encoder(**dict(zip(input_names, inputs)))[0]
+
+    model_path = os.path.join(dir_path, ONNX_MODEL_FILE_NAME)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(model.eval()),
+            tuple(sample[name] for name in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=DEFAULT_ONNX_OPSET,
+            dynamo=False,
+        )
+
+    quantize_dynamic(
+        model_path,
+        os.path.join(dir_path, ONNX_QUANTIZED_MODEL_FILE_NAME),
+        weight_type=QuantType.QInt8,
+    )
+
+    tokenizer.save_pretrained(dir_path)
+
+    with open(os.path.join(dir_path, ONNX_CONFIG_FILE_NAME), "w") as f:
+        json.dump(
+            {
+                "max_seq_length": max_seq_length,
+                "pooling": pooling,
+                "normalize": normalize,
+                "pad_token": tokenizer.pad_token,
+                "pad_token_id": tokenizer.pad_token_id,
+            },
+            f,
+        )
+
+
+def export_sentence_transformer(model_name: str, dir_path: str) -> None:
+    """Exports a sentence-transformers model, keeping its sequence length, pooling and normalization."""
+
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    log(f"{export_sentence_transformer.__name__} START. model_name: {model_name}")
+
+    sentence_transformer = SentenceTransformer(model_name, device="cpu")
+    modules = list(sentence_transformer)
+    pooling = next((m for m in modules if isinstance(m, Pooling)), None)
+
+    export_onnx_model(
+        modules[0].auto_model,
+        sentence_transformer.tokenizer,
+        dir_path,
+        sentence_transformer.max_seq_length,
+        pooling="cls" if pooling is not None and pooling.pooling_mode_cls_token else "mean",
+        normalize=any(isinstance(m, Normalize) for m in modules),
+    )
+
+    log(f"{export_sentence_transformer.__name__} END.")
+
+
+def ensure_onnx_model(model_name: str, cache_dir: str) -> str:
+    """Returns the directory of the exported model, exporting it on first use."""
+
+    dir_path = os.path.join(cache_dir, model_name.replace("/", "--"))
+    if os.path.isfile(os.path.join(dir_path, ONNX_CONFIG_FILE_NAME)):
+        return dir_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # export aside and rename, embed workers may race for the first export...
+    tmp_dir_path = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        export_sentence_transformer(model_name, tmp_dir_path)
+        os.rename(tmp_dir_path, dir_path)
+    except OSError:
+        if not os.path.isfile(os.path.join(dir_path, ONNX_CONFIG_FILE_NAME)):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir_path, ignore_errors=True)
+
+    return dir_path
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence embeddings on ONNX Runtime, optionally int8 quantized, for CPU-only nodes.
+    """
+
+    def __init__(
+        self,
+        dir_path: str,
+        quantized: bool = True,
+        intra_op_threads: int = 0,
+        batch_size: int = 32,
+    ):
+        """
+        :param dir_path: Directory written by export_onnx_model.
+        :param quantized: Use the int8 dynamically quantized model.
+        :param intra_op_threads: ONNX Runtime intra-op threads, 0 lets the runtime decide.
+        :param batch_size: Texts per inference call.
+        """
+
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(dir_path, ONNX_CONFIG_FILE_NAME)) as f:
+            self._config: Dict[str, Any] = json.load(f)
+
+        self._tokenizer = Tokenizer.from_file(os.path.join(dir_path, "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=self._config["max_seq_length"])
+        self._tokenizer.enable_padding(
+            pad_id=self._config["pad_token_id"], pad_token=self._config["pad_token"]
+        )
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        model_file_name = ONNX_QUANTIZED_MODEL_FILE_NAME if quantized else ONNX_MODEL_FILE_NAME
+        self._session = onnxruntime.InferenceSession(
+            os.path.join(dir_path, model_file_name),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self._input_names = [i.name for i in self._session.get_inputs()]
+        self._batch_size = batch_size
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self._tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+
+        last_hidden_state = self._session.run(
+            None, {name: inputs[name] for name in self._input_names}
+        )[0]
+
+        if self._config["pooling"] == "cls":
+            vectors = last_hidden_state[:, 0]
+        else:
+            mask = inputs["attention_mask"][..., None].astype(last_hidden_state.dtype)
+            vectors = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self._config["normalize"]:
+            vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        # similar lengths share a batch, so little compute is spent on padding...
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+
+        for start in range(0, len(order), self._batch_size):
+            batch_order = order[start:start + self._batch_size]
+            for i, vector in zip(batch_order, self._embed_batch([texts[i] for i in batch_order])):
+                vectors[i] = vector.tolist()
+
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0].tolist()
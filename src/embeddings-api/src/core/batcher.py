@@ -0,0 +1,81 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Set, Tuple
+from langchain_core.embeddings import Embeddings
+
+
+DEFAULT_QRY_BATCH_SIZE = 32
+DEFAULT_QRY_BATCH_WAIT_MS = 5
+
+
+class QueryEmbeddingBatcher:
+    """
+    Coalesces queries arriving within a few milliseconds of each other into one embed_documents call on an executor.
+    """
+
+    def __init__(
+        self,
+        get_embedding_function: Callable[[], Embeddings],
+        executor: Executor,
+        max_batch_size: int = DEFAULT_QRY_BATCH_SIZE,
+        max_wait_seconds: float = DEFAULT_QRY_BATCH_WAIT_MS / 1000,
+    ):
+        """
+        :param get_embedding_function: Returns the model, resolved on each batch so it can be loaded lazily.
+        :param executor: Runs the model off the event loop.
+        :param max_batch_size: A batch is flushed as soon as it holds this many queries.
+        :param max_wait_seconds: Otherwise it's flushed this long after its first query arrived.
+        """
+
+        self._get_embedding_function = get_embedding_function
+        self._executor = executor
+        self._max_batch_size = max_batch_size
+        self._max_wait_seconds = max_wait_seconds
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._max_wait_seconds, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        # hold a reference, the loop only keeps weak ones to running tasks...
+        task = asyncio.ensure_future(self._embed(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _embed(self, pending: List[Tuple[str, asyncio.Future]]) -> None:
+        texts = list(dict.fromkeys(text for text, _ in pending))
+
+        try:
+            # the model is resolved on the executor too, a cold load must not block the loop...
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                self._executor, lambda: self._get_embedding_function().embed_documents(texts)
+            )
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        vectors_by_text = dict(zip(texts, vectors))
+        for text, future in pending:
+            if not future.done():
+                future.set_result(vectors_by_text[text])
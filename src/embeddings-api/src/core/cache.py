@@ -0,0 +1,215 @@
+import os
+import time
+import sqlite3
+import threading
+from array import array
+from typing import List, Dict, Iterable
+from langchain_core.embeddings import Embeddings
+from agntsmth_core.core.utls import generate_sha256
+
+
+SQLITE_MAX_PARAMS = 500
+# access times of cache hits are written with the next put, or once this many are pending...
+DEFAULT_TOUCH_FLUSH_SIZE = 4096
+
+
+def encode_vector(vector: List[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def decode_vector(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+def iter_slices(items: List[str], size: int) -> Iterable[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class EmbeddingCache:
+    """
+    Persistent chunk-hash -> float32 vector cache on local disk, evicting least recently used vectors past max_bytes.
+    """
+
+    def __init__(self, db_path: str, namespace: str, max_bytes: int, touch_flush_size: int = DEFAULT_TOUCH_FLUSH_SIZE):
+        """
+        Opens, or creates, the cache database.
+
+        :param db_path: Path of the SQLite file.
+        :param namespace: Partition of the cache, e.g. model name and splitter settings.
+        :param max_bytes: Total vector bytes kept across all namespaces before evicting.
+        :param touch_flush_size: Pending access time updates of cache hits written without waiting for a put.
+        """
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self._namespace = namespace
+        self._max_bytes = max_bytes
+        self._touch_flush_size = touch_flush_size
+        self._touched: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        # several embed workers share the file...
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                namespace TEXT NOT NULL,
+                chunk_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (namespace, chunk_hash)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)")
+        # the running byte total lives next to the vectors, so every worker sharing the file keeps it current...
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_stats (id INTEGER PRIMARY KEY CHECK (id = 0), total_bytes INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        if self._conn.execute("SELECT 1 FROM cache_stats WHERE id = 0").fetchone() is None:
+            self._conn.execute("INSERT INTO cache_stats (id, total_bytes) SELECT 0, COALESCE(SUM(size), 0) FROM embeddings")
+        self._conn.commit()
+
+    def get_many(self, chunk_hashes: List[str]) -> Dict[str, List[float]]:
+        vectors = {}
+        unique_hashes = list(dict.fromkeys(chunk_hashes))
+
+        with self._lock:
+            for hashes in iter_slices(unique_hashes, SQLITE_MAX_PARAMS):
+                placeholders = ",".join("?" * len(hashes))
+                rows = self._conn.execute(
+                    f"SELECT chunk_hash, vector FROM embeddings WHERE namespace = ? AND chunk_hash IN ({placeholders})",
+                    [self._namespace, *hashes],
+                ).fetchall()
+                vectors.update((chunk_hash, decode_vector(blob)) for chunk_hash, blob in rows)
+
+            now = time.time()
+            self._touched.update((chunk_hash, now) for chunk_hash in vectors)
+            if len(self._touched) >= self._touch_flush_size:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._flush_touched()
+                self._conn.commit()
+
+        return vectors
+
+    def put_many(self, vectors: Dict[str, List[float]]) -> None:
+        if not vectors:
+            return
+
+        now = time.time()
+        rows = [
+            (self._namespace, chunk_hash, blob, len(blob), now)
+            for chunk_hash, blob in ((h, encode_vector(v)) for h, v in vectors.items())
+        ]
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                replaced_bytes = 0
+                for hashes in iter_slices(list(vectors), SQLITE_MAX_PARAMS):
+                    placeholders = ",".join("?" * len(hashes))
+                    replaced_bytes += self._conn.execute(
+                        f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE namespace = ? AND chunk_hash IN ({placeholders})",
+                        [self._namespace, *hashes],
+                    ).fetchone()[0]
+
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (namespace, chunk_hash, vector, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._add_bytes(sum(row[3] for row in rows) - replaced_bytes)
+                self._flush_touched()
+                self._evict()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes()
+
+    def _total_bytes(self) -> int:
+        return self._conn.execute("SELECT total_bytes FROM cache_stats WHERE id = 0").fetchone()[0]
+
+    def _add_bytes(self, delta: int) -> None:
+        if delta:
+            self._conn.execute("UPDATE cache_stats SET total_bytes = total_bytes + ? WHERE id = 0", (delta,))
+
+    def _flush_touched(self) -> None:
+        if not self._touched:
+            return
+
+        self._conn.executemany(
+            "UPDATE embeddings SET last_used = MAX(last_used, ?) WHERE namespace = ? AND chunk_hash = ?",
+            [(last_used, self._namespace, chunk_hash) for chunk_hash, last_used in self._touched.items()],
+        )
+        self._touched.clear()
+
+    def _evict(self) -> None:
+        total_bytes = self._total_bytes()
+        if total_bytes <= self._max_bytes:
+            return
+
+        # trim to 90% so eviction doesn't run again on the very next write...
+        bytes_to_free = total_bytes - int(self._max_bytes * 0.9)
+        freed_bytes = 0
+        evict_keys = []
+
+        for namespace, chunk_hash, size in self._conn.execute(
+            "SELECT namespace, chunk_hash, size FROM embeddings ORDER BY last_used ASC"
+        ):
+            if freed_bytes >= bytes_to_free:
+                break
+            evict_keys.append((namespace, chunk_hash))
+            freed_bytes += size
+
+        self._conn.executemany(
+            "DELETE FROM embeddings WHERE namespace = ? AND chunk_hash = ?", evict_keys
+        )
+        self._add_bytes(-freed_bytes)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._touched:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._flush_touched()
+                self._conn.commit()
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only runs the underlying model on chunks missing from the cache.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self._embeddings = embeddings
+        self._cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        chunk_hashes = [generate_sha256(text) for text in texts]
+        vectors = self._cache.get_many(chunk_hashes)
+
+        texts_by_hash = dict(zip(chunk_hashes, texts))
+        missing_hashes = [h for h in texts_by_hash if h not in vectors]
+
+        if missing_hashes:
+            embedded = self._embeddings.embed_documents([texts_by_hash[h] for h in missing_hashes])
+            embedded_vectors = dict(zip(missing_hashes, embedded))
+            self._cache.put_many(embedded_vectors)
+            vectors.update(embedded_vectors)
+
+        return [vectors[h] for h in chunk_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embeddings.embed_query(text)
@@ -0,0 +1,186 @@
+import os
+import re
+from typing import List, Callable, Iterable, Optional, Tuple
+from langchain_core.documents import Document
+
+
+DEFAULT_MIN_CHUNK_FILL = 0.5
+
+# boundary levels, a chunk is cut at the strongest boundary past the minimum fill...
+NO_BOUNDARY = 0
+BLANK_LINE_BOUNDARY = 1
+MEMBER_BOUNDARY = 2
+TYPE_BOUNDARY = 3
+
+CSHARP_MODIFIERS = r"(?:(?:public|private|protected|internal|static|abstract|sealed|partial|async|override|virtual|readonly|unsafe|extern|new|required|file)\s+)"
+TYPESCRIPT_MODIFIERS = r"(?:(?:export|default|declare|abstract|public|private|protected|static|readonly|async|override)\s+)"
+
+LANGUAGE_PATTERNS = {
+    "python": {
+        "type": re.compile(r"^\s*class\s+\w"),
+        "member": re.compile(r"^\s*(?:async\s+)?def\s+\w"),
+        "prefix": re.compile(r"^\s*(?:@|#)"),
+    },
+    "csharp": {
+        "type": re.compile(rf"^\s*{CSHARP_MODIFIERS}*(?:class|interface|struct|record|enum|namespace|delegate)\s+\w"),
+        "member": re.compile(rf"^\s*{CSHARP_MODIFIERS}+[\w<>\[\],.?\s]+?\s+\w+\s*(?:<[^>]*>)?\s*\("),
+        "prefix": re.compile(r"^\s*(?:\[|//)"),
+    },
+    "typescript": {
+        "type": re.compile(rf"^\s*{TYPESCRIPT_MODIFIERS}*(?:class|interface|enum|namespace|module|type\s+\w+\s*=)\s*\w?"),
+        "member": re.compile(
+            rf"^\s*{TYPESCRIPT_MODIFIERS}*(?:function\s*\*?\s*\w+|(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?(?:\(|function|\w+\s*=>)|(?:get\s+|set\s+)?\w+\s*\([^;]*\)\s*(?::[^;]+)?\{{\s*$)"
+        ),
+        "prefix": re.compile(r"^\s*(?:@|//|/\*|\*)"),
+    },
+}
+
+LANGUAGE_FILE_EXTS = {
+    ".py": "python",
+    ".cs": "csharp",
+    ".ts": "typescript",
+    ".tsx": "typescript",
+    ".mts": "typescript",
+    ".js": "typescript",
+    ".jsx": "typescript",
+    ".mjs": "typescript",
+}
+
+
+def detect_language(file_path: Optional[str]) -> Optional[str]:
+    if not file_path:
+        return None
+
+    return LANGUAGE_FILE_EXTS.get(os.path.splitext(file_path)[1].lower(), None)
+
+
+def detect_boundary_levels(lines: List[str], language: Optional[str]) -> List[int]:
+    """Scores the boundary before each line, moving declaration boundaries up over attached decorators, attributes and comments."""
+
+    levels = [NO_BOUNDARY] * len(lines)
+    patterns = LANGUAGE_PATTERNS.get(language, None)
+
+    for i, line in enumerate(lines):
+        if i > 0 and not lines[i - 1].strip():
+            levels[i] = BLANK_LINE_BOUNDARY
+
+        if patterns is None or not line.strip():
+            continue
+
+        if patterns["type"].match(line):
+            level = TYPE_BOUNDARY
+        elif patterns["member"].match(line):
+            # functions declared at the top level weigh as much as types...
+            level = MEMBER_BOUNDARY if line[0].isspace() else TYPE_BOUNDARY
+        else:
+            continue
+
+        start = i
+        while start > 0 and patterns["prefix"].match(lines[start - 1]):
+            levels[start] = NO_BOUNDARY
+            start -= 1
+
+        levels[start] = max(levels[start], level)
+
+    return levels
+
+
+class CodeChunker:
+    """
+    Splits source files on syntactic boundaries (Python, C#, TypeScript), falling back to blank lines for anything else.
+
+    Each line is measured once, chunks are then cut from running token totals, so text is never re-tokenized.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int,
+        chunk_overlap: int,
+        length_function: Callable[[str], int],
+        min_chunk_fill: float = DEFAULT_MIN_CHUNK_FILL,
+    ):
+        """
+        :param chunk_size: Maximum tokens per chunk.
+        :param chunk_overlap: Maximum tokens of trailing lines repeated at the start of the next chunk.
+        :param length_function: Token count of a piece of text.
+        :param min_chunk_fill: Share of chunk_size a chunk must reach before it may be cut at a boundary.
+        """
+
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size}).")
+
+        self._chunk_size = chunk_size
+        self._chunk_overlap = chunk_overlap
+        self._length_function = length_function
+        self._min_chunk_tokens = int(chunk_size * min_chunk_fill)
+
+    def _measure_lines(self, text: str) -> Tuple[List[str], List[int]]:
+        lines = []
+        counts = []
+
+        for line in text.splitlines(keepends=True):
+            count = self._length_function(line)
+            if count <= self._chunk_size:
+                lines.append(line)
+                counts.append(count)
+                continue
+
+            # a single line longer than a chunk, e.g. embedded data, is cut by characters...
+            piece_chars = max(1, len(line) * self._chunk_size // (count + 1))
+            for i in range(0, len(line), piece_chars):
+                piece = line[i:i + piece_chars]
+                lines.append(piece)
+                counts.append(self._length_function(piece))
+
+        return lines, counts
+
+    def split_text(self, text: str, language: Optional[str] = None) -> List[str]:
+        lines, counts = self._measure_lines(text)
+        levels = detect_boundary_levels(lines, language)
+
+        chunks = []
+        start = 0
+
+        while start < len(lines):
+            end = start
+            chunk_tokens = 0
+            cut, cut_level = None, NO_BOUNDARY
+
+            while end < len(lines) and (end == start or chunk_tokens + counts[end] <= self._chunk_size):
+                # strongest boundary wins, the later one on a tie...
+                if end > start and chunk_tokens >= self._min_chunk_tokens and levels[end] >= cut_level and levels[end] > NO_BOUNDARY:
+                    cut, cut_level = end, levels[end]
+                chunk_tokens += counts[end]
+                end += 1
+
+            if end < len(lines) and cut is not None:
+                end = cut
+
+            chunk = "".join(lines[start:end])
+            if chunk.strip():
+                chunks.append(chunk)
+
+            if end >= len(lines):
+                break
+
+            overlap_start = end
+            overlap_tokens = 0
+            while overlap_start - 1 > start and overlap_tokens + counts[overlap_start - 1] <= self._chunk_overlap:
+                overlap_start -= 1
+                overlap_tokens += counts[overlap_start]
+
+            start = overlap_start
+
+        return chunks
+
+    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
+        split_docs = []
+
+        for doc in documents:
+            language = detect_language(doc.metadata.get("source", None))
+            split_docs.extend(
+                Document(page_content=chunk, metadata=dict(doc.metadata))
+                for chunk in self.split_text(doc.page_content, language)
+            )
+
+        return split_docs
@@ -1,138 +1,1038 @@
 import os
-from functools import partial
-from multiprocessing import Pool
+import asyncio
+import multiprocessing
 import logging
-from typing import List, Dict, Any, Awaitable, Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Any, Awaitable, Callable, Iterable, Iterator, Optional, Set, Tuple
+from chromadb import Collection
 from langchain_chroma import Chroma
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+import chardet
+import tiktoken
 from langchain_huggingface import HuggingFaceEmbeddings
-from agntsmth_core.core.utls import EnvVarProvider, log, traverse_folder, ChromaHttpClientFactory, generate_sha256
+from agntsmth_core.core.utls import EnvVarProvider, log, generate_sha256
 from .actors import create_embedding_actor_proxy
+from .cache import EmbeddingCache, CachedEmbeddings
+from .chunker import CodeChunker
+from .backends import OnnxEmbeddings, ensure_onnx_model, DEFAULT_ONNX_CACHE_DIR
+from .registry import registry, vector_store_backend
+from .lexical import get_lexical_index, index_chunks
+from .pipeline import iter_in_background, DEFAULT_STAGE_QUEUE_SIZE
+from .upsert import create_upsert_buffer
+from .git_fns import git_listed_paths, git_attr_excluded_paths
+from .filters import (
+    SkipReasons,
+    DEFAULT_MAX_FILE_BYTES,
+    DEFAULT_SNIFF_BYTES,
+    record_skipped_file,
+    merge_skipped_files,
+    is_binary_sample,
+    detect_name_skip_reason,
+    detect_content_skip_reason,
+)
 
 
+DEFAULT_EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+DEFAULT_EMBED_BACKEND = "torch"
 DEFAULT_CHUNK_SIZE = 1500
-DEFAULT_FILE_PATH_CHUNK_SIZE = 50
+DEFAULT_WORK_UNIT_BYTES = 1024 * 1024
+# longer than any reader trusts an alias it read before a swap, see QRY_CACHE_VERSION_REFRESH_SECONDS...
+DEFAULT_COLLECTION_GC_DELAY_SECONDS = 60
+DEFAULT_COLLECTION_COPY_PAGE_SIZE = 1024
 DEFAULT_CHUNK_OVERLAP = 50
+DEFAULT_CHUNK_ENCODING = "gpt2"
+DEFAULT_EMBED_BATCH_SIZE = 64
+DEFAULT_EMBED_BATCH_MAX_TOKENS = 32768
+DEFAULT_CHARS_PER_TOKEN = 4
+DEFAULT_EMBED_CACHE_PATH = os.path.expanduser("~/.cache/lxi/embedding_cache.sqlite")
+DEFAULT_EMBED_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_ENCODING_SAMPLE_BYTES = 64 * 1024
+# bumped whenever chunk metadata changes, files embedded under an older schema are re-embedded...
+CHUNK_SCHEMA_VERSION = 2
+# ancestor directories stored on each chunk, path prefix filters deeper than this are applied after the query...
+CHUNK_METADATA_DIR_DEPTH = 8
 DEFAULT_IGNORE_FOLDERS="node_modules,.git,bin,obj,__pycache__,models--sentence-transformers--all-MiniLM-L6-v2"
 DEFAULT_IGNORE_FILE_EXTS=".pfx,.crt,.cer,.pem,.postman_collection.json,.postman_environment,.png,.gif,.jpeg,.jpg,.ico,.svg,.woff,.woff2,.ttf,.gz,.zip,.tar,.tgz,.tar.gz,.rar,.7z,.pdf,.doc,.docx,.xls,.xlsx,.ppt,.pptx"
 
 env = EnvVarProvider()
 
 
-def create_embedding_function() -> HuggingFaceEmbeddings:
-    return HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+def create_embedding_function(intra_op_threads: Optional[int] = None) -> Embeddings:
+    """
+    Creates the embedding model on the configured backend.
 
+    :param intra_op_threads: ONNX Runtime intra-op threads, defaults to EMBED_INTRA_OP_THREADS.
+    """
 
-def translate_file_path_to_key(file_path: str) -> str:
-    return file_path.replace(".", "__").lower()
+    batch_size = int(env.get_env_var("EMBED_BATCH_SIZE", DEFAULT_EMBED_BATCH_SIZE))
+    backend = env.get_env_var("EMBED_BACKEND", DEFAULT_EMBED_BACKEND).lower()
+
+    if backend == "onnx":
+        if intra_op_threads is None:
+            intra_op_threads = int(env.get_env_var("EMBED_INTRA_OP_THREADS", 0))
+
+        dir_path = ensure_onnx_model(
+            DEFAULT_EMBEDDING_MODEL_NAME,
+            env.get_env_var("EMBED_ONNX_CACHE_DIR", DEFAULT_ONNX_CACHE_DIR),
+        )
+        return OnnxEmbeddings(
+            dir_path,
+            quantized=env.get_env_var("EMBED_ONNX_QUANTIZED", "true").lower() == "true",
+            intra_op_threads=intra_op_threads,
+            batch_size=batch_size,
+        )
+
+    if backend != "torch":
+        raise ValueError(f"Unknown embedding backend: {backend}.")
+
+    return HuggingFaceEmbeddings(
+        model_name=DEFAULT_EMBEDDING_MODEL_NAME,
+        encode_kwargs={"batch_size": batch_size},
+    )
+
+
+def embedding_backend_name() -> str:
+    backend = env.get_env_var("EMBED_BACKEND", DEFAULT_EMBED_BACKEND).lower()
+    if backend == "onnx" and env.get_env_var("EMBED_ONNX_QUANTIZED", "true").lower() == "true":
+        return "onnx-int8"
+    return backend
+
+
+def embedding_model_key() -> str:
+    return f"{DEFAULT_EMBEDDING_MODEL_NAME}:{embedding_backend_name()}"
+
+
+def get_embedding_function(intra_op_threads: Optional[int] = None) -> Embeddings:
+    """Returns the process-wide embedding model, loading it on first use."""
+
+    return registry.get_model(
+        embedding_model_key(), lambda: create_embedding_function(intra_op_threads)
+    )
+
+
+def create_ingestion_embedding_function(intra_op_threads: Optional[int] = None) -> Embeddings:
+    """Creates the embedding function used to embed file chunks, backed by the local chunk cache unless disabled."""
+
+    embedding_function = get_embedding_function(intra_op_threads)
 
+    if env.get_env_var("EMBED_CACHE_ENABLED", "true").lower() != "true":
+        return embedding_function
 
-def create_text_splitter() -> RecursiveCharacterTextSplitter:
     chunk_size = env.get_env_var("CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
     chunk_overlap = env.get_env_var("CHUNK_OVERLAP", DEFAULT_CHUNK_OVERLAP)
 
-    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    cache = EmbeddingCache(
+        db_path=env.get_env_var("EMBED_CACHE_PATH", DEFAULT_EMBED_CACHE_PATH),
+        # quantized vectors differ slightly, so each backend keeps its own entries...
+        namespace=f"{DEFAULT_EMBEDDING_MODEL_NAME}:{embedding_backend_name()}:{chunk_size}:{chunk_overlap}",
+        max_bytes=int(env.get_env_var("EMBED_CACHE_MAX_BYTES", DEFAULT_EMBED_CACHE_MAX_BYTES)),
     )
 
+    return CachedEmbeddings(embedding_function, cache)
 
-def create_vector_store(collection_name: str) -> Chroma:
-    chroma_client = ChromaHttpClientFactory.create_with_auth()
-    embedding_function = create_embedding_function()
-    vector_store = Chroma(
-        embedding_function=embedding_function,
-        client=chroma_client,
-        collection_name=collection_name,
+
+def get_ingestion_embedding_function(intra_op_threads: Optional[int] = None) -> Embeddings:
+    """Returns the process-wide ingestion embedding function, sharing the model with queries."""
+
+    return registry.get_model(
+        f"{embedding_model_key()}:ingestion",
+        lambda: create_ingestion_embedding_function(intra_op_threads),
     )
 
-    return vector_store
 
+def translate_file_path_to_key(file_path: str) -> str:
+    return file_path.replace(".", "__").lower()
 
-def process_file_paths(
-    file_paths: List[str],
-    file_system_name: str,
-    actor_state: Dict[str, Any],
-) -> None:
 
-    text_splitter = create_text_splitter()
-    vector_store = create_vector_store(collection_name=file_system_name)
-    embedding_function = create_embedding_function()
+def create_chunk_metadata(file_path: str, file_system_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Metadata stored with every chunk of a file: its source, lower-case extension and, relative to the file system root,
+    its path and ancestor directories ("dir_1": "src", "dir_2": "src/core", ...) so path prefixes can be matched exactly.
+    """
 
-    embedded_files_state = {}
+    metadata = {"source": file_path, "ext": os.path.splitext(file_path)[1].lower()}
+
+    if file_system_path is None:
+        return metadata
+
+    path = os.path.relpath(file_path, file_system_path).replace(os.sep, "/")
+    metadata["path"] = path
+
+    folders = path.split("/")[:-1]
+    for depth in range(1, min(len(folders), CHUNK_METADATA_DIR_DEPTH) + 1):
+        metadata[f"dir_{depth}"] = "/".join(folders[:depth])
+
+    return metadata
+
+
+def normalize_path_prefix(path_prefix: str) -> str:
+    return path_prefix.replace("\\", "/").strip().strip("/")
+
+
+def normalize_file_ext(file_ext: str) -> str:
+    return file_ext.lower() if file_ext.startswith(".") else f".{file_ext.lower()}"
+
+
+def create_chunk_where(
+    path_prefixes: Optional[List[str]] = None,
+    file_exts: Optional[List[str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Builds a Chroma where clause matching chunks under any of the path prefixes, whole directories or files relative
+    to the file system root, and with any of the file extensions.
+    """
+
+    clauses = []
+
+    if file_exts:
+        exts = [normalize_file_ext(ext) for ext in file_exts]
+        clauses.append({"ext": {"$in": exts}})
+
+    path_clauses = []
+    for path_prefix in path_prefixes or []:
+        path_prefix = normalize_path_prefix(path_prefix)
+        if not path_prefix:
+            continue
+
+        depth = min(path_prefix.count("/") + 1, CHUNK_METADATA_DIR_DEPTH)
+        dir_prefix = "/".join(path_prefix.split("/")[:depth])
+        path_clauses.append({"path": path_prefix})
+        path_clauses.append({f"dir_{depth}": dir_prefix})
+
+    if path_clauses:
+        clauses.append({"$or": path_clauses})
+
+    if not clauses:
+        return None
+
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def match_path_prefixes(path: Optional[str], path_prefixes: Optional[List[str]]) -> bool:
+    """Whether the repo-relative path is, or is under, one of the path prefixes."""
+
+    if not path_prefixes:
+        return True
+
+    if path is None:
+        return False
+
+    for path_prefix in path_prefixes:
+        path_prefix = normalize_path_prefix(path_prefix)
+        if not path_prefix or path == path_prefix or path.startswith(f"{path_prefix}/"):
+            return True
+
+    return False
+
+
+def create_text_splitter() -> CodeChunker:
+    chunk_size = int(env.get_env_var("CHUNK_SIZE", DEFAULT_CHUNK_SIZE))
+    chunk_overlap = int(env.get_env_var("CHUNK_OVERLAP", DEFAULT_CHUNK_OVERLAP))
+    encoding = tiktoken.get_encoding(env.get_env_var("CHUNK_ENCODING", DEFAULT_CHUNK_ENCODING))
+
+    return CodeChunker(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=lambda text: len(encoding.encode_ordinary(text)),
+    )
+
+
+def create_vector_store(collection_name: str) -> Chroma:
+    return registry.get_vector_store(collection_name, get_embedding_function())
+
+
+def create_collection(collection_name: str) -> Collection:
+    return registry.get_collection(collection_name)
+
+
+def versioned_collection_name(repo_name: str, generation: int) -> str:
+    return f"{repo_name}-v{generation}"
+
+
+def get_active_collection_name(metadata: Dict[str, Any], repo_name: str) -> str:
+    """The collection the repo's alias points to, repos never rebuilt blue/green live in the collection named after them."""
+
+    return metadata.get("active_collection", None) or repo_name
+
+
+def drop_collection(collection_name: str) -> None:
+    """Deletes the collection and its lexical index entries, a collection that doesn't exist is skipped."""
+
+    try:
+        registry.get_chroma_client().delete_collection(collection_name)
+    except Exception as e:
+        logging.warning(f"{drop_collection.__name__} <SKIPPING> collection_name: {collection_name}, err: {e}")
+    registry.evict_collection(collection_name)
+
+    lexical_index = get_lexical_index()
+    if lexical_index is not None:
+        lexical_index.delete_collection(collection_name)
+
+
+def copy_collection(source_collection_name: str, collection_name: str) -> int:
+    """
+    Copies every chunk of the source collection, vector included, into the collection, with its lexical index
+    entries. Returns the number of chunks copied, a source collection that doesn't exist copies none.
+    """
+
+    try:
+        source_collection = registry.get_chroma_client().get_collection(source_collection_name)
+    except Exception as e:
+        logging.warning(f"{copy_collection.__name__} <SKIPPING> collection_name: {source_collection_name}, err: {e}")
+        return 0
+
+    page_size = int(env.get_env_var("EMBED_COLLECTION_COPY_PAGE_SIZE", DEFAULT_COLLECTION_COPY_PAGE_SIZE))
+    copied_count = 0
+
+    with create_upsert_buffer(create_collection(collection_name)) as upsert_buffer:
+        while True:
+            page = source_collection.get(
+                include=["embeddings", "documents", "metadatas"], limit=page_size, offset=copied_count
+            )
+            if not page["ids"]:
+                break
+
+            upsert_buffer.add(
+                page["ids"],
+                [embedding.tolist() if hasattr(embedding, "tolist") else embedding for embedding in page["embeddings"]],
+                [
+                    Document(page_content=document or "", metadata=metadata or {})
+                    for document, metadata in zip(page["documents"], page["metadatas"])
+                ],
+            )
+            copied_count += len(page["ids"])
+
+    lexical_index = get_lexical_index()
+    if lexical_index is not None:
+        lexical_index.copy_collection(source_collection_name, collection_name)
+
+    return copied_count
+
+
+# keeps scheduled drops referenced until they're done...
+_collection_gc_tasks: Set[asyncio.Task] = set()
+
+
+async def drop_collection_later(collection_name: str, delay_seconds: float) -> None:
+    await asyncio.sleep(delay_seconds)
+    await asyncio.to_thread(drop_collection, collection_name)
+    log(f"{drop_collection_later.__name__} -> dropped: {collection_name}")
+
+
+def schedule_collection_gc(collection_name: str, delay_seconds: float) -> asyncio.Task:
+    task = asyncio.create_task(drop_collection_later(collection_name, delay_seconds))
+    _collection_gc_tasks.add(task)
+    task.add_done_callback(_collection_gc_tasks.discard)
+    return task
+
+
+def estimate_token_count(text: str) -> int:
+    return max(1, len(text) // DEFAULT_CHARS_PER_TOKEN)
+
+
+def iter_embedding_batches(
+    chunks: Iterable[Tuple[str, Document]],
+    batch_size: int,
+    max_batch_tokens: int,
+) -> Iterator[List[Tuple[str, Document]]]:
+    """Groups (id, document) chunks, across file boundaries, into batches bounded by chunk count and estimated tokens."""
+
+    batch = []
+    batch_tokens = 0
+
+    for chunk in chunks:
+        chunk_tokens = estimate_token_count(chunk[1].page_content)
+
+        if batch and (
+            len(batch) >= batch_size or batch_tokens + chunk_tokens > max_batch_tokens
+        ):
+            yield batch
+            batch = []
+            batch_tokens = 0
+
+        batch.append(chunk)
+        batch_tokens += chunk_tokens
+
+    if batch:
+        yield batch
+
+
+def detect_git_skip_reason(
+    relative_file_path: str,
+    listed_paths: Optional[Set[str]],
+    attr_excluded_paths: Set[str],
+) -> Optional[str]:
+    if listed_paths is not None and relative_file_path not in listed_paths:
+        return SkipReasons.GITIGNORE
+
+    if relative_file_path in attr_excluded_paths:
+        return SkipReasons.GITATTRIBUTES
+
+    return None
+
+
+def iter_file_paths(
+    folder_path: str,
+    ignore_folders: List[str],
+    ignore_file_exts: List[str],
+    skipped_files: Optional[Dict[str, Dict[str, int]]] = None,
+) -> Iterator[str]:
+    """Lazily walks folder_path, with the same folder and extension rules as traverse_folder, plus .gitignore and .gitattributes when it's a git work tree."""
+
+    if skipped_files is None:
+        skipped_files = {}
+
+    listed_paths = git_listed_paths(folder_path)
+    attr_excluded_paths = git_attr_excluded_paths(folder_path)
+
+    for root, dirs, files in os.walk(folder_path):
+        dirs[:] = [d for d in dirs if d not in ignore_folders]
+
+        for f in files:
+            if any(f.endswith(ext) for ext in ignore_file_exts):
+                continue
+
+            file_path = f"{root}/{f}"
+            reason = detect_git_skip_reason(
+                os.path.relpath(file_path, folder_path), listed_paths, attr_excluded_paths
+            )
+            if reason:
+                record_skipped_file(skipped_files, reason, os.path.getsize(file_path))
+                continue
+
+            yield file_path
+
+
+def filter_file_paths(
+    file_paths: Iterable[str],
+    skipped_files: Dict[str, Dict[str, int]],
+) -> Iterator[str]:
+    """Drops lockfiles, minified bundles, oversized and binary files before they are read in full."""
+
+    max_file_bytes = int(env.get_env_var("EMBED_MAX_FILE_BYTES", DEFAULT_MAX_FILE_BYTES))
+
+    for file_path in file_paths:
+        size = os.path.getsize(file_path)
+
+        reason = detect_name_skip_reason(file_path)
+        if not reason and size > max_file_bytes:
+            reason = SkipReasons.TOO_LARGE
+        if not reason:
+            with open(file_path, "rb") as f:
+                if is_binary_sample(f.read(DEFAULT_SNIFF_BYTES)):
+                    reason = SkipReasons.BINARY
+
+        if reason:
+            record_skipped_file(skipped_files, reason, size)
+            continue
+
+        yield file_path
+
+
+def decode_file_bytes(raw: bytes) -> Optional[str]:
+    """Decodes as utf-8, falling back to the encodings chardet detects on a leading sample."""
+
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        text = None
+        for detected in chardet.detect_all(raw[:DEFAULT_ENCODING_SAMPLE_BYTES]):
+            if not detected["encoding"]:
+                continue
+            try:
+                text = raw.decode(detected["encoding"])
+                break
+            except (UnicodeDecodeError, LookupError):
+                continue
+
+    if text is None:
+        return None
+
+    # match text mode reads, so hashes are stable across loaders...
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def load_file_documents(
+    file_paths: Iterable[str],
+    actor_state: Dict[str, Any],
+    embedded_files_state: Dict[str, Any],
+    skipped_files: Optional[Dict[str, Dict[str, int]]] = None,
+    file_system_path: Optional[str] = None,
+) -> Iterator[Tuple[str, Document]]:
+    """Reads, decodes and hashes files, yielding (hash, document) for new or changed files and recording unchanged ones in embedded_files_state."""
+
+    if skipped_files is None:
+        skipped_files = {}
 
     for file_path in file_paths:
 
-        loader = TextLoader(file_path, encoding="utf-8", autodetect_encoding=True)
-        docs = loader.load()
+        with open(file_path, "rb") as f:
+            raw = f.read()
+
+        page_content = decode_file_bytes(raw)
+
+        if page_content is None:
+            logging.warning(f"{load_file_documents.__name__} <SKIPPING>, undecodable. file_path: {file_path}")
+            record_skipped_file(skipped_files, SkipReasons.UNDECODABLE, len(raw))
+            continue
+
+        reason = detect_content_skip_reason(page_content, file_path)
+        if reason:
+            record_skipped_file(skipped_files, reason, len(raw))
+            continue
 
-        page_content = docs[0].page_content
         hash = generate_sha256(page_content)
         key = translate_file_path_to_key(file_path)
 
-        if actor_state.get(key, {}).get("hash", None):
-            # log(f"{process_file_paths.__name__} SKIPPING -> {file_path} already embedded.")
-            embedded_files_state[key] = {"hash": hash}
+        file_state = actor_state.get(key, {})
+        if file_state.get("hash", None) == hash and file_state.get("schema", None) == CHUNK_SCHEMA_VERSION:
+            # log(f"{load_file_documents.__name__} SKIPPING -> {file_path} unchanged.")
+            embedded_files_state[key] = {**file_state, "path": file_path}
             continue
 
-        split_docs = text_splitter.split_documents(docs)
-        split_texts = [doc.page_content for doc in split_docs]
+        yield hash, Document(page_content=page_content, metadata=create_chunk_metadata(file_path, file_system_path))
+
+
+def split_documents(
+    documents: Iterable[Tuple[str, Document]],
+    text_splitter: CodeChunker,
+    embedded_files_state: Dict[str, Any],
+) -> Iterator[Tuple[str, Document]]:
+    """Splits documents, yielding (id, document) chunks and recording each file's state in embedded_files_state."""
+
+    for hash, doc in documents:
+        file_path = doc.metadata["source"]
+
+        split_docs = text_splitter.split_documents([doc])
+
+        if not len(split_docs):
+            continue
+
+        embedded_files_state[translate_file_path_to_key(file_path)] = {
+            "hash": hash, "path": file_path, "chunks": len(split_docs), "schema": CHUNK_SCHEMA_VERSION
+        }
+
+        for i, split_doc in enumerate(split_docs):
+            yield f"{file_path}_{i}", split_doc
+
 
-        if not len(split_texts):
+def split_file_paths(
+    file_paths: Iterable[str],
+    actor_state: Dict[str, Any],
+    text_splitter: CodeChunker,
+    embedded_files_state: Dict[str, Any],
+    skipped_files: Optional[Dict[str, Dict[str, int]]] = None,
+    file_system_path: Optional[str] = None,
+) -> Iterator[Tuple[str, Document]]:
+    """Filters, loads and splits new or changed files, yielding (id, document) chunks and recording each file's state in embedded_files_state."""
+
+    if skipped_files is None:
+        skipped_files = {}
+
+    file_paths = filter_file_paths(file_paths, skipped_files)
+    documents = load_file_documents(file_paths, actor_state, embedded_files_state, skipped_files, file_system_path)
+    return split_documents(documents, text_splitter, embedded_files_state)
+
+
+def embed_batches(
+    chunks: Iterable[Tuple[str, Document]],
+    embedding_function: Embeddings,
+    batch_size: int,
+    max_batch_tokens: int,
+) -> Iterator[Tuple[List[str], List[List[float]], List[Document]]]:
+    for batch in iter_embedding_batches(chunks, batch_size, max_batch_tokens):
+        ids = [chunk_id for chunk_id, _ in batch]
+        split_docs = [split_doc for _, split_doc in batch]
+        split_texts = [split_doc.page_content for split_doc in split_docs]
+
+        yield ids, embedding_function.embed_documents(split_texts), split_docs
+
+
+def embed_chunks(
+    chunks: Iterable[Tuple[str, Document]],
+    embedding_function: Embeddings,
+    collection: Collection,
+    batch_size: int = DEFAULT_EMBED_BATCH_SIZE,
+    max_batch_tokens: int = DEFAULT_EMBED_BATCH_MAX_TOKENS,
+) -> int:
+    """
+    Embeds chunks in batches and upserts the vectors through a write-behind buffer, returning the number of chunks
+    written once every upsert has landed.
+    """
+
+    # the next batch is embedded while the previous one is buffered...
+    embedded_batches = iter_in_background(
+        embed_batches(chunks, embedding_function, batch_size, max_batch_tokens), maxsize=2
+    )
+
+    # upsert batches are sized for chroma, not for the model, and are sent while embedding goes on...
+    with create_upsert_buffer(collection) as upsert_buffer:
+        for ids, embeddings, split_docs in embedded_batches:
+            upsert_buffer.add(ids, embeddings, split_docs)
+
+    return upsert_buffer.upserted_count
+
+
+def diff_embedded_files_state(
+    previous_state: Dict[str, Any],
+    current_state: Dict[str, Any],
+) -> Dict[str, List[str]]:
+    """Classifies file keys as added, changed, unchanged or removed between two embedding states."""
+
+    embedding_diff = {"added": [], "changed": [], "unchanged": [], "removed": []}
+
+    for key, file_state in current_state.items():
+        previous_file_state = previous_state.get(key, None)
+        if previous_file_state is None:
+            embedding_diff["added"].append(key)
+        elif (
+            previous_file_state.get("hash", None) != file_state.get("hash", None)
+            or previous_file_state.get("schema", None) != file_state.get("schema", None)
+        ):
+            embedding_diff["changed"].append(key)
+        else:
+            embedding_diff["unchanged"].append(key)
+
+    embedding_diff["removed"] = [key for key in previous_state if key not in current_state]
+
+    return embedding_diff
+
+
+def collect_stale_chunk_ids(
+    collection: Collection,
+    previous_state: Dict[str, Any],
+    current_state: Dict[str, Any],
+    embedding_diff: Dict[str, List[str]],
+) -> List[str]:
+    """Collects ids of chunks belonging to removed files and of surplus chunk indices of changed files."""
+
+    stale_ids = []
+
+    for key in embedding_diff["changed"] + embedding_diff["removed"]:
+        previous_file_state = previous_state[key]
+        file_path = previous_file_state.get("path", None)
+        chunk_count = current_state.get(key, {}).get("chunks", 0)
+
+        if not file_path:
+            logging.warning(f"{collect_stale_chunk_ids.__name__} <SKIPPING>, no path recorded. key: {key}")
             continue
 
-        embeddings = embedding_function.embed_documents(split_texts)
-        ids = [f"{file_path}_{i}" for i in range(len(embeddings))]
+        if "chunks" in previous_file_state:
+            stale_ids.extend(
+                f"{file_path}_{i}" for i in range(chunk_count, previous_file_state["chunks"])
+            )
+            continue
+
+        # state written before chunk counts were recorded, ask the collection instead...
+        current_ids = {f"{file_path}_{i}" for i in range(chunk_count)}
+        stored_ids = collection.get(where={"source": file_path}, include=[])["ids"]
+        stale_ids.extend(i for i in stored_ids if i not in current_ids)
+
+    return stale_ids
+
 
-        vector_store.add_documents(documents=split_docs, embeddings=embeddings, ids=ids)
+def delete_stale_chunks(
+    collection: Collection,
+    previous_state: Dict[str, Any],
+    current_state: Dict[str, Any],
+    embedding_diff: Dict[str, List[str]],
+) -> int:
+    stale_ids = collect_stale_chunk_ids(collection, previous_state, current_state, embedding_diff)
 
-        embedded_files_state[key] = {"hash": hash}
+    if stale_ids:
+        collection.delete(ids=stale_ids)
+
+    return len(stale_ids)
+
+
+def process_file_paths(
+    file_paths: Iterable[str],
+    file_system_name: str,
+    actor_state: Dict[str, Any],
+    skipped_files: Dict[str, Dict[str, int]],
+    file_system_path: Optional[str] = None,
+) -> Dict[str, Any]:
+
+    batch_size = int(env.get_env_var("EMBED_BATCH_SIZE", DEFAULT_EMBED_BATCH_SIZE))
+    max_batch_tokens = int(env.get_env_var("EMBED_BATCH_MAX_TOKENS", DEFAULT_EMBED_BATCH_MAX_TOKENS))
+    queue_size = int(env.get_env_var("EMBED_STAGE_QUEUE_SIZE", DEFAULT_STAGE_QUEUE_SIZE))
+
+    text_splitter = create_text_splitter()
+    collection = create_collection(collection_name=file_system_name)
+    embedding_function = get_ingestion_embedding_function()
+
+    embedded_files_state = {}
+
+    # walk -> filter -> read/decode/hash -> split -> index -> embed -> upsert, each stage on its own thread behind a bounded queue...
+    file_paths = iter_in_background(file_paths, queue_size)
+    file_paths = iter_in_background(filter_file_paths(file_paths, skipped_files), queue_size)
+    documents = iter_in_background(
+        load_file_documents(file_paths, actor_state, embedded_files_state, skipped_files, file_system_path), queue_size
+    )
+    chunks = iter_in_background(
+        split_documents(documents, text_splitter, embedded_files_state), queue_size
+    )
+    chunks = index_chunks(chunks, get_lexical_index(), file_system_name)
+    embed_chunks(chunks, embedding_function, collection, batch_size, max_batch_tokens)
 
     return embedded_files_state
 
 
-async def process_file_paths_concurrent(
+# per-process state for embed workers, populated once by the pool initializer...
+_worker_context: Dict[str, Any] = {}
+
+
+def _init_embed_worker(file_system_name: str, worker_threads: int, file_system_path: Optional[str] = None) -> None:
+    # onnx workers size their session with the thread share instead, torch isn't needed there...
+    if env.get_env_var("EMBED_BACKEND", DEFAULT_EMBED_BACKEND).lower() == "torch":
+        import torch
+
+        torch.set_num_threads(worker_threads)
+
+    _worker_context["file_system_path"] = file_system_path
+    _worker_context["text_splitter"] = create_text_splitter()
+    _worker_context["embedding_function"] = get_ingestion_embedding_function(worker_threads)
+    _worker_context["collection_name"] = file_system_name
+    _worker_context["collection"] = create_collection(collection_name=file_system_name)
+    _worker_context["batch_size"] = int(env.get_env_var("EMBED_BATCH_SIZE", DEFAULT_EMBED_BATCH_SIZE))
+    _worker_context["max_batch_tokens"] = int(env.get_env_var("EMBED_BATCH_MAX_TOKENS", DEFAULT_EMBED_BATCH_MAX_TOKENS))
+
+
+def _process_work_unit(
+    work_unit: Tuple[List[str], Dict[str, Any]]
+) -> Tuple[Dict[str, Any], Dict[str, Dict[str, int]]]:
+    file_paths, actor_state = work_unit
+
+    embedded_files_state = {}
+    skipped_files = {}
+
+    chunks = split_file_paths(
+        file_paths,
+        actor_state,
+        _worker_context["text_splitter"],
+        embedded_files_state,
+        skipped_files,
+        _worker_context["file_system_path"],
+    )
+    chunks = index_chunks(chunks, get_lexical_index(), _worker_context["collection_name"])
+    embed_chunks(
+        chunks,
+        _worker_context["embedding_function"],
+        _worker_context["collection"],
+        _worker_context["batch_size"],
+        _worker_context["max_batch_tokens"],
+    )
+
+    return embedded_files_state, skipped_files
+
+
+def create_work_units(
+    file_paths: List[str],
+    actor_state: Dict[str, Any],
+    max_unit_bytes: int,
+) -> List[Tuple[List[str], Dict[str, Any]]]:
+    """Packs file paths, largest first, into units of roughly max_unit_bytes, each carrying only its own slice of the actor state."""
+
+    sized_file_paths = sorted(
+        ((os.path.getsize(file_path), file_path) for file_path in file_paths),
+        reverse=True,
+    )
+
+    work_units = []
+    unit_file_paths = []
+    unit_bytes = 0
+
+    for size, file_path in sized_file_paths:
+        if unit_file_paths and unit_bytes + size > max_unit_bytes:
+            work_units.append(unit_file_paths)
+            unit_file_paths = []
+            unit_bytes = 0
+
+        unit_file_paths.append(file_path)
+        unit_bytes += size
+
+    if unit_file_paths:
+        work_units.append(unit_file_paths)
+
+    return [
+        (
+            unit_file_paths,
+            {
+                key: actor_state[key]
+                for key in map(translate_file_path_to_key, unit_file_paths)
+                if key in actor_state
+            },
+        )
+        for unit_file_paths in work_units
+    ]
+
+
+def process_file_paths_concurrent(
     file_paths: List[str],
     file_system_name: str,
-    actor_state: Dict[str, Any]
-):
-    """ Process file paths concurrently. This is a work in progress."""
-    file_path_chunk_size = int(env.get_env_var("FILE_PATH_CHUNK_SIZE", DEFAULT_FILE_PATH_CHUNK_SIZE))
+    actor_state: Dict[str, Any],
+    skipped_files: Dict[str, Dict[str, int]],
+    file_system_path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Process file paths across a pool of worker processes, each loading the model once."""
 
-    file_path_chunks = [file_paths[i:i + file_path_chunk_size] for i in range(0, len(file_paths), file_path_chunk_size)]
+    workers = int(env.get_env_var("EMBED_WORKERS", os.cpu_count() or 1))
+    max_unit_bytes = int(env.get_env_var("EMBED_WORK_UNIT_BYTES", DEFAULT_WORK_UNIT_BYTES))
+    worker_threads = max(1, (os.cpu_count() or 1) // workers)
 
-    prtl_process_file_paths = partial(
-        process_file_paths,
-        file_system_name=file_system_name,
-        actor_state=actor_state,
-    )
+    work_units = create_work_units(file_paths, actor_state, max_unit_bytes)
+    log(f"{process_file_paths_concurrent.__name__} -> workers: {workers}, work_units: {len(work_units)}")
 
-    with Pool() as pool:
-        embedded_file_states = pool.map(prtl_process_file_paths, file_path_chunks)
+    # export once up front rather than in every worker...
+    if env.get_env_var("EMBED_BACKEND", DEFAULT_EMBED_BACKEND).lower() == "onnx":
+        ensure_onnx_model(
+            DEFAULT_EMBEDDING_MODEL_NAME,
+            env.get_env_var("EMBED_ONNX_CACHE_DIR", DEFAULT_ONNX_CACHE_DIR),
+        )
 
     merged_embedded_file_states = {}
-    for state in embedded_file_states:
-        merged_embedded_file_states.update(state)
 
-    actor = create_embedding_actor_proxy(file_system_name)
-    await actor.set_state(merged_embedded_file_states)
+    # spawn, not fork, the parent holds torch thread pools and open http connections. a worker failing to start
+    # breaks the executor and raises BrokenProcessPool here, a multiprocessing.Pool would respawn it forever...
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_embed_worker,
+        initargs=(file_system_name, worker_threads, file_system_path),
+    )
+    try:
+        # idle workers pull the next unit as soon as they finish, so large and small units balance out...
+        for future in as_completed([executor.submit(_process_work_unit, work_unit) for work_unit in work_units]):
+            state, unit_skipped_files = future.result()
+            merged_embedded_file_states.update(state)
+            merge_skipped_files(skipped_files, unit_skipped_files)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return merged_embedded_file_states
+
+
+def is_file_path_ignored(
+    relative_file_path: str, ignore_folders: List[str], ignore_file_exts: List[str]
+) -> bool:
+    """Applies the same folder and extension rules as iter_file_paths to a single repo-relative path."""
+
+    *folders, file_name = relative_file_path.split("/")
+    if any(folder in ignore_folders for folder in folders):
+        return True
+
+    return any(file_name.endswith(ext) for ext in ignore_file_exts)
+
+
+def reconcile_file_paths(
+    file_paths: Iterable[str],
+    file_system_name: str,
+    previous_state: Dict[str, Any],
+    skipped_files: Optional[Dict[str, Dict[str, int]]] = None,
+    file_system_path: Optional[str] = None,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Embeds new and changed files, deletes stale chunks, and returns the new state with a report of what changed and what was skipped."""
 
+    if skipped_files is None:
+        skipped_files = {}
 
-async def embed_file_system(file_system_path: str, file_system_name:str) -> Awaitable:
+    lexical_index = get_lexical_index()
+    indexed_state = previous_state
+    if lexical_index is not None:
+        # files missing from the lexical index, e.g. embedded before it existed or on a fresh disk, are split again...
+        indexed_sources = lexical_index.get_sources(file_system_name)
+        indexed_state = {
+            key: file_state for key, file_state in previous_state.items()
+            if file_state.get("path", None) in indexed_sources
+        }
+
+    # pool workers would only take turns on the local store's file lock, it's written from this process...
+    if env.get_env_var("EMBED_CONCURRENT", "false").lower() == "true" and vector_store_backend() != "local":
+        current_state = process_file_paths_concurrent(
+            list(file_paths), file_system_name, indexed_state, skipped_files, file_system_path
+        )
+    else:
+        current_state = process_file_paths(
+            file_paths, file_system_name, indexed_state, skipped_files, file_system_path
+        )
+
+    embedding_diff = diff_embedded_files_state(previous_state, current_state)
+    deleted_chunks = delete_stale_chunks(
+        create_collection(collection_name=file_system_name),
+        previous_state,
+        current_state,
+        embedding_diff,
+    )
+
+    if lexical_index is not None:
+        lexical_index.delete_sources(
+            file_system_name,
+            [previous_state[key]["path"] for key in embedding_diff["removed"] if previous_state[key].get("path", None)],
+        )
+
+    embedding_report = {
+        "added": len(embedding_diff["added"]),
+        "changed": len(embedding_diff["changed"]),
+        "unchanged": len(embedding_diff["unchanged"]),
+        "removed": len(embedding_diff["removed"]),
+        "deleted_chunks": deleted_chunks,
+        "skipped": skipped_files,
+    }
+
+    return current_state, embedding_report
+
+
+async def embed_file_system(file_system_path: str, file_system_name:str) -> Awaitable[Dict[str, int]]:
     log(f"{embed_file_system.__name__} START.")
 
     ignore_folders = env.get_env_var("IGNORE_FOLDERS", DEFAULT_IGNORE_FOLDERS).split(",")
     ignore_file_exts = env.get_env_var("IGNORE_FILE_EXTS", DEFAULT_IGNORE_FILE_EXTS).split(",")
 
-    file_dict = traverse_folder(file_system_path, ignore_folders, ignore_file_exts)
-    file_paths = [f"{k}/{f}" for k, v in file_dict.items() for f in v]
+    skipped_files = {}
+    file_paths = iter_file_paths(file_system_path, ignore_folders, ignore_file_exts, skipped_files)
 
     actor = create_embedding_actor_proxy(file_system_name)
     actor_state = await actor.get_state()
+    actor = create_embedding_actor_proxy(file_system_name)
+    collection_name = get_active_collection_name(await actor.get_metadata(), file_system_name)
 
-    updated_actor_state = process_file_paths(file_paths, file_system_name, actor_state)
+    # embedding takes minutes, keep the event loop serving /qry meanwhile...
+    updated_actor_state, embedding_report = await asyncio.to_thread(
+        reconcile_file_paths, file_paths, collection_name, actor_state, skipped_files, file_system_path
+    )
 
     actor = create_embedding_actor_proxy(file_system_name)
     await actor.set_state(updated_actor_state)
 
-    log(f"{embed_file_system.__name__} END.")
+    log(f"{embed_file_system.__name__} END. {embedding_report}")
+
+    return embedding_report
+
+
+async def rebuild_file_system(file_system_path: str, file_system_name: str) -> Awaitable[Dict[str, Any]]:
+    """
+    Rebuilds the file system into a new version of its collection while queries keep reading the active one, then
+    repoints the repo's alias to the new version, together with its state, and drops the old version once readers
+    have moved on. The new version starts as a copy of the active one, so only files changed since are re-embedded.
+    """
+
+    log(f"{rebuild_file_system.__name__} START.")
+
+    ignore_folders = env.get_env_var("IGNORE_FOLDERS", DEFAULT_IGNORE_FOLDERS).split(",")
+    ignore_file_exts = env.get_env_var("IGNORE_FILE_EXTS", DEFAULT_IGNORE_FILE_EXTS).split(",")
+    gc_delay_seconds = float(env.get_env_var("EMBED_COLLECTION_GC_DELAY_SECONDS", DEFAULT_COLLECTION_GC_DELAY_SECONDS))
+
+    actor = create_embedding_actor_proxy(file_system_name)
+    metadata = await actor.get_metadata()
+    active_collection = get_active_collection_name(metadata, file_system_name)
+    generation = metadata.get("collection_generation", 0) + 1
+    shadow_collection = versioned_collection_name(file_system_name, generation)
+
+    # leftovers of a rebuild that died before its swap, and versions retired by the previous rebuild...
+    for collection_name in [shadow_collection, *metadata.get("retired_collections", [])]:
+        if collection_name != active_collection:
+            await asyncio.to_thread(drop_collection, collection_name)
+
+    actor = create_embedding_actor_proxy(file_system_name)
+    actor_state = await actor.get_state()
+    copied_chunks = await asyncio.to_thread(copy_collection, active_collection, shadow_collection)
+
+    skipped_files = {}
+    file_paths = iter_file_paths(file_system_path, ignore_folders, ignore_file_exts, skipped_files)
+
+    # diffed against the active version's state, unchanged files keep their copied chunks, without a copy all are new...
+    updated_actor_state, embedding_report = await asyncio.to_thread(
+        reconcile_file_paths,
+        file_paths,
+        shadow_collection,
+        actor_state if copied_chunks else {},
+        skipped_files,
+        file_system_path,
+    )
+
+    # re-read, other fields may have moved on while the rebuild ran...
+    actor = create_embedding_actor_proxy(file_system_name)
+    metadata = await actor.get_metadata()
+    retired_collection = get_active_collection_name(metadata, file_system_name)
+    metadata.update({
+        "active_collection": shadow_collection,
+        "collection_generation": generation,
+        "retired_collections": [retired_collection],
+    })
+
+    actor = create_embedding_actor_proxy(file_system_name)
+    await actor.set_state_and_metadata({"state": updated_actor_state, "metadata": metadata})
+
+    schedule_collection_gc(retired_collection, gc_delay_seconds)
+
+    embedding_report.update({
+        "copied_chunks": copied_chunks,
+        "active_collection": shadow_collection,
+        "retired_collection": retired_collection,
+    })
+    log(f"{rebuild_file_system.__name__} END. {embedding_report}")
+
+    return embedding_report
+
+
+async def embed_file_system_changes(
+    file_system_path: str,
+    file_system_name: str,
+    changed_file_paths: List[str],
+    removed_file_paths: List[str],
+) -> Awaitable[Dict[str, int]]:
+    """Embeds only the given changed files and drops the removed ones, leaving the rest of the state untouched."""
+
+    log(f"{embed_file_system_changes.__name__} START. changed: {len(changed_file_paths)}, removed: {len(removed_file_paths)}")
+
+    ignore_folders = env.get_env_var("IGNORE_FOLDERS", DEFAULT_IGNORE_FOLDERS).split(",")
+    ignore_file_exts = env.get_env_var("IGNORE_FILE_EXTS", DEFAULT_IGNORE_FILE_EXTS).split(",")
+
+    listed_paths = git_listed_paths(file_system_path)
+    attr_excluded_paths = git_attr_excluded_paths(file_system_path)
+
+    skipped_files = {}
+    file_paths = []
+    for file_path in changed_file_paths:
+        relative_file_path = os.path.relpath(file_path, file_system_path)
+        if not os.path.isfile(file_path) or is_file_path_ignored(
+            relative_file_path, ignore_folders, ignore_file_exts
+        ):
+            continue
+
+        reason = detect_git_skip_reason(relative_file_path, listed_paths, attr_excluded_paths)
+        if reason:
+            record_skipped_file(skipped_files, reason, os.path.getsize(file_path))
+            continue
+
+        file_paths.append(file_path)
+
+    actor = create_embedding_actor_proxy(file_system_name)
+    actor_state = await actor.get_state()
+    actor = create_embedding_actor_proxy(file_system_name)
+    collection_name = get_active_collection_name(await actor.get_metadata(), file_system_name)
+
+    touched_keys = {
+        translate_file_path_to_key(file_path)
+        for file_path in changed_file_paths + removed_file_paths
+    }
+    previous_state = {key: actor_state[key] for key in touched_keys if key in actor_state}
+
+    current_state, embedding_report = await asyncio.to_thread(
+        reconcile_file_paths, file_paths, collection_name, previous_state, skipped_files, file_system_path
+    )
+
+    updated_actor_state = {
+        key: file_state for key, file_state in actor_state.items() if key not in touched_keys
+    }
+    updated_actor_state.update(current_state)
+
+    actor = create_embedding_actor_proxy(file_system_name)
+    await actor.set_state(updated_actor_state)
+
+    embedding_report["unchanged"] += len(updated_actor_state) - len(current_state)
+
+    log(f"{embed_file_system_changes.__name__} END. {embedding_report}")
+
+    return embedding_report
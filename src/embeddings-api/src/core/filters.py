@@ -0,0 +1,115 @@
+import os
+import re
+from typing import Dict, Optional
+
+
+DEFAULT_MAX_FILE_BYTES = 1024 * 1024
+DEFAULT_SNIFF_BYTES = 8 * 1024
+DEFAULT_MINIFIED_MIN_BYTES = 1024
+DEFAULT_MINIFIED_AVG_LINE_LENGTH = 200
+DEFAULT_BINARY_CONTROL_RATIO = 0.3
+# generators stamp their banner in the header comment, a marker further down is just code talking about it...
+DEFAULT_GENERATED_MARKER_LINES = 5
+
+GENERATED_FILE_NAMES = {
+    "package-lock.json",
+    "npm-shrinkwrap.json",
+    "yarn.lock",
+    "pnpm-lock.yaml",
+    "poetry.lock",
+    "Pipfile.lock",
+    "uv.lock",
+    "Cargo.lock",
+    "composer.lock",
+    "Gemfile.lock",
+    "go.sum",
+    "packages.lock.json",
+}
+MINIFIED_FILE_SUFFIXES = (".min.js", ".min.css", ".min.mjs", ".js.map", ".css.map", ".bundle.js")
+# long lines only mean minified in these, svg, json and the like are legitimately written on one line...
+MINIFIABLE_FILE_EXTS = (".js", ".mjs", ".cjs", ".css")
+COMMENT_LINE_PATTERN = re.compile(r"^\s*(//|#|/\*|\*|<!--|--|;|')")
+GENERATED_MARKERS = (
+    "@generated",
+    "<auto-generated",
+    "code generated by",
+    "this file was automatically generated",
+    "this file is automatically generated",
+)
+
+# bytes that show up in text files, anything else in the leading sample counts towards binary...
+TEXT_BYTES = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7F})
+
+
+class SkipReasons:
+    GITIGNORE = "gitignore"
+    GITATTRIBUTES = "gitattributes"
+    TOO_LARGE = "too_large"
+    BINARY = "binary"
+    UNDECODABLE = "undecodable"
+    MINIFIED = "minified"
+    GENERATED = "generated"
+
+
+def record_skipped_file(skipped_files: Dict[str, Dict[str, int]], reason: str, size: int) -> None:
+    stats = skipped_files.setdefault(reason, {"files": 0, "bytes": 0})
+    stats["files"] += 1
+    stats["bytes"] += size
+
+
+def merge_skipped_files(target: Dict[str, Dict[str, int]], source: Dict[str, Dict[str, int]]) -> None:
+    for reason, stats in source.items():
+        target_stats = target.setdefault(reason, {"files": 0, "bytes": 0})
+        target_stats["files"] += stats["files"]
+        target_stats["bytes"] += stats["bytes"]
+
+
+def is_binary_sample(sample: bytes) -> bool:
+    if not sample:
+        return False
+
+    if b"\0" in sample:
+        return True
+
+    control_bytes = sample.translate(None, TEXT_BYTES)
+    return len(control_bytes) / len(sample) > DEFAULT_BINARY_CONTROL_RATIO
+
+
+def detect_name_skip_reason(file_path: str) -> Optional[str]:
+    """Cheap checks on the file name alone, run before any bytes are read."""
+
+    file_name = os.path.basename(file_path)
+
+    if file_name in GENERATED_FILE_NAMES:
+        return SkipReasons.GENERATED
+
+    if file_name.endswith(MINIFIED_FILE_SUFFIXES):
+        return SkipReasons.MINIFIED
+
+    return None
+
+
+def is_generated_header(text: str) -> bool:
+    """Whether a generated marker shows up in a comment among the first lines."""
+
+    for line in text[:DEFAULT_SNIFF_BYTES].splitlines()[:DEFAULT_GENERATED_MARKER_LINES]:
+        if COMMENT_LINE_PATTERN.match(line) and any(marker in line.lower() for marker in GENERATED_MARKERS):
+            return True
+    return False
+
+
+def detect_content_skip_reason(text: str, file_path: Optional[str] = None) -> Optional[str]:
+    """Heuristics for minified bundles and generated sources on decoded content."""
+
+    if is_generated_header(text):
+        return SkipReasons.GENERATED
+
+    if file_path is not None and not file_path.lower().endswith(MINIFIABLE_FILE_EXTS):
+        return None
+
+    if len(text) >= DEFAULT_MINIFIED_MIN_BYTES:
+        avg_line_length = len(text) / (text.count("\n") + 1)
+        if avg_line_length > DEFAULT_MINIFIED_AVG_LINE_LENGTH:
+            return SkipReasons.MINIFIED
+
+    return None
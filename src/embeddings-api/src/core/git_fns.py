@@ -0,0 +1,124 @@
+import os
+from shlex import quote
+from typing import List, Optional, Set, Tuple
+from agntsmth_core.core.utls import exec_sh_cmd, log
+
+
+def git_head_sha(dir_path: str) -> Optional[str]:
+    output, _ = exec_sh_cmd(f"git -C {quote(dir_path)} rev-parse HEAD")
+    return output or None
+
+
+def git_has_commit(dir_path: str, sha: str) -> bool:
+    output, _ = exec_sh_cmd(f"git -C {quote(dir_path)} cat-file -t {quote(sha)}")
+    return output == "commit"
+
+
+def clone_mirror(clone_url: str, dir_path: str, branch_name: Optional[str] = None) -> Optional[str]:
+    """Shallow clones into dir_path, leaving no credentials in the remote config. Returns the HEAD sha."""
+
+    branch_arg = f"--branch {quote(branch_name)} " if branch_name else ""
+    _, err = exec_sh_cmd(f"git clone --depth 1 {branch_arg}{quote(clone_url)} {quote(dir_path)}")
+    if not os.path.isdir(os.path.join(dir_path, ".git")):
+        log(f"{clone_mirror.__name__} FAILED. err: {err}")
+        return None
+
+    # the clone url may carry a PAT, the mirror outlives the job so don't persist it...
+    exec_sh_cmd(f"git -C {quote(dir_path)} remote remove origin")
+
+    return git_head_sha(dir_path)
+
+
+def fetch_mirror(clone_url: str, dir_path: str, branch_name: Optional[str] = None) -> Optional[str]:
+    """Fetches the tip of the branch (or the remote HEAD) into an existing mirror and checks it out. Returns the new HEAD sha."""
+
+    if not os.path.isdir(os.path.join(dir_path, ".git")):
+        return None
+
+    ref = quote(branch_name) if branch_name else "HEAD"
+    output, err = exec_sh_cmd(f"git -C {quote(dir_path)} fetch --depth 1 {quote(clone_url)} {ref}")
+    if output is None:
+        log(f"{fetch_mirror.__name__} FAILED. err: {err}")
+        return None
+
+    output, err = exec_sh_cmd(
+        f"git -C {quote(dir_path)} reset --hard FETCH_HEAD && git -C {quote(dir_path)} clean -fdx"
+    )
+    if output is None:
+        log(f"{fetch_mirror.__name__} FAILED. err: {err}")
+        return None
+
+    return git_head_sha(dir_path)
+
+
+def git_changed_paths(
+    dir_path: str, from_sha: str, to_sha: str
+) -> Optional[Tuple[List[str], List[str]]]:
+    """
+    Diffs two commits of a mirror.
+
+    :return: (changed, removed) absolute file paths, or None when either commit isn't available locally.
+    """
+
+    if not git_has_commit(dir_path, from_sha) or not git_has_commit(dir_path, to_sha):
+        return None
+
+    output, err = exec_sh_cmd(
+        f"git -C {quote(dir_path)} diff --name-status --no-renames -z {quote(from_sha)} {quote(to_sha)}"
+    )
+    if output is None:
+        log(f"{git_changed_paths.__name__} FAILED. err: {err}")
+        return None
+
+    changed_file_paths = []
+    removed_file_paths = []
+
+    # -z output alternates status and path, each NUL terminated...
+    fields = [f for f in output.split("\0") if f]
+    for status, path in zip(fields[0::2], fields[1::2]):
+        file_path = f"{dir_path}/{path}"
+        if status == "D":
+            removed_file_paths.append(file_path)
+        else:
+            changed_file_paths.append(file_path)
+
+    return changed_file_paths, removed_file_paths
+
+
+def git_listed_paths(dir_path: str) -> Optional[Set[str]]:
+    """Repo-relative paths of tracked and untracked files that .gitignore rules don't exclude, or None outside a git work tree."""
+
+    if not os.path.isdir(os.path.join(dir_path, ".git")):
+        return None
+
+    output, err = exec_sh_cmd(
+        f"git -C {quote(dir_path)} ls-files -z --cached --others --exclude-standard"
+    )
+    if output is None:
+        log(f"{git_listed_paths.__name__} FAILED. err: {err}")
+        return None
+
+    return {path for path in output.split("\0") if path}
+
+
+def git_attr_excluded_paths(dir_path: str) -> Set[str]:
+    """Repo-relative paths that .gitattributes marks as generated, vendored or binary."""
+
+    if not os.path.isdir(os.path.join(dir_path, ".git")):
+        return set()
+
+    output, err = exec_sh_cmd(
+        f"git -C {quote(dir_path)} ls-files -z --cached --others --exclude-standard"
+        f" | git -C {quote(dir_path)} check-attr -z --stdin linguist-generated linguist-vendored binary"
+    )
+    if output is None:
+        log(f"{git_attr_excluded_paths.__name__} FAILED. err: {err}")
+        return set()
+
+    # -z output is path, attribute, value triples, each NUL terminated...
+    fields = output.split("\0")
+    return {
+        path
+        for path, _, value in zip(fields[0::3], fields[1::3], fields[2::3])
+        if value in ("set", "true")
+    }
@@ -0,0 +1,299 @@
+import os
+import re
+import math
+import sqlite3
+import functools
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from langchain_core.documents import Document
+from agntsmth_core.core.utls import EnvVarProvider
+
+
+# per node by default, hybrid /qry needs EMBED_LEXICAL_INDEX_PATH on storage every embedding and query node shares...
+DEFAULT_LEXICAL_INDEX_PATH = os.path.expanduser("~/.cache/lxi/lexical_index.sqlite")
+DEFAULT_BM25_K1 = 1.2
+DEFAULT_BM25_B = 0.75
+# terms in more than this share of a collection's chunks barely rank anything, and cost the most postings to read...
+DEFAULT_MAX_TERM_DF_RATIO = 0.5
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+IDENTIFIER_PART_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+env = EnvVarProvider()
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Identifier-aware terms of text: every identifier lower-cased as a whole, plus its camelCase and snake_case parts,
+    e.g. "getUserById" -> getuserbyid, get, user, by, id.
+    """
+
+    terms = []
+
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        whole = identifier.lower()
+        if MIN_TERM_LENGTH <= len(whole) <= MAX_TERM_LENGTH:
+            terms.append(whole)
+
+        parts = [part.lower() for word in identifier.split("_") for part in IDENTIFIER_PART_PATTERN.findall(word)]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if MIN_TERM_LENGTH <= len(part) <= MAX_TERM_LENGTH)
+
+    return terms
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index of chunks on local disk, per collection, with identifier-aware terms. Chunks are replaced a
+    source file at a time and only chunk ids are returned, the chunks themselves stay in the vector store.
+    """
+
+    def __init__(self, db_path: str, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B):
+        """
+        Opens, or creates, the index database.
+
+        :param db_path: Path of the SQLite file.
+        :param k1: BM25 term frequency saturation.
+        :param b: BM25 chunk length normalization.
+        """
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self._k1 = k1
+        self._b = b
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        # several embed workers share the file...
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                collection TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                source TEXT NOT NULL,
+                path TEXT,
+                ext TEXT,
+                length INTEGER NOT NULL,
+                PRIMARY KEY (collection, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_chunks_source ON chunks (collection, source);
+            CREATE TABLE IF NOT EXISTS postings (
+                collection TEXT NOT NULL,
+                term TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (collection, term, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_postings_chunk ON postings (collection, chunk_id);
+            CREATE TABLE IF NOT EXISTS collections (
+                collection TEXT PRIMARY KEY,
+                chunk_count INTEGER NOT NULL,
+                total_length INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            """
+        )
+        self._conn.commit()
+
+    def _delete_sources(self, collection_name: str, sources: List[str]) -> None:
+        for source in sources:
+            rows = self._conn.execute(
+                "SELECT chunk_id, length FROM chunks WHERE collection = ? AND source = ?", (collection_name, source)
+            ).fetchall()
+            if not rows:
+                continue
+
+            self._conn.executemany(
+                "DELETE FROM postings WHERE collection = ? AND chunk_id = ?",
+                [(collection_name, chunk_id) for chunk_id, _ in rows],
+            )
+            self._conn.execute("DELETE FROM chunks WHERE collection = ? AND source = ?", (collection_name, source))
+            self._conn.execute(
+                "UPDATE collections SET chunk_count = chunk_count - ?, total_length = total_length - ? WHERE collection = ?",
+                (len(rows), sum(length for _, length in rows), collection_name),
+            )
+
+    def replace_source(self, collection_name: str, source: str, chunks: List[Tuple[str, Document]]) -> None:
+        """Replaces every indexed chunk of the source file with its (id, document) chunks."""
+
+        chunk_rows = []
+        posting_rows = []
+
+        for chunk_id, document in chunks:
+            term_counts = Counter(tokenize(document.page_content))
+            chunk_rows.append((
+                collection_name,
+                chunk_id,
+                source,
+                document.metadata.get("path", None),
+                document.metadata.get("ext", None),
+                sum(term_counts.values()),
+            ))
+            posting_rows.extend((collection_name, term, chunk_id, tf) for term, tf in term_counts.items())
+
+        with self._lock:
+            # lock the file up front, chunk counts are read and updated in one transaction...
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._delete_sources(collection_name, [source])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (collection, chunk_id, source, path, ext, length) VALUES (?, ?, ?, ?, ?, ?)",
+                chunk_rows,
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO postings (collection, term, chunk_id, tf) VALUES (?, ?, ?, ?)", posting_rows
+            )
+            self._conn.execute(
+                """
+                INSERT INTO collections (collection, chunk_count, total_length) VALUES (?, ?, ?)
+                ON CONFLICT (collection) DO UPDATE SET
+                    chunk_count = chunk_count + excluded.chunk_count,
+                    total_length = total_length + excluded.total_length
+                """,
+                (collection_name, len(chunk_rows), sum(row[-1] for row in chunk_rows)),
+            )
+            self._conn.commit()
+
+    def delete_sources(self, collection_name: str, sources: List[str]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._delete_sources(collection_name, sources)
+            self._conn.commit()
+
+    def delete_collection(self, collection_name: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for table in ("postings", "chunks", "collections"):
+                self._conn.execute(f"DELETE FROM {table} WHERE collection = ?", (collection_name,))
+            self._conn.commit()
+
+    def copy_collection(self, source_collection_name: str, collection_name: str) -> None:
+        """Replaces the collection's chunks with a copy of the source collection's."""
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for table in ("postings", "chunks", "collections"):
+                self._conn.execute(f"DELETE FROM {table} WHERE collection = ?", (collection_name,))
+            self._conn.execute(
+                "INSERT INTO chunks SELECT ?, chunk_id, source, path, ext, length FROM chunks WHERE collection = ?",
+                (collection_name, source_collection_name),
+            )
+            self._conn.execute(
+                "INSERT INTO postings SELECT ?, term, chunk_id, tf FROM postings WHERE collection = ?",
+                (collection_name, source_collection_name),
+            )
+            self._conn.execute(
+                "INSERT INTO collections SELECT ?, chunk_count, total_length FROM collections WHERE collection = ?",
+                (collection_name, source_collection_name),
+            )
+            self._conn.commit()
+
+    def get_sources(self, collection_name: str) -> set:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT source FROM chunks WHERE collection = ?", (collection_name,)
+            ).fetchall()
+        return {source for source, in rows}
+
+    def search(
+        self,
+        collection_name: str,
+        qry: str,
+        k: int,
+        accept: Optional[Callable[[Optional[str], Optional[str]], bool]] = None,
+    ) -> List[Tuple[str, float]]:
+        """
+        Returns the (chunk id, BM25 score) of the k best matching chunks, most relevant first.
+
+        :param accept: Filters chunks by their repo-relative path and extension.
+        """
+
+        terms = list(dict.fromkeys(tokenize(qry)))
+        if not terms:
+            return []
+
+        with self._lock:
+            stats = self._conn.execute(
+                "SELECT chunk_count, total_length FROM collections WHERE collection = ?", (collection_name,)
+            ).fetchone()
+            if stats is None or stats[0] <= 0:
+                return []
+
+            chunk_count, total_length = stats
+            placeholders = ",".join("?" * len(terms))
+            dfs = dict(self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE collection = ? AND term IN ({placeholders}) GROUP BY term",
+                [collection_name, *terms],
+            ).fetchall())
+
+            rare_terms = [term for term in dfs if dfs[term] <= chunk_count * DEFAULT_MAX_TERM_DF_RATIO]
+            terms = rare_terms or list(dfs)
+            if not terms:
+                return []
+
+            placeholders = ",".join("?" * len(terms))
+            postings = self._conn.execute(
+                f"""
+                SELECT p.term, p.chunk_id, p.tf, c.length, c.path, c.ext
+                FROM postings p JOIN chunks c ON c.collection = p.collection AND c.chunk_id = p.chunk_id
+                WHERE p.collection = ? AND p.term IN ({placeholders})
+                """,
+                [collection_name, *terms],
+            ).fetchall()
+
+        avg_length = max(total_length / chunk_count, 1)
+        scores: Dict[str, float] = {}
+
+        for term, chunk_id, tf, length, path, ext in postings:
+            if accept is not None and not accept(path, ext):
+                continue
+
+            df = dfs[term]
+            idf = math.log(1 + (chunk_count - df + 0.5) / (df + 0.5))
+            norm = tf + self._k1 * (1 - self._b + self._b * length / avg_length)
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self._k1 + 1) / norm
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+@functools.lru_cache(maxsize=1)
+def get_lexical_index() -> Optional[LexicalIndex]:
+    """Returns the process-wide lexical index, or None when EMBED_LEXICAL_INDEX is disabled."""
+
+    if env.get_env_var("EMBED_LEXICAL_INDEX", "true").lower() != "true":
+        return None
+
+    return LexicalIndex(env.get_env_var("EMBED_LEXICAL_INDEX_PATH", DEFAULT_LEXICAL_INDEX_PATH))
+
+
+def index_chunks(
+    chunks: Iterable[Tuple[str, Document]], lexical_index: Optional[LexicalIndex], collection_name: str
+) -> Iterator[Tuple[str, Document]]:
+    """Passes (id, document) chunks through, replacing each source file's chunks in the lexical index once all are seen."""
+
+    if lexical_index is None:
+        yield from chunks
+        return
+
+    source = None
+    source_chunks: List[Tuple[str, Document]] = []
+
+    # split_documents yields all chunks of a file in a row...
+    for chunk in chunks:
+        chunk_source = chunk[1].metadata["source"]
+        if chunk_source != source and source_chunks:
+            lexical_index.replace_source(collection_name, source, source_chunks)
+            source_chunks = []
+
+        source = chunk_source
+        source_chunks.append(chunk)
+        yield chunk
+
+    if source_chunks:
+        lexical_index.replace_source(collection_name, source, source_chunks)
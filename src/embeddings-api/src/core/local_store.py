@@ -0,0 +1,555 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from agntsmth_core.core.utls import log
+
+
+DEFAULT_LOCAL_STORE_DIR = os.path.expanduser("~/.cache/lxi/vector_store")
+DEFAULT_LOCAL_MAX_LOADED_COLLECTIONS = 8
+# below this many candidates an exact scan of the matrix beats walking the graph...
+DEFAULT_LOCAL_EXACT_MAX_VECTORS = 4096
+DEFAULT_LOCAL_PERSIST_SECONDS = 30
+DEFAULT_HNSW_M = 16
+DEFAULT_HNSW_EF_CONSTRUCTION = 100
+DEFAULT_HNSW_EF_SEARCH = 64
+DEFAULT_SPACE = "l2"
+INITIAL_CAPACITY = 1024
+
+RECORDS_FILE_NAME = "records.sqlite"
+VECTORS_FILE_NAME = "vectors.f32"
+HNSW_FILE_NAME = "hnsw.bin"
+LOCK_FILE_NAME = "write.lock"
+
+WHERE_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+}
+
+
+def match_where(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """Evaluates a Chroma where clause, with $and, $or and the comparison operators, against chunk metadata."""
+
+    if not where:
+        return True
+
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(match_where(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(match_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key, None)
+            for operator, operand in condition.items():
+                if operator not in WHERE_OPERATORS:
+                    raise ValueError(f"Unsupported where operator: {operator}.")
+                if not WHERE_OPERATORS[operator](value, operand):
+                    return False
+        elif metadata.get(key, None) != condition:
+            return False
+
+    return True
+
+
+def load_hnswlib() -> Optional[Any]:
+    try:
+        import hnswlib
+    except ImportError:
+        return None
+    return hnswlib
+
+
+class LoadedCollection:
+    """
+    A collection opened from disk: ids, documents and metadata in SQLite, vectors in a memory-mapped float32 matrix
+    indexed by slot, and an HNSW graph over the slots. Ids and metadata are held in memory for filtering, documents
+    are read on demand. Several processes, e.g. uvicorn workers, may open the same collection: writes are serialized
+    by a file lock and every open copy reloads once the generation on disk moves past its own.
+    """
+
+    def __init__(self, dir_path: str, metadata: Optional[Dict[str, Any]] = None, persist_seconds: float = DEFAULT_LOCAL_PERSIST_SECONDS):
+        os.makedirs(dir_path, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.closed = False
+        self._dir_path = dir_path
+        self._persist_seconds = persist_seconds
+        self._persisted_at = time.monotonic()
+        self._lock_file = open(os.path.join(dir_path, LOCK_FILE_NAME), "a")
+
+        self._conn = sqlite3.connect(os.path.join(dir_path, RECORDS_FILE_NAME), timeout=30, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                slot INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                document TEXT,
+                metadata TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+        saved_metadata = self._read_meta().get("collection_metadata", None)
+        self.metadata: Dict[str, Any] = saved_metadata or {"hnsw:space": DEFAULT_SPACE, **(metadata or {})}
+        if saved_metadata is None:
+            self._save_meta({"collection_metadata": self.metadata})
+
+        self._vectors: Optional[np.memmap] = None
+        self._hnsw = None
+        self._load()
+
+    def _read_meta(self) -> Dict[str, Any]:
+        return {key: json.loads(value) for key, value in self._conn.execute("SELECT key, value FROM meta")}
+
+    def _load(self) -> None:
+        """(Re)reads records, the matrix and the graph as of the generation on disk."""
+
+        saved_meta = self._read_meta()
+        self._dim: Optional[int] = saved_meta.get("dim", None)
+        self._generation: int = saved_meta.get("generation", 0)
+        self._hnsw_generation: Optional[int] = saved_meta.get("hnsw_generation", None)
+
+        self.ids: Dict[int, str] = {}
+        self.metadatas: Dict[int, Dict[str, Any]] = {}
+        self.slots: Dict[str, int] = {}
+        for slot, chunk_id, metadata_json in self._conn.execute("SELECT slot, id, metadata FROM records"):
+            self.ids[slot] = chunk_id
+            self.metadatas[slot] = json.loads(metadata_json) if metadata_json else {}
+            self.slots[chunk_id] = slot
+
+        self._next_slot = max(self.ids, default=-1) + 1
+        self._free_slots = sorted(set(range(self._next_slot)) - set(self.ids), reverse=True)
+
+        self._vectors = None
+        self._hnsw = None
+        if self._dim is not None:
+            self._open_vectors(max(INITIAL_CAPACITY, self._next_slot))
+            self._load_hnsw()
+
+    def _disk_generation(self) -> int:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return json.loads(row[0]) if row else 0
+
+    def refresh(self) -> bool:
+        """Reloads when another process wrote the collection since it was loaded, returning whether it did."""
+
+        if self._disk_generation() == self._generation:
+            return False
+
+        log(f"{self.refresh.__name__} -> reloading, dir_path: {self._dir_path}, generation: {self._generation}")
+        self._load()
+        return True
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """Holds the collection's file lock, across processes, with the latest generation loaded."""
+
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            self.refresh()
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @property
+    def space(self) -> str:
+        return self.metadata.get("hnsw:space", DEFAULT_SPACE)
+
+    def _save_meta(self, values: Dict[str, Any]) -> None:
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in values.items()],
+        )
+        self._conn.commit()
+
+    def _open_vectors(self, capacity: int) -> None:
+        vectors_path = os.path.join(self._dir_path, VECTORS_FILE_NAME)
+        size_bytes = capacity * self._dim * 4
+        if not os.path.exists(vectors_path) or os.path.getsize(vectors_path) < size_bytes:
+            with open(vectors_path, "ab") as f:
+                f.truncate(size_bytes)
+
+        capacity = os.path.getsize(vectors_path) // (self._dim * 4)
+        if self._vectors is not None:
+            self._vectors.flush()
+        self._vectors = np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self._dim))
+
+    def _load_hnsw(self) -> None:
+        hnswlib = load_hnswlib()
+        if hnswlib is None:
+            return
+
+        self._hnsw = hnswlib.Index(space=self.space, dim=self._dim)
+        hnsw_path = os.path.join(self._dir_path, HNSW_FILE_NAME)
+
+        if os.path.exists(hnsw_path) and self._hnsw_generation == self._generation:
+            self._hnsw.load_index(hnsw_path, max_elements=self._vectors.shape[0])
+        else:
+            # the graph lags the records, e.g. after a crash, rebuild it from the matrix...
+            log(f"{self._load_hnsw.__name__} -> rebuilding graph, dir_path: {self._dir_path}, vectors: {len(self.ids)}")
+            self._hnsw.init_index(
+                max_elements=self._vectors.shape[0], ef_construction=DEFAULT_HNSW_EF_CONSTRUCTION, M=DEFAULT_HNSW_M
+            )
+            if self.ids:
+                slots = np.fromiter(self.ids, dtype=np.int64)
+                self._hnsw.add_items(self._vectors[slots], slots)
+
+        self._hnsw.set_ef(DEFAULT_HNSW_EF_SEARCH)
+
+    def _ensure_capacity(self, slot_count: int) -> None:
+        if slot_count <= self._vectors.shape[0]:
+            return
+
+        capacity = max(slot_count, self._vectors.shape[0] * 2)
+        self._open_vectors(capacity)
+        if self._hnsw is not None:
+            self._hnsw.resize_index(capacity)
+
+    def _allocate_slot(self) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        self._next_slot += 1
+        return self._next_slot - 1
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def upsert(
+        self,
+        ids: List[str],
+        embeddings: List[List[float]],
+        documents: Optional[List[str]] = None,
+        metadatas: Optional[List[Dict[str, Any]]] = None,
+    ) -> None:
+        if not ids:
+            return
+
+        # the last write of an id repeated within the batch wins, as it would over separate upserts...
+        last_positions = list({chunk_id: i for i, chunk_id in enumerate(ids)}.values())
+        if len(last_positions) < len(ids):
+            ids = [ids[i] for i in last_positions]
+            embeddings = [embeddings[i] for i in last_positions]
+            documents = [documents[i] for i in last_positions] if documents else None
+            metadatas = [metadatas[i] for i in last_positions] if metadatas else None
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self._dim is None:
+            self._dim = vectors.shape[1]
+            self._save_meta({"dim": self._dim})
+            self._open_vectors(INITIAL_CAPACITY)
+            self._load_hnsw()
+        elif vectors.shape[1] != self._dim:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} doesn't match the collection's {self._dim}.")
+
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+
+        slots = [self.slots.get(chunk_id, None) for chunk_id in ids]
+        slots = [slot if slot is not None else self._allocate_slot() for slot in slots]
+        self._ensure_capacity(max(slots) + 1)
+
+        self._vectors[slots] = vectors
+        if self._hnsw is not None:
+            # re-adding a deleted or existing label updates it in place...
+            self._hnsw.add_items(vectors, slots)
+
+        rows = []
+        for slot, chunk_id, document, metadata in zip(slots, ids, documents, metadatas):
+            self.ids[slot] = chunk_id
+            self.metadatas[slot] = metadata or {}
+            self.slots[chunk_id] = slot
+            rows.append((slot, chunk_id, document, json.dumps(metadata) if metadata else None))
+
+        self._conn.executemany("INSERT OR REPLACE INTO records (slot, id, document, metadata) VALUES (?, ?, ?, ?)", rows)
+        self._written()
+
+    def delete(self, ids: List[str]) -> None:
+        slots = [self.slots.pop(chunk_id) for chunk_id in ids if chunk_id in self.slots]
+        if not slots:
+            return
+
+        for slot in slots:
+            del self.ids[slot]
+            del self.metadatas[slot]
+            if self._hnsw is not None:
+                self._hnsw.mark_deleted(slot)
+        self._free_slots = sorted(set(self._free_slots) | set(slots), reverse=True)
+
+        self._conn.executemany("DELETE FROM records WHERE slot = ?", [(slot,) for slot in slots])
+        self._written()
+
+    def _written(self) -> None:
+        self._generation += 1
+        self._save_meta({"generation": self._generation})
+
+        if time.monotonic() - self._persisted_at > self._persist_seconds:
+            self.persist()
+
+    def persist(self) -> None:
+        """Flushes the matrix and saves the graph, marking it current with the records."""
+
+        if self._vectors is not None:
+            self._vectors.flush()
+        if self._hnsw is not None and self._hnsw_generation != self._generation:
+            # other processes may be loading the graph, swap the file in whole...
+            hnsw_path = os.path.join(self._dir_path, HNSW_FILE_NAME)
+            self._hnsw.save_index(f"{hnsw_path}.{os.getpid()}.tmp")
+            os.replace(f"{hnsw_path}.{os.getpid()}.tmp", hnsw_path)
+            self._hnsw_generation = self._generation
+            self._save_meta({"hnsw_generation": self._hnsw_generation})
+        self._persisted_at = time.monotonic()
+
+    def close(self) -> None:
+        with self.writing():
+            self.persist()
+        self._vectors = None
+        self._hnsw = None
+        self._conn.close()
+        self._lock_file.close()
+        self.closed = True
+
+    def filter_slots(self, ids: Optional[List[str]], where: Optional[Dict[str, Any]]) -> List[int]:
+        slots = [self.slots[chunk_id] for chunk_id in ids if chunk_id in self.slots] if ids is not None else list(self.ids)
+        if where:
+            slots = [slot for slot in slots if match_where(self.metadatas[slot], where)]
+        return slots
+
+    def get_documents(self, slots: List[int]) -> List[Optional[str]]:
+        documents = {}
+        for i in range(0, len(slots), 500):
+            batch = slots[i:i + 500]
+            documents.update(self._conn.execute(
+                f"SELECT slot, document FROM records WHERE slot IN ({','.join('?' * len(batch))})", batch
+            ).fetchall())
+        return [documents.get(slot, None) for slot in slots]
+
+    def get_embeddings(self, slots: List[int]) -> np.ndarray:
+        # float64 like Chroma returns them, mmr re-ranks float32 similarities differently...
+        return np.array(self._vectors[slots], dtype=np.float64) if slots else np.empty((0, self._dim or 0))
+
+    def _distances(self, query: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        """Distances the way Chroma reports them: squared l2, or 1 - similarity for cosine and ip."""
+
+        if self.space == "l2":
+            return np.maximum(0.0, (vectors * vectors).sum(axis=1) - 2 * vectors @ query + query @ query)
+        if self.space == "cosine":
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+            return 1.0 - (vectors @ query) / np.maximum(norms, 1e-12)
+        return 1.0 - vectors @ query
+
+    def search(
+        self, query: np.ndarray, n_results: int, where: Optional[Dict[str, Any]], exact_max_vectors: int
+    ) -> Tuple[List[int], List[float]]:
+        """Nearest slots to the query, exact over small candidate sets and through the graph otherwise."""
+
+        candidates = self.filter_slots(None, where) if where else None
+        candidate_count = len(candidates) if candidates is not None else len(self.ids)
+        n_results = min(n_results, candidate_count)
+        if n_results <= 0:
+            return [], []
+
+        if self._hnsw is None or candidate_count <= exact_max_vectors:
+            slots = np.fromiter(candidates if candidates is not None else self.ids, dtype=np.int64)
+            distances = self._distances(query, self._vectors[slots])
+            nearest = np.argpartition(distances, n_results - 1)[:n_results] if n_results < len(slots) else np.arange(len(slots))
+            nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+            return slots[nearest].tolist(), distances[nearest].tolist()
+
+        self._hnsw.set_ef(max(DEFAULT_HNSW_EF_SEARCH, n_results))
+        allowed = set(candidates) if candidates is not None else None
+        labels, distances = self._hnsw.knn_query(
+            query.reshape(1, -1), k=n_results, filter=(allowed.__contains__ if allowed is not None else None)
+        )
+        return [int(label) for label in labels[0]], distances[0].tolist()
+
+
+class LocalCollection:
+    """
+    Chroma Collection look-alike, covering what ingestion, /qry and the langchain Chroma wrapper call, over a
+    collection the client loads on demand.
+    """
+
+    def __init__(self, client: "LocalVectorStoreClient", name: str):
+        self._client = client
+        self.name = name
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        with self._client.use(self.name) as loaded:
+            return dict(loaded.metadata)
+
+    def count(self) -> int:
+        with self._client.use(self.name) as loaded:
+            return loaded.count()
+
+    def upsert(self, ids, embeddings=None, documents=None, metadatas=None, **kwargs) -> None:
+        if embeddings is None:
+            raise ValueError("The local vector store has no embedding function, embeddings are required.")
+
+        with self._client.use(self.name) as loaded, loaded.writing():
+            loaded.upsert(list(ids), embeddings, documents, metadatas)
+
+    add = upsert
+    update = upsert
+
+    def delete(self, ids=None, where=None, **kwargs) -> None:
+        if ids is None and where is None:
+            return
+
+        with self._client.use(self.name) as loaded, loaded.writing():
+            slots = loaded.filter_slots(ids, where)
+            loaded.delete([loaded.ids[slot] for slot in slots])
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas"), **kwargs) -> Dict[str, Any]:
+        with self._client.use(self.name) as loaded:
+            slots = loaded.filter_slots(ids, where)[offset or 0:]
+            if limit is not None:
+                slots = slots[:limit]
+
+            return {
+                "ids": [loaded.ids[slot] for slot in slots],
+                "documents": loaded.get_documents(slots) if "documents" in include else None,
+                "metadatas": [loaded.metadatas[slot] for slot in slots] if "metadatas" in include else None,
+                "embeddings": loaded.get_embeddings(slots) if "embeddings" in include else None,
+            }
+
+    def query(
+        self,
+        query_embeddings=None,
+        n_results: int = 10,
+        where=None,
+        where_document=None,
+        include=("documents", "metadatas", "distances"),
+        query_texts=None,
+        **kwargs,
+    ) -> Dict[str, Any]:
+        if query_embeddings is None:
+            raise ValueError("The local vector store has no embedding function, query_embeddings are required.")
+        if where_document:
+            raise ValueError("where_document isn't supported by the local vector store.")
+
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": [], "embeddings": []}
+
+        with self._client.use(self.name) as loaded:
+            for query in np.asarray(query_embeddings, dtype=np.float32):
+                slots, distances = loaded.search(query, n_results, where, self._client.exact_max_vectors)
+                results["ids"].append([loaded.ids[slot] for slot in slots])
+                results["distances"].append(distances)
+                results["documents"].append(loaded.get_documents(slots) if "documents" in include else None)
+                results["metadatas"].append([loaded.metadatas[slot] for slot in slots] if "metadatas" in include else None)
+                results["embeddings"].append(loaded.get_embeddings(slots) if "embeddings" in include else None)
+
+        return {key: value if key == "ids" or key in include else None for key, value in results.items()}
+
+
+class LocalVectorStoreClient:
+    """
+    In-process stand-in for the Chroma client, persisting each collection in its own directory. At most
+    max_loaded_collections stay open, the least recently used one is persisted and closed to make room. Clients of
+    several processes may share dir_path, each sees the others' writes on its next use of a collection.
+    """
+
+    def __init__(
+        self,
+        dir_path: str,
+        max_loaded_collections: int = DEFAULT_LOCAL_MAX_LOADED_COLLECTIONS,
+        exact_max_vectors: int = DEFAULT_LOCAL_EXACT_MAX_VECTORS,
+        persist_seconds: float = DEFAULT_LOCAL_PERSIST_SECONDS,
+    ):
+        """
+        :param dir_path: Root directory of the collections.
+        :param max_loaded_collections: Collections kept open, with their matrix mapped and graph in memory.
+        :param exact_max_vectors: Searches over at most this many candidates scan the matrix instead of the graph.
+        :param persist_seconds: Writes save the graph at most this often, and on eviction.
+        """
+
+        os.makedirs(dir_path, exist_ok=True)
+
+        self._dir_path = dir_path
+        self._max_loaded_collections = max_loaded_collections
+        self.exact_max_vectors = exact_max_vectors
+        self._persist_seconds = persist_seconds
+        self._lock = threading.Lock()
+        self._loaded: "OrderedDict[str, LoadedCollection]" = OrderedDict()
+
+    def _collection_path(self, name: str) -> str:
+        return os.path.join(self._dir_path, name)
+
+    @contextmanager
+    def use(self, name: str, metadata: Optional[Dict[str, Any]] = None) -> Iterator[LoadedCollection]:
+        """Yields the loaded collection, loading it on demand, locked against writers and eviction while in use."""
+
+        while True:
+            evicted = []
+            with self._lock:
+                loaded = self._loaded.get(name, None)
+                if loaded is None:
+                    loaded = LoadedCollection(self._collection_path(name), metadata, self._persist_seconds)
+                    self._loaded[name] = loaded
+                self._loaded.move_to_end(name)
+                while len(self._loaded) > self._max_loaded_collections:
+                    evicted.append(self._loaded.popitem(last=False))
+
+            for evicted_name, evicted_collection in evicted:
+                with evicted_collection.lock:
+                    evicted_collection.close()
+                log(f"{self.use.__name__} -> evicted: {evicted_name}")
+
+            with loaded.lock:
+                # evicted by another thread between the lookup and the lock, load it again...
+                if loaded.closed:
+                    continue
+                # another worker process may have written it since...
+                loaded.refresh()
+                yield loaded
+                return
+
+    def get_or_create_collection(self, name: str, embedding_function=None, metadata=None, **kwargs) -> LocalCollection:
+        with self.use(name, metadata):
+            pass
+        return LocalCollection(self, name)
+
+    def get_collection(self, name: str, **kwargs) -> LocalCollection:
+        if not os.path.isdir(self._collection_path(name)):
+            raise ValueError(f"Collection {name} does not exist.")
+        return LocalCollection(self, name)
+
+    def list_collections(self) -> List[str]:
+        return sorted(
+            entry for entry in os.listdir(self._dir_path) if os.path.isdir(self._collection_path(entry))
+        )
+
+    def delete_collection(self, name: str) -> None:
+        with self._lock:
+            loaded = self._loaded.pop(name, None)
+        if loaded is not None:
+            with loaded.lock:
+                loaded.close()
+        shutil.rmtree(self._collection_path(name), ignore_errors=True)
+
+    def persist(self) -> None:
+        with self._lock:
+            loaded_collections = list(self._loaded.values())
+        for loaded in loaded_collections:
+            with loaded.lock:
+                if not loaded.closed:
+                    with loaded.writing():
+                        loaded.persist()
+
+    def heartbeat(self) -> int:
+        return time.time_ns()
@@ -0,0 +1,55 @@
+import queue
+import threading
+from typing import Iterable, Iterator, Any
+
+
+DEFAULT_STAGE_QUEUE_SIZE = 64
+STAGE_POLL_SECONDS = 0.1
+
+_END = object()
+
+
+def _put(items: queue.Queue, entry: Any, stopped: threading.Event) -> bool:
+    while not stopped.is_set():
+        try:
+            items.put(entry, timeout=STAGE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def iter_in_background(iterable: Iterable[Any], maxsize: int = DEFAULT_STAGE_QUEUE_SIZE) -> Iterator[Any]:
+    """
+    Drives iterable on its own thread, handing items over through a bounded queue.
+
+    Chaining stages this way lets each one run ahead of the next by at most maxsize items,
+    so I/O, tokenization and inference overlap while memory stays bounded. Errors raised by
+    the stage are re-raised in the consumer, and abandoning the consumer stops the stage.
+    """
+
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not _put(items, (item, None), stopped):
+                    return
+            _put(items, (_END, None), stopped)
+        except BaseException as e:
+            _put(items, (_END, e), stopped)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, err = items.get()
+            if item is _END:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stopped.set()
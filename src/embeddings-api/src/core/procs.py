@@ -1,22 +1,75 @@
 import os
-from typing import Awaitable, Dict, Any, Optional
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Dict, Any, Hashable, List, Optional
 from json import dumps as json_dumps
 import logging
-from langchain_chroma import Chroma
+import numpy as np
+from langchain_chroma.vectorstores import maximal_marginal_relevance
 from agntsmth_core.core.utls import (
     exec_sh_cmd,
     EnvVarProvider,
-    ChromaHttpClientFactory,
     log,
 )
 from lxi_framework import RootCmd, DaprConfigs, publish_event
 
-from .embed import embed_file_system, create_embedding_function
+from .embed import (
+    embed_file_system,
+    embed_file_system_changes,
+    rebuild_file_system,
+    get_active_collection_name,
+    create_embedding_function,
+    create_collection,
+    create_chunk_where,
+    match_path_prefixes,
+    normalize_file_ext,
+    embedding_model_key,
+    get_embedding_function,
+    CHUNK_METADATA_DIR_DEPTH,
+)
+from .registry import registry
+from .lexical import get_lexical_index
+from .batcher import QueryEmbeddingBatcher, DEFAULT_QRY_BATCH_SIZE, DEFAULT_QRY_BATCH_WAIT_MS
+from .qry_cache import (
+    QueryCache,
+    DEFAULT_QRY_CACHE_MAX_BYTES,
+    DEFAULT_QRY_CACHE_TTL_SECONDS,
+    DEFAULT_QRY_CACHE_VERSION_REFRESH_SECONDS,
+)
+from .actors import create_embedding_actor_proxy
+from .git_fns import clone_mirror, fetch_mirror, git_changed_paths
+
 
+DEFAULT_QRY_EXECUTOR_WORKERS = 4
+DEFAULT_QRY_K = 4
+DEFAULT_QRY_MAX_K = 50
+DEFAULT_QRY_MAX_BATCH_SIZE = 32
+DEFAULT_QRY_MMR_FETCH_K_FACTOR = 4
+DEFAULT_QRY_MMR_LAMBDA_MULT = 0.5
+# reciprocal-rank fusion constant, larger values flatten the advantage of top ranks...
+DEFAULT_QRY_RRF_K = 60
 
 env = EnvVarProvider()
-chroma_client = ChromaHttpClientFactory().create_with_auth()
-embedding_function = create_embedding_function()
+
+# model and chroma calls for /qry run here, never on the event loop...
+qry_executor = ThreadPoolExecutor(
+    max_workers=int(env.get_env_var("QRY_EXECUTOR_WORKERS", DEFAULT_QRY_EXECUTOR_WORKERS)),
+    thread_name_prefix="qry",
+)
+qry_batcher = QueryEmbeddingBatcher(
+    get_embedding_function,
+    qry_executor,
+    max_batch_size=int(env.get_env_var("QRY_BATCH_SIZE", DEFAULT_QRY_BATCH_SIZE)),
+    max_wait_seconds=int(env.get_env_var("QRY_BATCH_WAIT_MS", DEFAULT_QRY_BATCH_WAIT_MS)) / 1000,
+)
+query_cache = QueryCache(
+    max_bytes=int(env.get_env_var("QRY_CACHE_MAX_BYTES", DEFAULT_QRY_CACHE_MAX_BYTES)),
+    ttl_seconds=float(env.get_env_var("QRY_CACHE_TTL_SECONDS", DEFAULT_QRY_CACHE_TTL_SECONDS)),
+    version_refresh_seconds=float(
+        env.get_env_var("QRY_CACHE_VERSION_REFRESH_SECONDS", DEFAULT_QRY_CACHE_VERSION_REFRESH_SECONDS)
+    ),
+)
 
 
 repo_dir_path: str = (
@@ -35,15 +88,19 @@ async def rm_repo(repo_name: str) -> Awaitable:
     log(f"{rm_repo.__name__} END.")
 
 
-async def clone_repo(repo_name: str, branch_name: Optional[str] = None) -> Awaitable:
-    log(f"{clone_repo.__name__} START.")
-
+def build_clone_url(repo_name: str) -> str:
     pat = env.get_env_var("PAT")
     if not pat:
         raise ValueError("No PAT found in environment variables.")
 
     organization = env.get_env_var("AZDO_ORGANIZATION") or "your-organization"
-    clone_url = f"https://{pat}@dev.azure.com/{organization}/Software/_git/{repo_name}"
+    return f"https://{pat}@dev.azure.com/{organization}/Software/_git/{repo_name}"
+
+
+async def clone_repo(repo_name: str, branch_name: Optional[str] = None) -> Awaitable:
+    log(f"{clone_repo.__name__} START.")
+
+    clone_url = build_clone_url(repo_name)
     dir_path = repo_dir_path(repo_name)
 
     if branch_name:
@@ -56,6 +113,50 @@ async def clone_repo(repo_name: str, branch_name: Optional[str] = None) -> Await
     log(f"{clone_repo.__name__} END.")
 
 
+async def bump_collection_version(repo_name: str) -> int:
+    """Marks the repo's collection as changed, orphaning /qry results cached against the previous version."""
+
+    actor = create_embedding_actor_proxy(repo_name)
+    metadata = await actor.get_metadata()
+    version = metadata.get("collection_version", 0) + 1
+    metadata["collection_version"] = version
+
+    actor = create_embedding_actor_proxy(repo_name)
+    await actor.set_metadata(metadata)
+
+    query_cache.set_version(repo_name, version)
+
+    return version
+
+
+async def get_collection_version(collection_name: str) -> Optional[int]:
+    async def fetch_version() -> int:
+        actor = create_embedding_actor_proxy(collection_name)
+        metadata = await actor.get_metadata()
+        return metadata.get("collection_version", 0)
+
+    try:
+        return await query_cache.get_version(collection_name, fetch_version)
+    except Exception as e:
+        # without a version there's no telling whether cached documents are stale...
+        logging.warning(f"{get_collection_version.__name__} <SKIPPING> documents cache. err: {e}")
+        return None
+
+
+async def resolve_collection_name(repo_name: str) -> str:
+    """The collection the repo's alias points to, re-read from the embedding actor every few seconds."""
+
+    async def fetch_active_collection() -> str:
+        actor = create_embedding_actor_proxy(repo_name)
+        return get_active_collection_name(await actor.get_metadata(), repo_name)
+
+    try:
+        return await query_cache.get_active_collection(repo_name, fetch_active_collection)
+    except Exception as e:
+        logging.warning(f"{resolve_collection_name.__name__} <FALLING BACK> to the repo collection. err: {e}")
+        return repo_name
+
+
 async def process_clone_cmd(cmd: RootCmd) -> Awaitable:
     log(f"{process_clone_cmd.__name__} START.")
 
@@ -74,9 +175,61 @@ async def process_embed_cmd(cmd: RootCmd) -> Awaitable:
     log(f"{process_embed_cmd.__name__} -> repo_name: {repo_name}, dir_path: {dir_path}")
 
     await embed_file_system(dir_path, repo_name)
+    await bump_collection_version(repo_name)
     log(f"{process_embed_cmd.__name__} END.")
 
 
+async def sync_embed_repo(
+    repo_name: str, branch_name: Optional[str] = None, clone_url: Optional[str] = None
+) -> Awaitable[Dict[str, int]]:
+    """
+    Embeds a repo from a persistent local mirror, only re-embedding the paths changed since the last embedded commit.
+    Falls back to a fresh clone and a full embed when the mirror or the last embedded commit isn't available.
+    """
+
+    log(f"{sync_embed_repo.__name__} START. repo_name: {repo_name}, branch_name: {branch_name}")
+
+    clone_url = clone_url or build_clone_url(repo_name)
+    dir_path = repo_dir_path(repo_name)
+
+    actor = create_embedding_actor_proxy(repo_name)
+    metadata = await actor.get_metadata()
+    last_commit_sha = metadata.get("commit_sha", None)
+
+    # a different branch means a different history, diffing against it is meaningless...
+    if metadata.get("branch_name", None) != branch_name:
+        last_commit_sha = None
+
+    commit_sha = fetch_mirror(clone_url, dir_path, branch_name)
+    changed_paths = (
+        git_changed_paths(dir_path, last_commit_sha, commit_sha)
+        if commit_sha and last_commit_sha
+        else None
+    )
+
+    if changed_paths is not None:
+        changed_file_paths, removed_file_paths = changed_paths
+        embedding_report = await embed_file_system_changes(
+            dir_path, repo_name, changed_file_paths, removed_file_paths
+        )
+    else:
+        if not commit_sha:
+            await rm_repo(repo_name)
+            commit_sha = clone_mirror(clone_url, dir_path, branch_name)
+            if not commit_sha:
+                raise ValueError(f"Unable to clone repo {repo_name}.")
+
+        embedding_report = await embed_file_system(dir_path, repo_name)
+
+    metadata.update({"commit_sha": commit_sha, "branch_name": branch_name})
+    actor = create_embedding_actor_proxy(repo_name)
+    await actor.set_metadata(metadata)
+
+    log(f"{sync_embed_repo.__name__} END. commit_sha: {commit_sha}, {embedding_report}")
+
+    return embedding_report
+
+
 async def process_rm_clone_embed_cmd(cmd: RootCmd) -> Awaitable:
     log(f"{process_rm_clone_embed_cmd.__name__} START.")
 
@@ -88,10 +241,21 @@ async def process_rm_clone_embed_cmd(cmd: RootCmd) -> Awaitable:
         f"{process_rm_clone_embed_cmd.__name__} -> repo_name: {repo_name}, branch_name: {branch_name}, dir_path: {dir_path}"
     )
 
-    await rm_repo(repo_name)
-    await clone_repo(repo_name, branch_name)
-    await embed_file_system(dir_path, repo_name)
-    await rm_repo(repo_name)
+    if env.get_env_var("EMBED_GIT_INCREMENTAL", "false").lower() == "true":
+        await sync_embed_repo(repo_name, branch_name)
+    else:
+        await rm_repo(repo_name)
+        await clone_repo(repo_name, branch_name)
+        if env.get_env_var("EMBED_BLUE_GREEN", "true").lower() == "true":
+            # queries keep reading the current version until the rebuilt one is complete...
+            embedding_report = await rebuild_file_system(dir_path, repo_name)
+            query_cache.set_active_collection(repo_name, embedding_report["active_collection"])
+        else:
+            await embed_file_system(dir_path, repo_name)
+        await rm_repo(repo_name)
+
+    version = await bump_collection_version(repo_name)
+    log(f"{process_rm_clone_embed_cmd.__name__} -> collection_version: {version}")
 
     await publish_event(
         pubsub_name=DaprConfigs.DAPR_PUBSUB_NAME.value,
@@ -102,31 +266,356 @@ async def process_rm_clone_embed_cmd(cmd: RootCmd) -> Awaitable:
     log(f"{process_rm_clone_embed_cmd.__name__} END.")
 
 
-def create_retriever(collection_name: str):
-    vector_store = Chroma(
-        embedding_function=embedding_function,
-        collection_name=collection_name,
-        client=chroma_client,
+def warm_up() -> None:
+    """Loads the embedding model and connects to Chroma ahead of the first request."""
+
+    log(f"{warm_up.__name__} START.")
+    registry.warm_up(embedding_model_key(), create_embedding_function)
+    log(f"{warm_up.__name__} END. {registry.metrics()}")
+
+
+def parse_qry_options(cmd: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reads the optional /qry search parameters: k, score_threshold, mmr (with fetch_k and lambda_mult), hybrid, path_prefixes
+    (or a single path_prefix) and file_exts. Raises ValueError on invalid values.
+
+    hybrid is off unless asked for, per query or with QRY_HYBRID. Every node answering /qry reads the lexical index at
+    EMBED_LEXICAL_INDEX_PATH, so with hybrid on it must sit on storage shared with the nodes that embed. score_threshold
+    applies to the similarity score, lexical hits have none, so a thresholded query is vector only.
+    """
+
+    max_k = int(env.get_env_var("QRY_MAX_K", DEFAULT_QRY_MAX_K))
+
+    k = cmd.get("k", None)
+    k = DEFAULT_QRY_K if k is None else int(k)
+    if k < 1:
+        raise ValueError(f"k must be positive, got {k}.")
+    k = min(k, max_k)
+
+    score_threshold = cmd.get("score_threshold", None)
+    if score_threshold is not None:
+        score_threshold = float(score_threshold)
+
+    mmr = bool(cmd.get("mmr", False))
+    fetch_k = cmd.get("fetch_k", None)
+    fetch_k = k * DEFAULT_QRY_MMR_FETCH_K_FACTOR if fetch_k is None else int(fetch_k)
+    fetch_k = min(max(fetch_k, k), max_k * DEFAULT_QRY_MMR_FETCH_K_FACTOR)
+    lambda_mult = float(cmd.get("lambda_mult", DEFAULT_QRY_MMR_LAMBDA_MULT))
+    if not 0 <= lambda_mult <= 1:
+        raise ValueError(f"lambda_mult must be between 0 and 1, got {lambda_mult}.")
+
+    hybrid = cmd.get("hybrid", None)
+    hybrid = env.get_env_var("QRY_HYBRID", "false").lower() == "true" if hybrid is None else bool(hybrid)
+    # lexical only hits have no similarity to hold against the threshold...
+    hybrid = hybrid and score_threshold is None
+
+    path_prefixes = cmd.get("path_prefixes", None) or []
+    if cmd.get("path_prefix", None):
+        path_prefixes = [*path_prefixes, cmd["path_prefix"]]
+    file_exts = cmd.get("file_exts", None) or []
+
+    if isinstance(path_prefixes, str) or isinstance(file_exts, str):
+        raise ValueError("path_prefixes and file_exts must be lists.")
+
+    return {
+        "k": k,
+        "score_threshold": score_threshold,
+        "mmr": mmr,
+        "fetch_k": fetch_k if mmr else None,
+        "lambda_mult": lambda_mult if mmr else None,
+        "hybrid": hybrid,
+        "path_prefixes": sorted(set(path_prefixes)),
+        "file_exts": sorted(set(file_exts)),
+    }
+
+
+def qry_options_key(qry_options: Dict[str, Any]) -> Hashable:
+    return tuple(
+        (key, tuple(value) if isinstance(value, list) else value)
+        for key, value in sorted(qry_options.items())
     )
-    retriever = vector_store.as_retriever()
-    return retriever
+
+
+def distance_to_score(distance: float, space: str) -> float:
+    """Maps a Chroma distance to a cosine similarity like score, higher is more relevant, for normalized embeddings."""
+
+    if space == "l2":
+        # chroma reports squared l2, which is 2 - 2 * cosine for unit vectors...
+        return 1.0 - distance / 2
+    return 1.0 - distance
+
+
+def fuse_ranked_documents(ranked_documents: List[List[Dict[str, Any]]], k: int, rrf_k: int) -> List[Dict[str, Any]]:
+    """
+    Reciprocal-rank fusion of ranked lists of documents, matched by id. Each document keeps its similarity score, None
+    when only lexically matched, and gets an rrf_score, its fused score as a share of the best possible one, i.e.
+    ranking first in every list.
+    """
+
+    documents_by_id: Dict[str, Dict[str, Any]] = {}
+    scores: Dict[str, float] = {}
+
+    for documents in ranked_documents:
+        for rank, doc in enumerate(documents):
+            documents_by_id.setdefault(doc["id"], doc)
+            scores[doc["id"]] = scores.get(doc["id"], 0.0) + 1.0 / (rrf_k + rank + 1)
+
+    best_score = len(ranked_documents) / (rrf_k + 1)
+    # sorted is stable, ties keep the order of the first list...
+    fused_ids = sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)[:k]
+    return [
+        {"score": None, **documents_by_id[chunk_id], "rrf_score": scores[chunk_id] / best_score} for chunk_id in fused_ids
+    ]
+
+
+def search_lexical_batch(
+    collection_name: str, collection, qrys: List[str], qry_options: Dict[str, Any]
+) -> Optional[List[List[Dict[str, Any]]]]:
+    """
+    Ranks chunks matching each query's identifiers in the lexical index, None when it's disabled. Chunks are read from
+    the collection in one request, ids it no longer holds are dropped.
+    """
+
+    lexical_index = get_lexical_index()
+    if lexical_index is None:
+        return None
+
+    path_prefixes = qry_options["path_prefixes"]
+    file_exts = {normalize_file_ext(ext) for ext in qry_options["file_exts"]}
+
+    def accept(path: Optional[str], ext: Optional[str]) -> bool:
+        return (not file_exts or ext in file_exts) and match_path_prefixes(path, path_prefixes)
+
+    hits = [lexical_index.search(collection_name, qry, qry_options["k"], accept) for qry in qrys]
+
+    chunk_ids = list(dict.fromkeys(chunk_id for qry_hits in hits for chunk_id, _ in qry_hits))
+    if not chunk_ids:
+        return [[] for _ in qrys]
+
+    results = collection.get(ids=chunk_ids, include=["documents", "metadatas"])
+    documents_by_id = {
+        chunk_id: {"id": chunk_id, "source": metadata["source"], "page_content": page_content}
+        for chunk_id, page_content, metadata in zip(results["ids"], results["documents"], results["metadatas"])
+    }
+
+    return [[documents_by_id[chunk_id] for chunk_id, _ in qry_hits if chunk_id in documents_by_id] for qry_hits in hits]
+
+
+def search_collection_batch(
+    collection_name: str,
+    embeddings: List[List[float]],
+    qry_options: Dict[str, Any],
+    qrys: Optional[List[str]] = None,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Queries the collection for every embedding in one request, with the metadata filters pushed into the where clause,
+    returning scored documents per embedding. With hybrid on and the query texts given, the vector results are fused
+    with the lexical index's by reciprocal rank and ordered by rrf_score.
+    """
+
+    k = qry_options["k"]
+    path_prefixes = qry_options["path_prefixes"]
+    n_results = qry_options["fetch_k"] if qry_options["mmr"] else k
+
+    include = ["documents", "metadatas", "distances"]
+    if qry_options["mmr"]:
+        include.append("embeddings")
+
+    collection = create_collection(collection_name)
+    results = collection.query(
+        query_embeddings=embeddings,
+        n_results=n_results,
+        where=create_chunk_where(path_prefixes, qry_options["file_exts"]),
+        include=include,
+    )
+
+    lexical_documents = None
+    if qry_options["hybrid"] and qrys is not None:
+        lexical_documents = search_lexical_batch(collection_name, collection, qrys, qry_options)
+
+    space = (collection.metadata or {}).get("hnsw:space", "l2")
+    # prefixes deeper than the stored ancestor directories only narrowed the query, finish filtering here...
+    filter_path_prefixes = any(path_prefix.count("/") >= CHUNK_METADATA_DIR_DEPTH for path_prefix in path_prefixes)
+    rrf_k = int(env.get_env_var("QRY_RRF_K", DEFAULT_QRY_RRF_K))
+
+    found_documents = []
+    for i, embedding in enumerate(embeddings):
+        documents = [
+            {
+                "id": chunk_id,
+                "source": metadata["source"],
+                "page_content": page_content,
+                "score": distance_to_score(distance, space),
+                "path": metadata.get("path", None),
+            }
+            for chunk_id, page_content, metadata, distance in zip(
+                results["ids"][i], results["documents"][i], results["metadatas"][i], results["distances"][i]
+            )
+        ]
+
+        if qry_options["mmr"] and documents:
+            mmr_indices = maximal_marginal_relevance(
+                np.array(embedding, dtype=np.float32),
+                results["embeddings"][i],
+                lambda_mult=qry_options["lambda_mult"],
+                k=k,
+            )
+            documents = [documents[j] for j in mmr_indices]
+
+        if filter_path_prefixes:
+            documents = [doc for doc in documents if match_path_prefixes(doc["path"], path_prefixes)]
+
+        if qry_options["score_threshold"] is not None:
+            documents = [doc for doc in documents if doc["score"] >= qry_options["score_threshold"]]
+
+        documents = documents[:k]
+        if lexical_documents is not None:
+            documents = fuse_ranked_documents([documents, lexical_documents[i]], k, rrf_k)
+
+        found_documents.append([
+            {
+                "source": doc["source"],
+                "page_content": doc["page_content"],
+                "score": doc["score"],
+                **({"rrf_score": doc["rrf_score"]} if "rrf_score" in doc else {}),
+            }
+            for doc in documents
+        ])
+
+    return found_documents
+
+
+def search_collection(
+    collection_name: str, embedding: List[float], qry_options: Dict[str, Any], qry: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Queries the collection with the metadata filters pushed into the where clause, returning scored documents."""
+
+    return search_collection_batch(collection_name, [embedding], qry_options, None if qry is None else [qry])[0]
+
+
+async def embed_qry(model_key: str, qry: str) -> List[float]:
+    embedding = query_cache.get_embedding(model_key, qry)
+    if embedding is None:
+        embedding = await qry_batcher.embed_query(qry)
+        query_cache.put_embedding(model_key, qry, embedding)
+    return embedding
+
+
+async def retrieve_documents(qry_cmds: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Answers several queries at once: misses are embedded in one model batch, and queries against the same collection
+    with the same options share one Chroma request. Returns the documents of each query, in order.
+    """
+
+    qry_options_list = [parse_qry_options(qry_cmd) for qry_cmd in qry_cmds]
+
+    model_key = embedding_model_key()
+    # concurrent misses land in the same batcher flush, i.e. one embed_documents call...
+    embeddings = await asyncio.gather(*(embed_qry(model_key, qry_cmd["qry"]) for qry_cmd in qry_cmds))
+
+    repo_names = list(dict.fromkeys(qry_cmd["file_system_name"] for qry_cmd in qry_cmds))
+    # a repo's documents live in whichever version of its collection the alias points to...
+    collection_names = dict(zip(
+        repo_names,
+        await asyncio.gather(*(resolve_collection_name(name) for name in repo_names)),
+    ))
+    versions = dict(zip(
+        [collection_names[name] for name in repo_names],
+        await asyncio.gather(*(get_collection_version(name) for name in repo_names)),
+    ))
+
+    found_documents: List[Optional[List[Dict[str, Any]]]] = [None] * len(qry_cmds)
+    groups: Dict[Hashable, List[int]] = {}
+
+    for i, (qry_cmd, qry_options) in enumerate(zip(qry_cmds, qry_options_list)):
+        collection_name = collection_names[qry_cmd["file_system_name"]]
+        options_key = qry_options_key(qry_options)
+        version = versions[collection_name]
+        if version is not None:
+            found_documents[i] = query_cache.get_documents(collection_name, version, embeddings[i], options_key)
+        if found_documents[i] is None:
+            groups.setdefault((collection_name, options_key), []).append(i)
+
+    loop = asyncio.get_running_loop()
+
+    async def search_group(collection_name: str, options_key: Hashable, indices: List[int]) -> None:
+        group_documents = await loop.run_in_executor(
+            qry_executor,
+            search_collection_batch,
+            collection_name,
+            [embeddings[i] for i in indices],
+            qry_options_list[indices[0]],
+            [qry_cmds[i]["qry"] for i in indices],
+        )
+        version = versions[collection_name]
+        for i, documents in zip(indices, group_documents):
+            found_documents[i] = documents
+            if version is not None:
+                query_cache.put_documents(collection_name, version, embeddings[i], options_key, documents)
+
+    await asyncio.gather(*(
+        search_group(collection_name, options_key, indices)
+        for (collection_name, options_key), indices in groups.items()
+    ))
+
+    return found_documents
 
 
 async def process_qry_cmd(cmd: Dict[str, Any]) -> Awaitable:
     log(f"{process_qry_cmd.__name__} START.")
 
-    qry = cmd["qry"]
-    file_system_name = cmd["file_system_name"]
+    started = time.perf_counter()
 
-    retriever = create_retriever(file_system_name)
-    documents = retriever.invoke(qry)
-    resp = {
-        "documents": [
-            {"source": doc.metadata["source"], "page_content": doc.page_content}
-            for doc in documents
-        ]
-    }
+    documents = (await retrieve_documents([cmd]))[0]
+    resp = {"documents": documents}
+
+    registry.record_request(time.perf_counter() - started)
 
     log(f"{process_qry_cmd.__name__} END.")
 
     return resp
+
+
+def parse_qry_batch_cmd(cmd: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Expands a /qry/batch command into /qry commands. Each entry of "qrys" is a query string or a /qry command, keys
+    missing from an entry, e.g. file_system_name, k or filters, are taken from the batch command itself.
+    Raises ValueError on invalid commands.
+    """
+
+    qrys = cmd.get("qrys", None)
+    if not isinstance(qrys, list) or not qrys:
+        raise ValueError("qrys must be a non-empty list.")
+
+    max_batch_size = int(env.get_env_var("QRY_MAX_BATCH_SIZE", DEFAULT_QRY_MAX_BATCH_SIZE))
+    if len(qrys) > max_batch_size:
+        raise ValueError(f"At most {max_batch_size} qrys per batch, got {len(qrys)}.")
+
+    defaults = {key: value for key, value in cmd.items() if key != "qrys"}
+    qry_cmds = [
+        {**defaults, **(qry if isinstance(qry, dict) else {"qry": qry})}
+        for qry in qrys
+    ]
+
+    for qry_cmd in qry_cmds:
+        if not qry_cmd.get("qry", None) or not qry_cmd.get("file_system_name", None):
+            raise ValueError("Every qry needs a qry and a file_system_name.")
+        parse_qry_options(qry_cmd)
+
+    return qry_cmds
+
+
+async def process_qry_batch_cmd(cmd: Dict[str, Any]) -> Awaitable:
+    log(f"{process_qry_batch_cmd.__name__} START.")
+
+    started = time.perf_counter()
+
+    qry_cmds = parse_qry_batch_cmd(cmd)
+    found_documents = await retrieve_documents(qry_cmds)
+    resp = {"results": [{"documents": documents} for documents in found_documents]}
+
+    registry.record_request(time.perf_counter() - started)
+
+    log(f"{process_qry_batch_cmd.__name__} END. qrys: {len(qry_cmds)}")
+
+    return resp
@@ -0,0 +1,161 @@
+import time
+import hashlib
+from array import array
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+DEFAULT_QRY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_QRY_CACHE_TTL_SECONDS = 600
+DEFAULT_QRY_CACHE_VERSION_REFRESH_SECONDS = 5
+
+# rough per-entry bookkeeping cost on top of the payload...
+ENTRY_OVERHEAD_BYTES = 128
+
+
+class TtlLruCache:
+    """
+    LRU cache whose entries expire after ttl_seconds, evicting least recently used entries past max_bytes.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, _, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, size_bytes: int) -> None:
+        size_bytes += ENTRY_OVERHEAD_BYTES
+        if size_bytes > self._max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (time.monotonic() + self._ttl_seconds, size_bytes, value)
+        self._size_bytes += size_bytes
+
+        while self._size_bytes > self._max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        _, size_bytes, _ = self._entries.pop(key)
+        self._size_bytes -= size_bytes
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._size_bytes,
+        }
+
+
+def hash_embedding(embedding: List[float]) -> str:
+    return hashlib.sha256(array("f", embedding).tobytes()).hexdigest()
+
+
+class QueryCache:
+    """
+    Two-layer /qry cache: query text -> query embedding, and (collection, version, embedding, options) -> documents.
+
+    Documents are keyed by the collection version, bumping it when a repo is re-embedded orphans every cached result.
+    The collection a repo's alias points to is cached the same way, refreshed from the embedding actor.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_QRY_CACHE_MAX_BYTES,
+        ttl_seconds: float = DEFAULT_QRY_CACHE_TTL_SECONDS,
+        version_refresh_seconds: float = DEFAULT_QRY_CACHE_VERSION_REFRESH_SECONDS,
+    ):
+        """
+        :param max_bytes: Memory budget, split evenly between the two layers.
+        :param ttl_seconds: Lifetime of an entry in either layer.
+        :param version_refresh_seconds: How long a collection version, or alias, read from the embedding actor is trusted.
+        """
+
+        self._embeddings = TtlLruCache(max_bytes // 2, ttl_seconds)
+        self._documents = TtlLruCache(max_bytes // 2, ttl_seconds)
+        self._version_refresh_seconds = version_refresh_seconds
+        self._versions: Dict[str, Tuple[float, int]] = {}
+        self._active_collections: Dict[str, Tuple[float, str]] = {}
+
+    def get_embedding(self, model_key: str, qry: str) -> Optional[List[float]]:
+        vector = self._embeddings.get((model_key, qry))
+        return vector.tolist() if vector is not None else None
+
+    def put_embedding(self, model_key: str, qry: str, embedding: List[float]) -> None:
+        # float32, as produced by the model, at a fraction of the size of a list of floats...
+        vector = array("f", embedding)
+        self._embeddings.put((model_key, qry), vector, len(qry) + vector.itemsize * len(vector))
+
+    def get_documents(
+        self, collection_name: str, version: int, embedding: List[float], options: Hashable
+    ) -> Optional[List[Dict[str, Any]]]:
+        return self._documents.get((collection_name, version, hash_embedding(embedding), options))
+
+    def put_documents(
+        self, collection_name: str, version: int, embedding: List[float], options: Hashable, documents: List[Dict[str, Any]]
+    ) -> None:
+        size_bytes = sum(len(str(value)) for doc in documents for value in doc.values())
+        self._documents.put((collection_name, version, hash_embedding(embedding), options), documents, size_bytes)
+
+    async def _get_refreshed(self, entries: Dict[str, Tuple[float, Any]], key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        fetched_at, value = entries.get(key, (None, None))
+        if fetched_at is not None and time.monotonic() - fetched_at < self._version_refresh_seconds:
+            return value
+
+        value = await fetch()
+        entries[key] = (time.monotonic(), value)
+        return value
+
+    async def get_version(self, collection_name: str, fetch_version: Callable[[], Awaitable[int]]) -> int:
+        """Returns the collection version, re-reading it through fetch_version once the local copy is older than the refresh interval."""
+
+        return await self._get_refreshed(self._versions, collection_name, fetch_version)
+
+    def set_version(self, collection_name: str, version: int) -> None:
+        self._versions[collection_name] = (time.monotonic(), version)
+
+    async def get_active_collection(self, repo_name: str, fetch_active_collection: Callable[[], Awaitable[str]]) -> str:
+        """
+        Returns the collection the repo's alias points to, re-reading it like versions. When re-reading fails the last
+        known collection is kept, an old version stays queryable for a while after a swap.
+        """
+
+        try:
+            return await self._get_refreshed(self._active_collections, repo_name, fetch_active_collection)
+        except Exception:
+            _, active_collection = self._active_collections.get(repo_name, (None, None))
+            if active_collection is None:
+                raise
+            return active_collection
+
+    def set_active_collection(self, repo_name: str, collection_name: str) -> None:
+        self._active_collections[repo_name] = (time.monotonic(), collection_name)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"embeddings": self._embeddings.stats(), "documents": self._documents.stats()}
@@ -0,0 +1,183 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+from chromadb import Collection
+from chromadb.api import ClientAPI
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from agntsmth_core.core.utls import ChromaHttpClientFactory, EnvVarProvider, log
+from .local_store import (
+    LocalVectorStoreClient,
+    DEFAULT_LOCAL_STORE_DIR,
+    DEFAULT_LOCAL_MAX_LOADED_COLLECTIONS,
+    DEFAULT_LOCAL_EXACT_MAX_VECTORS,
+    DEFAULT_LOCAL_PERSIST_SECONDS,
+)
+
+
+DEFAULT_COLLECTION_CACHE_SIZE = 64
+DEFAULT_VECTOR_STORE = "chroma"
+
+env = EnvVarProvider()
+
+
+class Registry:
+    """
+    Process-wide owner of embedding models, keyed by model name, the pooled Chroma client and an LRU of collection handles.
+    """
+
+    def __init__(
+        self,
+        collection_cache_size: int = DEFAULT_COLLECTION_CACHE_SIZE,
+        chroma_client_factory: Callable[[], ClientAPI] = ChromaHttpClientFactory.create_with_auth,
+    ):
+        self._lock = threading.RLock()
+        self._models: Dict[str, Embeddings] = {}
+        self._chroma_client: Optional[ClientAPI] = None
+        self._collections: "OrderedDict[str, Collection]" = OrderedDict()
+        self._vector_stores: "OrderedDict[str, Chroma]" = OrderedDict()
+        self._collection_cache_size = collection_cache_size
+        self._chroma_client_factory = chroma_client_factory
+        self._metrics: Dict[str, Any] = {
+            "created_at": time.time(),
+            "model_load_seconds": {},
+            "chroma_connect_seconds": None,
+            "warm_up_seconds": None,
+            "startup_seconds": None,
+            "first_request_seconds": None,
+            "collection_hits": 0,
+            "collection_misses": 0,
+        }
+
+    def get_model(self, name: str, factory: Callable[[], Embeddings]) -> Embeddings:
+        """Returns the model registered under name, loading it with factory on first use."""
+
+        with self._lock:
+            model = self._models.get(name, None)
+            if model is None:
+                started = time.perf_counter()
+                model = factory()
+                self._models[name] = model
+                self._metrics["model_load_seconds"][name] = time.perf_counter() - started
+                log(f"{self.get_model.__name__} -> loaded: {name}, seconds: {self._metrics['model_load_seconds'][name]:.3f}")
+            return model
+
+    def get_chroma_client(self) -> ClientAPI:
+        with self._lock:
+            if self._chroma_client is None:
+                started = time.perf_counter()
+                self._chroma_client = self._chroma_client_factory()
+                self._metrics["chroma_connect_seconds"] = time.perf_counter() - started
+            return self._chroma_client
+
+    def _get_cached(self, cache: OrderedDict, key: str) -> Any:
+        value = cache.get(key, None)
+        if value is None:
+            self._metrics["collection_misses"] += 1
+            return None
+
+        cache.move_to_end(key)
+        self._metrics["collection_hits"] += 1
+        return value
+
+    def _put_cached(self, cache: OrderedDict, key: str, value: Any) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self._collection_cache_size:
+            cache.popitem(last=False)
+
+    def get_collection(self, collection_name: str) -> Collection:
+        """Returns a cached handle to the collection, creating the collection if it doesn't exist."""
+
+        with self._lock:
+            collection = self._get_cached(self._collections, collection_name)
+            if collection is None:
+                # no collection-side embedding function, vectors are always computed by the caller...
+                collection = self.get_chroma_client().get_or_create_collection(
+                    name=collection_name, embedding_function=None
+                )
+                self._put_cached(self._collections, collection_name, collection)
+            return collection
+
+    def get_vector_store(self, collection_name: str, embedding_function: Embeddings) -> Chroma:
+        """Returns a cached vector store over the collection, querying with embedding_function."""
+
+        with self._lock:
+            vector_store = self._get_cached(self._vector_stores, collection_name)
+            if vector_store is None or vector_store.embeddings is not embedding_function:
+                vector_store = Chroma(
+                    embedding_function=embedding_function,
+                    client=self.get_chroma_client(),
+                    collection_name=collection_name,
+                )
+                self._put_cached(self._vector_stores, collection_name, vector_store)
+            return vector_store
+
+    def evict_collection(self, collection_name: str) -> None:
+        """Drops the cached handles, e.g. after the collection was deleted or recreated."""
+
+        with self._lock:
+            self._collections.pop(collection_name, None)
+            self._vector_stores.pop(collection_name, None)
+
+    def warm_up(self, model_name: str, factory: Callable[[], Embeddings]) -> None:
+        """Loads the model, runs one query through it and connects to Chroma, so the first request doesn't pay for it."""
+
+        started = time.perf_counter()
+
+        self.get_model(model_name, factory).embed_query("warm up")
+        self.get_chroma_client().heartbeat()
+
+        self._metrics["warm_up_seconds"] = time.perf_counter() - started
+        self._metrics["startup_seconds"] = time.time() - self._metrics["created_at"]
+
+    def record_request(self, seconds: float) -> None:
+        with self._lock:
+            if self._metrics["first_request_seconds"] is None:
+                self._metrics["first_request_seconds"] = seconds
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._metrics,
+                "model_load_seconds": dict(self._metrics["model_load_seconds"]),
+                "models": list(self._models),
+                "collections": len(self._collections),
+                "vector_stores": len(self._vector_stores),
+            }
+
+
+def vector_store_backend() -> str:
+    return env.get_env_var("EMBED_VECTOR_STORE", DEFAULT_VECTOR_STORE).lower()
+
+
+def create_vector_store_client() -> ClientAPI:
+    """
+    The Chroma HTTP client, or with EMBED_VECTOR_STORE "local" an in-process store behind the same collection API,
+    e.g. for small and medium repos where a round trip to Chroma costs more than the search itself.
+    """
+
+    backend = vector_store_backend()
+    log(f"{create_vector_store_client.__name__} -> backend: {backend}")
+
+    if backend == "local":
+        return LocalVectorStoreClient(
+            env.get_env_var("EMBED_LOCAL_STORE_DIR", DEFAULT_LOCAL_STORE_DIR),
+            max_loaded_collections=int(
+                env.get_env_var("EMBED_LOCAL_MAX_LOADED_COLLECTIONS", DEFAULT_LOCAL_MAX_LOADED_COLLECTIONS)
+            ),
+            exact_max_vectors=int(env.get_env_var("EMBED_LOCAL_EXACT_MAX_VECTORS", DEFAULT_LOCAL_EXACT_MAX_VECTORS)),
+            persist_seconds=float(env.get_env_var("EMBED_LOCAL_PERSIST_SECONDS", DEFAULT_LOCAL_PERSIST_SECONDS)),
+        )
+
+    if backend != "chroma":
+        raise ValueError(f"Unknown vector store: {backend}.")
+
+    return ChromaHttpClientFactory.create_with_auth()
+
+
+registry = Registry(
+    collection_cache_size=int(env.get_env_var("EMBED_COLLECTION_CACHE_SIZE", DEFAULT_COLLECTION_CACHE_SIZE)),
+    chroma_client_factory=create_vector_store_client,
+)
@@ -0,0 +1,208 @@
+import time
+import random
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from json import dumps as json_dumps
+from typing import List, Optional
+from chromadb import Collection
+from langchain_core.documents import Document
+from agntsmth_core.core.utls import EnvVarProvider
+
+
+DEFAULT_UPSERT_BATCH_SIZE = 1024
+DEFAULT_UPSERT_BATCH_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_UPSERT_MAX_IN_FLIGHT = 2
+DEFAULT_UPSERT_RETRIES = 3
+DEFAULT_UPSERT_BACKOFF_SECONDS = 0.5
+DEFAULT_UPSERT_MAX_BACKOFF_SECONDS = 8
+# a float serialized in the json request body, e.g. -0.012345678901234567...
+EMBEDDING_VALUE_BYTES = 22
+
+env = EnvVarProvider()
+
+
+def get_max_batch_size(collection: Collection) -> Optional[int]:
+    """Chroma's limit on records per request, or None when the client doesn't report one."""
+
+    get_max = getattr(getattr(collection, "_client", None), "get_max_batch_size", None)
+    if get_max is None:
+        return None
+
+    try:
+        return int(get_max())
+    except Exception as e:
+        logging.warning(f"{get_max_batch_size.__name__} <SKIPPING>, err: {e}")
+        return None
+
+
+def estimate_record_bytes(chunk_id: str, embedding: List[float], document: Document) -> int:
+    return (
+        len(chunk_id)
+        + len(embedding) * EMBEDDING_VALUE_BYTES
+        + len(document.page_content.encode("utf-8"))
+        + len(json_dumps(document.metadata))
+    )
+
+
+class UpsertBuffer:
+    """
+    Write-behind buffer of embedded chunks. Records from any number of files are accumulated and upserted in batches
+    bounded by record count and request bytes, a few requests in flight while the caller keeps embedding. Chunk ids
+    are deterministic, so a failed batch is simply upserted again.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        batch_size: int = DEFAULT_UPSERT_BATCH_SIZE,
+        max_batch_bytes: int = DEFAULT_UPSERT_BATCH_MAX_BYTES,
+        max_in_flight: int = DEFAULT_UPSERT_MAX_IN_FLIGHT,
+        retries: int = DEFAULT_UPSERT_RETRIES,
+        backoff_seconds: float = DEFAULT_UPSERT_BACKOFF_SECONDS,
+        max_backoff_seconds: float = DEFAULT_UPSERT_MAX_BACKOFF_SECONDS,
+    ):
+        """
+        :param collection: Collection the records are upserted into.
+        :param batch_size: Records per request, capped by the client's max batch size.
+        :param max_batch_bytes: Estimated request body bytes per request, a single larger record is sent alone.
+        :param max_in_flight: Requests sent concurrently, adding records blocks while this many are pending.
+        :param retries: Attempts after the first one of a failed request.
+        :param backoff_seconds: Base of the exponential backoff, each wait is drawn uniformly up to it.
+        """
+
+        max_batch_size = get_max_batch_size(collection)
+
+        self._collection = collection
+        self._batch_size = max(1, min(batch_size, max_batch_size) if max_batch_size else batch_size)
+        self._max_batch_bytes = max_batch_bytes
+        self._retries = retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+
+        self._ids: List[str] = []
+        self._embeddings: List[List[float]] = []
+        self._documents: List[Document] = []
+        self._bytes = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix="upsert")
+        self._in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._futures: List[Future] = []
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._upserted_count = 0
+        self._request_count = 0
+
+    @property
+    def upserted_count(self) -> int:
+        with self._lock:
+            return self._upserted_count
+
+    @property
+    def request_count(self) -> int:
+        with self._lock:
+            return self._request_count
+
+    def _raise_error(self) -> None:
+        with self._lock:
+            error = self._error
+        if error is not None:
+            raise error
+
+    def add(self, ids: List[str], embeddings: List[List[float]], documents: List[Document]) -> None:
+        """Buffers embedded chunks, sending full batches, and raises the error of an earlier batch that gave up."""
+
+        self._raise_error()
+
+        for chunk_id, embedding, document in zip(ids, embeddings, documents):
+            record_bytes = estimate_record_bytes(chunk_id, embedding, document)
+            if self._ids and self._bytes + record_bytes > self._max_batch_bytes:
+                self.flush()
+
+            self._ids.append(chunk_id)
+            self._embeddings.append(embedding)
+            self._documents.append(document)
+            self._bytes += record_bytes
+
+            if len(self._ids) >= self._batch_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """Sends the buffered records, waiting for a free request slot first."""
+
+        if not self._ids:
+            return
+
+        batch = (self._ids, self._embeddings, self._documents)
+        self._ids, self._embeddings, self._documents, self._bytes = [], [], [], 0
+
+        self._in_flight.acquire()
+        try:
+            future = self._executor.submit(self._upsert, *batch)
+        except BaseException:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self._in_flight.release())
+        self._futures = [f for f in self._futures if not f.done()] + [future]
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter, so concurrent batches don't retry in lockstep...
+        return random.uniform(0, min(self._max_backoff_seconds, self._backoff_seconds * 2 ** attempt))
+
+    def _upsert(self, ids: List[str], embeddings: List[List[float]], documents: List[Document]) -> None:
+        for attempt in range(self._retries + 1):
+            try:
+                self._collection.upsert(
+                    ids=ids,
+                    embeddings=embeddings,
+                    documents=[doc.page_content for doc in documents],
+                    metadatas=[doc.metadata for doc in documents],
+                )
+                break
+            except Exception as e:
+                if attempt == self._retries:
+                    with self._lock:
+                        self._error = self._error or e
+                    raise
+
+                logging.warning(f"{self._upsert.__name__} <RETRYING> records: {len(ids)}, attempt: {attempt + 1}, err: {e}")
+                time.sleep(self._backoff(attempt))
+
+        with self._lock:
+            self._upserted_count += len(ids)
+            self._request_count += 1
+
+    def close(self) -> int:
+        """Sends what's left, waits for every request and returns the number of records upserted."""
+
+        try:
+            self._raise_error()
+            self.flush()
+            for future in self._futures:
+                future.exception()
+            self._raise_error()
+        finally:
+            self._executor.shutdown(wait=True)
+
+        return self.upserted_count
+
+    def __enter__(self) -> "UpsertBuffer":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # the caller failed, don't send a partial batch, only let pending requests settle...
+            self._executor.shutdown(wait=True)
+
+
+def create_upsert_buffer(collection: Collection) -> UpsertBuffer:
+    return UpsertBuffer(
+        collection,
+        batch_size=int(env.get_env_var("EMBED_UPSERT_BATCH_SIZE", DEFAULT_UPSERT_BATCH_SIZE)),
+        max_batch_bytes=int(env.get_env_var("EMBED_UPSERT_BATCH_MAX_BYTES", DEFAULT_UPSERT_BATCH_MAX_BYTES)),
+        max_in_flight=int(env.get_env_var("EMBED_UPSERT_MAX_IN_FLIGHT", DEFAULT_UPSERT_MAX_IN_FLIGHT)),
+        retries=int(env.get_env_var("EMBED_UPSERT_RETRIES", DEFAULT_UPSERT_RETRIES)),
+        backoff_seconds=float(env.get_env_var("EMBED_UPSERT_BACKOFF_SECONDS", DEFAULT_UPSERT_BACKOFF_SECONDS)),
+    )
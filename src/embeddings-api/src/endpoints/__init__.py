@@ -1,9 +1,10 @@
 from fastapi import APIRouter
 
-from . import healthz
+from . import healthz, metrics
 
 router = APIRouter()
 
 router.include_router(healthz.router)
+router.include_router(metrics.router)
 
 __all__ = ["router"]
\ No newline at end of file
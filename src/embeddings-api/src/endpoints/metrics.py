@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from core import registry, query_cache
+
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def metrics():
+    return JSONResponse(content={**registry.metrics(), "qry_cache": query_cache.stats()})
@@ -1,11 +1,13 @@
+import asyncio
 import logging
 from json import dumps as json_dumps
 
 from fastapi import FastAPI, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from lxi_framework import RootQry
-from core import process_qry
+from core import process_qry, stream_qry, get_graph, get_conversation_graph, get_token_counter
 from endpoints import healthz
 
 
@@ -23,10 +25,35 @@ app.add_middleware(
 app.include_router(healthz.router)
 
 
+@app.on_event("startup")
+async def startup_event():
+    logging.info("Compiling agent graph...")
+    try:
+        await asyncio.to_thread(get_graph)
+        await asyncio.to_thread(get_conversation_graph)
+        # loading the encoding may download it, not on the first request's event loop...
+        await asyncio.to_thread(get_token_counter)
+    except Exception as e:
+        # not fatal, the first request builds it...
+        logging.warning(f"startup_event <SKIPPING> graph compile. err: {e}")
+
+
 @app.post("/qry")
 async def handle_qry(qry: RootQry):
     logging.info(f"{handle_qry.__name__} START.")
     output = await process_qry(qry)
     logging.info(f"{handle_qry.__name__} END.")
-    resp = json_dumps({"output": output})
+    resp = json_dumps(output)
     return Response(content=resp, status_code=status.HTTP_200_OK)
+
+
+@app.post("/qry/stream")
+async def handle_qry_stream(qry: RootQry):
+    logging.info(f"{handle_qry_stream.__name__} START.")
+
+    async def iter_ndjson():
+        async for event in stream_qry(qry):
+            yield json_dumps(event) + "\n"
+        logging.info(f"{handle_qry_stream.__name__} END.")
+
+    return StreamingResponse(iter_ndjson(), media_type="application/x-ndjson")
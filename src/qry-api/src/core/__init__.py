@@ -1,4 +1,7 @@
 from .agent import *
 from .procs import *
+from .http_client import *
 from .retrievers import *
+from .conversations import *
+from .compaction import *
 from .maps import *
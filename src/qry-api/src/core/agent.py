@@ -1,24 +1,39 @@
+import asyncio
 import functools
 import operator
 import logging
-from typing import TypedDict, Sequence, Annotated
+from collections import OrderedDict
+from typing import Optional, TypedDict, Sequence, Annotated
 
 from langchain_core.messages import BaseMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import Tool
 
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import START, END, StateGraph
 
 from agntsmth_core.core.utls import (
     ModelFactory,
     EnvVarProvider,
+    log,
 )
 from agntsmth_core.core.tools import RetrieveAdditionalContextTool
 
 from .retrievers import RemoteEmbeddingRetriever
+from .conversations import create_checkpointer
+from .compaction import DEFAULT_TOOL_RESULT_MAX_TOKENS, compact_tool_messages
 
 
+DEFAULT_QRY_K = 4
+DEFAULT_TOOL_CONCURRENCY = 4
+DEFAULT_TOOL_TIMEOUT_SECONDS = 30
+DEFAULT_REPO_TOOLS_CACHE_SIZE = 64
+
 env = EnvVarProvider()
 
+# per-repo tools, keyed by repo name, least recently used first...
+_repo_tools: "OrderedDict[str, dict]" = OrderedDict()
+
 
 class GraphState(TypedDict):
     message_history: Annotated[Sequence[BaseMessage], operator.add]
@@ -39,68 +54,189 @@ def should_invoke_tools(state: GraphState):
     return "continue"
 
 
-def invoke_tools(state: GraphState, tools):
-    logging.info(f"{invoke_tools.__name__} START.")
+async def batch_retrieval_tool_calls(tool_calls, tools_by_name: dict, timeout_seconds: float) -> dict:
+    """
+    Answers all calls to a retrieval tool whose retriever supports batches with one request, keyed by tool_call_id.
+    Calls left out, e.g. when the batch fails, are invoked one by one.
+    """
 
-    message_history = state["message_history"]
-    last_message = message_history[-1]
+    responses = {}
+
+    for tool in tools_by_name.values():
+        retriever = getattr(tool, "retriever", None)
+        if not hasattr(retriever, "aget_relevant_documents_batch"):
+            continue
+
+        retrieval_tool_calls = [
+            tool_call for tool_call in tool_calls
+            if tool_call.get("name", None) == tool.name and "query" in tool_call.get("args", {})
+        ]
+        if len(retrieval_tool_calls) < 2:
+            continue
 
-    tool_messages = []
-    for tool_call in last_message.tool_calls:
         try:
-            tool_name = tool_call["name"]
-            tool_args = tool_call["args"]
-
-            for tool in tools:
-                if tool.name == tool_name:
-                    response = tool.invoke(tool_args)
-                    break
-            else:
-                response = f"Tool {tool_name} not found"
-
-            tool_messages.append(
-                ToolMessage(
-                    content=str(response),
-                    name=tool_call["name"],
-                    tool_call_id=tool_call["id"],
-                )
+            batch = await asyncio.wait_for(
+                retriever.aget_relevant_documents_batch(
+                    [tool_call["args"]["query"] for tool_call in retrieval_tool_calls]
+                ),
+                timeout_seconds,
             )
         except Exception as e:
-            tool_messages.append(
-                ToolMessage(
-                    content=f"Error: {str(e)}",
-                    name=tool_call.get("name", "unknown"),
-                    tool_call_id=tool_call.get("id", "unknown"),
+            logging.warning(f"{batch_retrieval_tool_calls.__name__} <SKIPPING> batch, tool: {tool.name}, err: {e!r}")
+            continue
+
+        responses.update({tool_call["id"]: documents for tool_call, documents in zip(retrieval_tool_calls, batch)})
+
+    return responses
+
+
+async def invoke_tool_call(
+    tool_call, tools_by_name: dict, semaphore: asyncio.Semaphore, timeout_seconds: float
+) -> ToolMessage:
+    tool_name = tool_call.get("name", "unknown")
+    tool = tools_by_name.get(tool_name, None)
+
+    artifact = None
+
+    if tool is None:
+        content = f"Tool {tool_name} not found"
+    else:
+        try:
+            async with semaphore:
+                # tools are sync underneath their async facade, run them on threads so calls actually overlap...
+                response = await asyncio.wait_for(
+                    asyncio.to_thread(tool.invoke, tool_call["args"]), timeout_seconds
                 )
+            content = str(response)
+            artifact = response
+        except asyncio.TimeoutError:
+            content = f"Error: {tool_name} timed out after {timeout_seconds}s"
+        except Exception as e:
+            content = f"Error: {str(e)}"
+
+    # the raw response rides along as the artifact, e.g. for streaming document summaries...
+    return ToolMessage(content=content, name=tool_name, tool_call_id=tool_call.get("id", "unknown"), artifact=artifact)
+
+
+async def invoke_tools(
+    state: GraphState,
+    tools_by_name: dict,
+    max_concurrency: int = DEFAULT_TOOL_CONCURRENCY,
+    timeout_seconds: float = DEFAULT_TOOL_TIMEOUT_SECONDS,
+    max_result_tokens: int = DEFAULT_TOOL_RESULT_MAX_TOKENS,
+):
+    logging.info(f"{invoke_tools.__name__} START.")
+
+    message_history = state["message_history"]
+    last_message = message_history[-1]
+    tool_calls = last_message.tool_calls
+
+    # several retrieval calls in one turn cost one round trip to the embeddings-api...
+    batched_responses = await batch_retrieval_tool_calls(tool_calls, tools_by_name, timeout_seconds)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def invoke(tool_call) -> ToolMessage:
+        if tool_call.get("id", None) in batched_responses:
+            return ToolMessage(
+                content=str(batched_responses[tool_call["id"]]),
+                name=tool_call["name"],
+                tool_call_id=tool_call["id"],
+                artifact=batched_responses[tool_call["id"]],
             )
+        return await invoke_tool_call(tool_call, tools_by_name, semaphore, timeout_seconds)
+
+    # gather keeps the order of tool_calls, whatever order the calls finish in...
+    tool_messages = await asyncio.gather(*(invoke(tool_call) for tool_call in tool_calls))
 
-    logging.info(f"{invoke_tools.__name__} END.")
+    # retrieved chunks are deduped against the conversation, merged and trimmed before the LLM sees them...
+    tool_messages = compact_tool_messages(list(tool_messages), message_history, max_result_tokens)
+
+    logging.info(f"{invoke_tools.__name__} END. tool_calls: {len(tool_calls)}")
     return {"message_history": tool_messages}
 
 
-def invoke_agent(llm, state, format_response_fn=lambda r: r):
+async def invoke_agent(llm, state, format_response_fn=lambda r: r):
     message_history = state["message_history"]
-    response = llm.invoke(message_history)
+    response = await llm.ainvoke(message_history)
     return {"message_history": [format_response_fn(response)]}
 
 
+def create_search_kwargs() -> dict:
+    """/qry search parameters for the agent's retriever, fewer and more relevant chunks keep tool results small."""
+
+    search_kwargs = {
+        "k": int(env.get_env_var("QRY_K", DEFAULT_QRY_K)),
+        "mmr": env.get_env_var("QRY_MMR", "false").lower() == "true",
+    }
+
+    score_threshold = env.get_env_var("QRY_SCORE_THRESHOLD", None)
+    if score_threshold:
+        search_kwargs["score_threshold"] = float(score_threshold)
+
+    return search_kwargs
+
+
 def build_tools(repo_name: str) -> list[Tool]:
     host = env.get_env_var("EMBEDDINGS_API_HOST")
-    retriever = RemoteEmbeddingRetriever(host, repo_name)
+    retriever = RemoteEmbeddingRetriever(host, repo_name, search_kwargs=create_search_kwargs())
     context_retriever_tool = RetrieveAdditionalContextTool(retriever)
     return [context_retriever_tool]
 
 
-def build_graph(repo_name: str):
-    tools = build_tools(repo_name)
+def get_repo_tools(repo_name: str) -> dict:
+    """Returns the repo's tools by name, from a bounded LRU so per-repo retrievers aren't rebuilt every turn."""
+
+    tools_by_name = _repo_tools.get(repo_name, None)
+    if tools_by_name is None:
+        tools_by_name = {tool.name: tool for tool in build_tools(repo_name)}
+        _repo_tools[repo_name] = tools_by_name
+
+    _repo_tools.move_to_end(repo_name)
+    while len(_repo_tools) > int(env.get_env_var("QRY_REPO_TOOLS_CACHE_SIZE", DEFAULT_REPO_TOOLS_CACHE_SIZE)):
+        _repo_tools.popitem(last=False)
+
+    return tools_by_name
+
+
+def create_graph_config(repo_name: str, conversation_id: Optional[str] = None) -> dict:
+    """Runtime config carrying the repo a run of the shared graph works on and, if any, its conversation."""
+
+    configurable = {"repo_name": repo_name}
+    if conversation_id is not None:
+        configurable["thread_id"] = conversation_id
+
+    return {"configurable": configurable}
 
-    llm = ModelFactory.create(tools=tools)
-    invoke_llm_fn = lambda state: invoke_agent(llm, state)
+
+async def invoke_repo_tools(state: GraphState, config: RunnableConfig, **kwargs):
+    repo_name = config["configurable"]["repo_name"]
+    return await invoke_tools(state, get_repo_tools(repo_name), **kwargs)
+
+
+@functools.lru_cache(maxsize=1)
+def get_llm():
+    """Returns the process-wide LLM client, shared by every compiled graph."""
+
+    # binding only needs the tool schemas, the repo's own tools are resolved per run from the config...
+    return ModelFactory.create(tools=build_tools(""))
+
+
+def build_graph(checkpointer: Optional[BaseCheckpointSaver] = None):
+    invoke_llm_fn = functools.partial(invoke_agent, get_llm())
 
     graph = StateGraph(GraphState)
 
     graph.add_node("agent", invoke_llm_fn)
-    graph.add_node("invoke_tools", functools.partial(invoke_tools, tools=tools))
+    graph.add_node(
+        "invoke_tools",
+        functools.partial(
+            invoke_repo_tools,
+            max_concurrency=int(env.get_env_var("QRY_TOOL_CONCURRENCY", DEFAULT_TOOL_CONCURRENCY)),
+            timeout_seconds=float(env.get_env_var("QRY_TOOL_TIMEOUT_SECONDS", DEFAULT_TOOL_TIMEOUT_SECONDS)),
+            max_result_tokens=int(env.get_env_var("QRY_TOOL_RESULT_MAX_TOKENS", DEFAULT_TOOL_RESULT_MAX_TOKENS)),
+        ),
+    )
     graph.add_edge(START, "agent")
     graph.add_conditional_edges(
         "agent",
@@ -113,4 +249,24 @@ def build_graph(repo_name: str):
     graph.add_edge("invoke_tools", "agent")
     graph.add_edge("agent", END)
 
-    return graph.compile()
+    return graph.compile(checkpointer=checkpointer)
+
+
+@functools.lru_cache(maxsize=1)
+def get_graph():
+    """Returns the process-wide compiled graph, built with its LLM client on first use."""
+
+    log(f"{get_graph.__name__} START.")
+    graph = build_graph()
+    log(f"{get_graph.__name__} END.")
+    return graph
+
+
+@functools.lru_cache(maxsize=1)
+def get_conversation_graph():
+    """Returns the process-wide compiled graph that keeps each conversation's state in the checkpointer."""
+
+    log(f"{get_conversation_graph.__name__} START.")
+    graph = build_graph(checkpointer=create_checkpointer())
+    log(f"{get_conversation_graph.__name__} END.")
+    return graph
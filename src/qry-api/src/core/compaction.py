@@ -0,0 +1,274 @@
+import functools
+import logging
+from typing import Callable, Dict, List, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, ToolMessage
+
+from agntsmth_core.core.utls import EnvVarProvider
+
+
+DEFAULT_TOOL_RESULT_MAX_TOKENS = 2000
+DEFAULT_TOKEN_ENCODING = "cl100k_base"
+DEFAULT_CHARS_PER_TOKEN = 4
+DEFAULT_MIN_MERGE_OVERLAP_CHARS = 16
+DEFAULT_MIN_TRUNCATED_TOKENS = 64
+
+NO_DOCUMENTS = "No documents found."
+NO_NEW_DOCUMENTS = "No new documents, the relevant ones are already in the conversation above."
+
+env = EnvVarProvider()
+
+# chunk texts already in front of the LLM, keyed by source, None holds tool results without documents...
+SeenChunks = Dict[Optional[str], List[str]]
+
+
+def estimate_token_count(text: str) -> int:
+    return max(1, len(text) // DEFAULT_CHARS_PER_TOKEN)
+
+
+@functools.lru_cache(maxsize=1)
+def get_token_counter() -> Callable[[str], int]:
+    """Returns a tiktoken based token counter, or a chars per token estimate when the encoding can't be loaded."""
+
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(env.get_env_var("QRY_TOKEN_ENCODING", DEFAULT_TOKEN_ENCODING))
+    except Exception as e:
+        logging.warning(f"{get_token_counter.__name__} <FALLING BACK> to estimated token counts, err: {e}")
+        return estimate_token_count
+
+    return lambda text: len(encoding.encode_ordinary(text))
+
+
+def get_source(document: Document) -> Optional[str]:
+    return document.metadata.get("source", None)
+
+
+def get_score(document: Document) -> float:
+    score = document.metadata.get("score", None)
+    return score if score is not None else float("-inf")
+
+
+def collect_seen_chunks(messages: Sequence[BaseMessage]) -> SeenChunks:
+    """Chunk texts earlier tool results already put in the conversation."""
+
+    seen: SeenChunks = {}
+
+    for message in messages:
+        if not isinstance(message, ToolMessage):
+            continue
+
+        if isinstance(message.artifact, list):
+            for document in message.artifact:
+                if isinstance(document, Document):
+                    seen.setdefault(get_source(document), []).append(document.page_content)
+        elif isinstance(message.content, str):
+            # e.g. a stateless history sent back by the client, its artifacts are gone but the text isn't...
+            seen.setdefault(None, []).append(message.content)
+
+    return seen
+
+
+def is_seen(document: Document, seen: SeenChunks) -> bool:
+    text = document.page_content.strip()
+    return any(text in seen_text for seen_text in seen.get(get_source(document), []) + seen.get(None, []))
+
+
+def dedup_documents(documents: List[Document], seen: SeenChunks) -> List[Document]:
+    """Drops documents whose text is already in the conversation, or repeated within documents."""
+
+    deduped = []
+    deduped_keys = set()
+
+    for document in documents:
+        key = (get_source(document), document.page_content.strip())
+        if key in deduped_keys or is_seen(document, seen):
+            continue
+        deduped_keys.add(key)
+        deduped.append(document)
+
+    return deduped
+
+
+def merge_texts(head: str, tail: str, min_overlap_chars: int) -> Optional[str]:
+    """Joins tail onto head when tail starts with at least min_overlap_chars of head's end, otherwise None."""
+
+    if tail in head:
+        return head
+    if len(tail) < min_overlap_chars:
+        return None
+
+    anchor = tail[:min_overlap_chars]
+    start = max(0, len(head) - len(tail))
+    position = head.find(anchor, start)
+    while position != -1:
+        if tail.startswith(head[position:]):
+            return head[:position] + tail
+        position = head.find(anchor, position + 1)
+
+    return None
+
+
+def merge_documents(head: Document, tail: Document, text: str) -> Document:
+    metadata = dict(head.metadata)
+    if "score" in head.metadata or "score" in tail.metadata:
+        metadata["score"] = max(get_score(head), get_score(tail))
+    return Document(page_content=text, metadata=metadata)
+
+
+def merge_adjacent_documents(
+    documents: List[Document], min_overlap_chars: int = DEFAULT_MIN_MERGE_OVERLAP_CHARS
+) -> List[Document]:
+    """
+    Merges chunks of the same source that the splitter cut with an overlap, or that contain one another, into one
+    document scored by its best chunk. Sources keep the position of their first chunk.
+    """
+
+    by_source: Dict[Optional[str], List[Document]] = {}
+    for document in documents:
+        by_source.setdefault(get_source(document), []).append(document)
+
+    merged: List[Document] = []
+
+    for source_documents in by_source.values():
+        pending = list(source_documents)
+        while pending:
+            current = pending.pop(0)
+            i = 0
+            while i < len(pending):
+                other = pending[i]
+                text = merge_texts(current.page_content, other.page_content, min_overlap_chars)
+                if text is None:
+                    text = merge_texts(other.page_content, current.page_content, min_overlap_chars)
+                if text is None:
+                    i += 1
+                    continue
+
+                current = merge_documents(current, other, text)
+                pending.pop(i)
+                # the longer text may now bridge to a chunk skipped earlier...
+                i = 0
+            merged.append(current)
+
+    return merged
+
+
+def truncate_text(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    """Keeps whole lines of text up to max_tokens."""
+
+    kept = []
+    tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+        if tokens + line_tokens > max_tokens:
+            break
+        kept.append(line)
+        tokens += line_tokens
+
+    # tokens can merge across line breaks, per line counts are only close...
+    while kept and count_tokens("".join(kept)) > max_tokens:
+        kept.pop()
+
+    return "".join(kept)
+
+
+def format_document(document: Document) -> str:
+    return f"source: {get_source(document)}\n{document.page_content}"
+
+
+def format_documents(documents: List[Document]) -> str:
+    """Tool result text of documents, their sources and contents without the Document repr's quoting and escapes."""
+
+    return "\n\n".join(format_document(document) for document in documents)
+
+
+def trim_documents(
+    documents: List[Document],
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+    min_truncated_tokens: int = DEFAULT_MIN_TRUNCATED_TOKENS,
+) -> List[Document]:
+    """
+    Keeps the most relevant documents whose formatted text fits in max_tokens, truncating the first one that doesn't
+    fit while enough budget is left for it to be useful. Kept documents stay in their original order.
+    """
+
+    if max_tokens <= 0:
+        return documents
+
+    # unscored documents rank last, in their original order...
+    ranked = sorted(range(len(documents)), key=lambda i: -get_score(documents[i]))
+
+    kept = {}
+    remaining_tokens = max_tokens
+    truncated = False
+
+    for i in ranked:
+        document = documents[i]
+        tokens = count_tokens(format_document(document))
+        if tokens <= remaining_tokens:
+            kept[i] = document
+            remaining_tokens -= tokens
+        elif not truncated and remaining_tokens >= min_truncated_tokens:
+            header_tokens = count_tokens(format_document(Document(page_content="", metadata=document.metadata)))
+            text = truncate_text(document.page_content, remaining_tokens - header_tokens, count_tokens)
+            if text:
+                kept[i] = Document(page_content=text, metadata={**document.metadata, "truncated": True})
+                remaining_tokens -= header_tokens + count_tokens(text)
+            truncated = True
+
+    return [kept[i] for i in sorted(kept)]
+
+
+def compact_documents(
+    documents: List[Document],
+    seen: SeenChunks,
+    max_tokens: int = DEFAULT_TOOL_RESULT_MAX_TOKENS,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> List[Document]:
+    """
+    Compacts retrieved documents before they reach the LLM: drops chunks already in the conversation, merges
+    overlapping chunks of a source and trims the rest to max_tokens. Kept chunks are added to seen.
+    """
+
+    compacted = trim_documents(
+        merge_adjacent_documents(dedup_documents(documents, seen)), max_tokens, count_tokens or get_token_counter()
+    )
+
+    for document in compacted:
+        seen.setdefault(get_source(document), []).append(document.page_content)
+
+    return compacted
+
+
+def compact_tool_messages(
+    tool_messages: List[ToolMessage],
+    message_history: Sequence[BaseMessage],
+    max_tokens: int = DEFAULT_TOOL_RESULT_MAX_TOKENS,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> List[ToolMessage]:
+    """
+    Replaces the document lists of retrieval tool results with their compacted text, other results pass through.
+    Results are compacted in order, a chunk returned by two calls of one turn is only kept by the first.
+    """
+
+    seen = collect_seen_chunks(message_history)
+    compacted_messages = []
+
+    for tool_message in tool_messages:
+        artifact = tool_message.artifact
+        if not isinstance(artifact, list) or not all(isinstance(d, Document) for d in artifact):
+            compacted_messages.append(tool_message)
+            continue
+
+        documents = compact_documents(artifact, seen, max_tokens, count_tokens)
+        if documents:
+            content = format_documents(documents)
+        else:
+            content = NO_NEW_DOCUMENTS if artifact else NO_DOCUMENTS
+
+        compacted_messages.append(tool_message.model_copy(update={"content": content, "artifact": documents}))
+
+    return compacted_messages
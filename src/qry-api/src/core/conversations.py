@@ -0,0 +1,352 @@
+import asyncio
+import base64
+import logging
+import threading
+from json import dumps as json_dumps
+from json import loads as json_loads
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    WRITES_IDX_MAP,
+)
+from langgraph.checkpoint.memory import InMemorySaver
+
+from agntsmth_core.core.utls import EnvVarProvider, log
+
+
+DEFAULT_CONVERSATION_STORE = "dapr"
+DEFAULT_CONVERSATION_STATESTORE_NAME = "statestore-conversations"
+DEFAULT_WRITES_SAVE_RETRIES = 5
+
+env = EnvVarProvider()
+
+
+def is_etag_mismatch(e: Exception) -> bool:
+    """Whether a Dapr state call failed because the item changed since it was read."""
+
+    import grpc
+
+    code = getattr(e, "code", None)
+    return callable(code) and code() == grpc.StatusCode.ABORTED
+
+
+class DaprCheckpointSaver(BaseCheckpointSaver):
+    """
+    LangGraph checkpointer on a Dapr state store, keeping only the latest checkpoint of each conversation and its
+    pending writes, which is all resuming a conversation needs.
+    """
+
+    def __init__(
+        self,
+        store_name: str,
+        client_factory: Optional[Callable[[], Any]] = None,
+        writes_save_retries: int = DEFAULT_WRITES_SAVE_RETRIES,
+        **kwargs,
+    ):
+        """
+        :param store_name: Dapr state store component name.
+        :param client_factory: Creates the Dapr client, defaults to dapr.clients.DaprClient.
+        :param writes_save_retries: Attempts after the first one to save pending writes, or checkpoint namespaces, another
+            task saved in between.
+        """
+
+        super().__init__(**kwargs)
+
+        self._store_name = store_name
+        self._writes_save_retries = writes_save_retries
+        self._client_factory = client_factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                if self._client_factory is None:
+                    from dapr.clients import DaprClient
+
+                    self._client_factory = DaprClient
+                # one client, its grpc channel is reused by every call...
+                self._client = self._client_factory()
+            return self._client
+
+    @staticmethod
+    def _checkpoint_key(thread_id: str, checkpoint_ns: str) -> str:
+        return f"conversation|{thread_id}|{checkpoint_ns}"
+
+    @staticmethod
+    def _writes_key(thread_id: str, checkpoint_ns: str) -> str:
+        return f"conversation|{thread_id}|{checkpoint_ns}|writes"
+
+    @staticmethod
+    def _namespaces_key(thread_id: str) -> str:
+        # checkpoint namespaces are "node:task_id" segments, none of them is a bare "namespaces"...
+        return f"conversation|{thread_id}|namespaces"
+
+    def _get_json_and_etag(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        state_item = self._get_client().get_state(
+            store_name=self._store_name, key=key, state_metadata={"contentType": "application/json"}
+        )
+        etag = getattr(state_item, "etag", None) or None
+        if state_item.data is None or state_item.data == b"":
+            return None, etag
+        return json_loads(state_item.data), etag
+
+    def _get_json(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._get_json_and_etag(key)[0]
+
+    def _save_json(self, key: str, value: Dict[str, Any], etag: Optional[str] = None, first_write: bool = False) -> None:
+        """Saves the value, with first_write only if the item is still at etag, or still missing without one."""
+
+        concurrency_kwargs = {}
+        if first_write:
+            from dapr.clients.grpc._state import Concurrency, StateOptions
+
+            concurrency_kwargs = {"etag": etag, "options": StateOptions(concurrency=Concurrency.first_write)}
+
+        self._get_client().save_state(
+            store_name=self._store_name,
+            key=key,
+            value=json_dumps(value),
+            state_metadata={"contentType": "application/json"},
+            **concurrency_kwargs,
+        )
+
+    def _add_checkpoint_ns(self, thread_id: str, checkpoint_ns: str) -> None:
+        """Records a subgraph's checkpoint namespace, so deleting the thread finds its keys."""
+
+        key = self._namespaces_key(thread_id)
+
+        # subgraphs running in parallel add theirs to the same item...
+        for attempt in range(self._writes_save_retries + 1):
+            saved_namespaces, etag = self._get_json_and_etag(key)
+            checkpoint_namespaces = (saved_namespaces or {}).get("checkpoint_namespaces", [])
+            if checkpoint_ns in checkpoint_namespaces:
+                return
+
+            try:
+                self._save_json(
+                    key, {"checkpoint_namespaces": [*checkpoint_namespaces, checkpoint_ns]}, etag=etag, first_write=True
+                )
+                return
+            except Exception as e:
+                if not is_etag_mismatch(e) or attempt == self._writes_save_retries:
+                    raise
+                logging.warning(
+                    f"{self._add_checkpoint_ns.__name__} <RETRYING> key: {key}, attempt: {attempt + 1}, err: {e}"
+                )
+
+    def _dumps(self, value: Any) -> list:
+        type_name, data = self.serde.dumps_typed(value)
+        return [type_name, base64.b64encode(data).decode()]
+
+    def _loads(self, value: list) -> Any:
+        type_name, data = value
+        return self.serde.loads_typed((type_name, base64.b64decode(data)))
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+
+        saved = self._get_json(self._checkpoint_key(thread_id, checkpoint_ns))
+        if saved is None:
+            return None
+
+        checkpoint_id = config["configurable"].get("checkpoint_id", None)
+        if checkpoint_id is not None and checkpoint_id != saved["checkpoint_id"]:
+            # only the latest checkpoint is kept...
+            return None
+
+        saved_writes = self._get_json(self._writes_key(thread_id, checkpoint_ns)) or {}
+        pending_writes = (
+            [
+                (task_id, channel, self._loads(value))
+                for task_id, channel, value, _ in saved_writes.get("writes", {}).values()
+            ]
+            if saved_writes.get("checkpoint_id", None) == saved["checkpoint_id"]
+            else []
+        )
+
+        parent_checkpoint_id = saved.get("parent_checkpoint_id", None)
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": saved["checkpoint_id"],
+                }
+            },
+            checkpoint=self._loads(saved["checkpoint"]),
+            metadata=self._loads(saved["metadata"]),
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_checkpoint_id,
+                    }
+                }
+                if parent_checkpoint_id
+                else None
+            ),
+            pending_writes=pending_writes,
+        )
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        if config is None or limit == 0:
+            return
+
+        checkpoint_tuple = self.get_tuple(config)
+        if checkpoint_tuple is None:
+            return
+
+        if filter and any(checkpoint_tuple.metadata.get(k, None) != v for k, v in filter.items()):
+            return
+
+        yield checkpoint_tuple
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+
+        if checkpoint_ns:
+            self._add_checkpoint_ns(thread_id, checkpoint_ns)
+
+        self._save_json(
+            self._checkpoint_key(thread_id, checkpoint_ns),
+            {
+                "checkpoint_id": checkpoint["id"],
+                "parent_checkpoint_id": config["configurable"].get("checkpoint_id", None),
+                "checkpoint": self._dumps(checkpoint),
+                "metadata": self._dumps(metadata),
+            },
+        )
+
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        key = self._writes_key(thread_id, checkpoint_ns)
+        dumped_writes = [(channel, self._dumps(value)) for channel, value in writes]
+
+        # parallel tasks of a step save their writes to the same item, each save only lands on what it read...
+        for attempt in range(self._writes_save_retries + 1):
+            saved_writes, etag = self._get_json_and_etag(key)
+            saved_writes = saved_writes or {}
+            if saved_writes.get("checkpoint_id", None) != checkpoint_id:
+                # writes of an older checkpoint are spent...
+                saved_writes = {"checkpoint_id": checkpoint_id, "writes": {}}
+
+            for idx, (channel, value) in enumerate(dumped_writes):
+                write_idx = WRITES_IDX_MAP.get(channel, idx)
+                write_key = f"{task_id}|{write_idx}"
+                if write_idx >= 0 and write_key in saved_writes["writes"]:
+                    continue
+                saved_writes["writes"][write_key] = [task_id, channel, value, task_path]
+
+            try:
+                self._save_json(key, saved_writes, etag=etag, first_write=True)
+                return
+            except Exception as e:
+                if not is_etag_mismatch(e) or attempt == self._writes_save_retries:
+                    raise
+                logging.warning(f"{self.put_writes.__name__} <RETRYING> key: {key}, attempt: {attempt + 1}, err: {e}")
+
+    def delete_thread(self, thread_id: str) -> None:
+        client = self._get_client()
+        namespaces_key = self._namespaces_key(thread_id)
+        checkpoint_namespaces = (self._get_json(namespaces_key) or {}).get("checkpoint_namespaces", [])
+
+        for checkpoint_ns in ["", *checkpoint_namespaces]:
+            for key in (self._checkpoint_key(thread_id, checkpoint_ns), self._writes_key(thread_id, checkpoint_ns)):
+                client.delete_state(store_name=self._store_name, key=key)
+        # last, a delete that fails half way can be retried...
+        client.delete_state(store_name=self._store_name, key=namespaces_key)
+
+    # the dapr client is blocking, keep it off the event loop...
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def create_checkpointer() -> BaseCheckpointSaver:
+    """Dapr backed checkpointer, or an in-memory one, e.g. for tests, when CONVERSATION_STORE is "memory"."""
+
+    conversation_store = env.get_env_var("CONVERSATION_STORE", DEFAULT_CONVERSATION_STORE).lower()
+    log(f"{create_checkpointer.__name__} -> conversation_store: {conversation_store}")
+
+    if conversation_store == "memory":
+        return InMemorySaver()
+
+    if conversation_store == "dapr":
+        return DaprCheckpointSaver(
+            env.get_env_var("CONVERSATION_STATESTORE_NAME", DEFAULT_CONVERSATION_STATESTORE_NAME)
+        )
+
+    raise ValueError(f"Unsupported CONVERSATION_STORE: {conversation_store}.")
@@ -0,0 +1,274 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+import importlib.util
+import weakref
+from typing import Any, Dict, Optional
+import httpx
+from agntsmth_core.core.utls import EnvVarProvider
+
+
+DEFAULT_HTTP_TIMEOUT_SECONDS = 30
+DEFAULT_HTTP_CONNECT_TIMEOUT_SECONDS = 3
+DEFAULT_HTTP_MAX_CONNECTIONS = 100
+DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_HTTP_KEEPALIVE_EXPIRY_SECONDS = 60
+DEFAULT_HTTP_RETRIES = 2
+DEFAULT_HTTP_BACKOFF_SECONDS = 0.1
+DEFAULT_HTTP_MAX_BACKOFF_SECONDS = 2
+DEFAULT_HTTP_BREAKER_FAILURES = 5
+DEFAULT_HTTP_BREAKER_RESET_SECONDS = 30
+
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+env = EnvVarProvider()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures, failing calls fast for reset_seconds, then lets a single
+    trial call through and closes again once one succeeds.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self._failure_threshold = failure_threshold
+        self._reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if time.monotonic() - self._opened_at < self._reset_seconds or self._trial_in_flight:
+                return False
+
+            # half open, one trial call decides whether the host is back...
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """Lets another trial call through when one ended without an outcome, e.g. cancelled by a timeout."""
+
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._failures >= self._failure_threshold:
+                self._opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+
+class PooledHttpClient:
+    """
+    Keep-alive httpx clients shared by every caller in the process, sync and async, with pool limits, timeouts,
+    bounded retries with jittered exponential backoff and a circuit breaker per host.
+    """
+
+    def __init__(
+        self,
+        timeout_seconds: float = DEFAULT_HTTP_TIMEOUT_SECONDS,
+        connect_timeout_seconds: float = DEFAULT_HTTP_CONNECT_TIMEOUT_SECONDS,
+        max_connections: int = DEFAULT_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections: int = DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry_seconds: float = DEFAULT_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        retries: int = DEFAULT_HTTP_RETRIES,
+        backoff_seconds: float = DEFAULT_HTTP_BACKOFF_SECONDS,
+        max_backoff_seconds: float = DEFAULT_HTTP_MAX_BACKOFF_SECONDS,
+        breaker_failures: int = DEFAULT_HTTP_BREAKER_FAILURES,
+        breaker_reset_seconds: float = DEFAULT_HTTP_BREAKER_RESET_SECONDS,
+        http2: bool = False,
+        transport: Optional[httpx.BaseTransport] = None,
+        async_transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        """
+        :param timeout_seconds: Read, write and pool timeout of a single attempt.
+        :param connect_timeout_seconds: Connect timeout of a single attempt.
+        :param retries: Attempts after the first one, on transport errors and retryable status codes.
+        :param backoff_seconds: Base of the exponential backoff, each wait is drawn uniformly up to it.
+        :param breaker_failures: Consecutive failed calls, after retries, that open a host's circuit.
+        :param breaker_reset_seconds: How long an open circuit fails fast before letting a trial call through.
+        :param http2: Negotiate HTTP/2, only honoured when the h2 package is installed.
+        :param transport: Sync transport override, e.g. for tests.
+        :param async_transport: Async transport override, e.g. for tests.
+        """
+
+        self._timeout = httpx.Timeout(timeout_seconds, connect=connect_timeout_seconds)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry_seconds,
+        )
+        self._retries = retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._breaker_failures = breaker_failures
+        self._breaker_reset_seconds = breaker_reset_seconds
+        self._http2 = http2 and importlib.util.find_spec("h2") is not None
+        self._transport = transport
+        self._async_transport = async_transport
+
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        # async clients hold connections bound to the loop that opened them, one per loop...
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def _get_client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(
+                    timeout=self._timeout, limits=self._limits, http2=self._http2, transport=self._transport
+                )
+            return self._client
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop, None)
+            if client is None:
+                client = httpx.AsyncClient(
+                    timeout=self._timeout, limits=self._limits, http2=self._http2, transport=self._async_transport
+                )
+                self._async_clients[loop] = client
+            return client
+
+    def get_breaker(self, url: str) -> CircuitBreaker:
+        host = httpx.URL(url).netloc.decode()
+        with self._lock:
+            breaker = self._breakers.get(host, None)
+            if breaker is None:
+                breaker = CircuitBreaker(self._breaker_failures, self._breaker_reset_seconds)
+                self._breakers[host] = breaker
+            return breaker
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter, so retries of concurrent callers don't arrive in lockstep...
+        return random.uniform(0, min(self._max_backoff_seconds, self._backoff_seconds * 2 ** attempt))
+
+    @staticmethod
+    def _is_retryable(response: Optional[httpx.Response], error: Optional[Exception]) -> bool:
+        if error is not None:
+            return isinstance(error, httpx.TransportError)
+        return response.status_code in RETRYABLE_STATUS_CODES
+
+    def _check_breaker(self, url: str) -> CircuitBreaker:
+        breaker = self.get_breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {httpx.URL(url).netloc.decode()}, failing fast.")
+        return breaker
+
+    @staticmethod
+    def _settle(breaker: CircuitBreaker, response: Optional[httpx.Response], error: Optional[Exception]) -> Any:
+        if error is not None:
+            breaker.record_failure()
+            raise error
+
+        # a 4xx is the caller's fault, the host itself is healthy...
+        if response.status_code >= 500 or response.status_code == 429:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        response.raise_for_status()
+        return response.json()
+
+    def post_json(self, url: str, json: Dict[str, Any]) -> Any:
+        """POSTs json, retrying transient failures, and returns the decoded response body."""
+
+        breaker = self._check_breaker(url)
+        client = self._get_client()
+
+        try:
+            for attempt in range(self._retries + 1):
+                response, error = None, None
+                try:
+                    response = client.post(url, json=json)
+                except Exception as e:
+                    error = e
+
+                if attempt == self._retries or not self._is_retryable(response, error):
+                    break
+
+                logging.warning(f"{self.post_json.__name__} <RETRYING> url: {url}, attempt: {attempt + 1}, err: {error or response.status_code}")
+                time.sleep(self._backoff(attempt))
+        except BaseException:
+            # interrupted, the call has no outcome for the breaker...
+            breaker.release_trial()
+            raise
+
+        return self._settle(breaker, response, error)
+
+    async def apost_json(self, url: str, json: Dict[str, Any]) -> Any:
+        """POSTs json, retrying transient failures, and returns the decoded response body."""
+
+        breaker = self._check_breaker(url)
+        client = self._get_async_client()
+
+        try:
+            for attempt in range(self._retries + 1):
+                response, error = None, None
+                try:
+                    response = await client.post(url, json=json)
+                except Exception as e:
+                    error = e
+
+                if attempt == self._retries or not self._is_retryable(response, error):
+                    break
+
+                logging.warning(f"{self.apost_json.__name__} <RETRYING> url: {url}, attempt: {attempt + 1}, err: {error or response.status_code}")
+                await asyncio.sleep(self._backoff(attempt))
+        except BaseException:
+            # cancelled, e.g. by a tool call timeout, the call has no outcome for the breaker...
+            breaker.release_trial()
+            raise
+
+        return self._settle(breaker, response, error)
+
+
+def create_http_client() -> PooledHttpClient:
+    return PooledHttpClient(
+        timeout_seconds=float(env.get_env_var("QRY_HTTP_TIMEOUT_SECONDS", DEFAULT_HTTP_TIMEOUT_SECONDS)),
+        connect_timeout_seconds=float(
+            env.get_env_var("QRY_HTTP_CONNECT_TIMEOUT_SECONDS", DEFAULT_HTTP_CONNECT_TIMEOUT_SECONDS)
+        ),
+        max_connections=int(env.get_env_var("QRY_HTTP_MAX_CONNECTIONS", DEFAULT_HTTP_MAX_CONNECTIONS)),
+        max_keepalive_connections=int(
+            env.get_env_var("QRY_HTTP_MAX_KEEPALIVE_CONNECTIONS", DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS)
+        ),
+        retries=int(env.get_env_var("QRY_HTTP_RETRIES", DEFAULT_HTTP_RETRIES)),
+        backoff_seconds=float(env.get_env_var("QRY_HTTP_BACKOFF_SECONDS", DEFAULT_HTTP_BACKOFF_SECONDS)),
+        breaker_failures=int(env.get_env_var("QRY_HTTP_BREAKER_FAILURES", DEFAULT_HTTP_BREAKER_FAILURES)),
+        breaker_reset_seconds=float(
+            env.get_env_var("QRY_HTTP_BREAKER_RESET_SECONDS", DEFAULT_HTTP_BREAKER_RESET_SECONDS)
+        ),
+        http2=env.get_env_var("QRY_HTTP2", "false").lower() == "true",
+    )
+
+
+# shared by every retriever in the process...
+http_client = create_http_client()
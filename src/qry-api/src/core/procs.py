@@ -1,26 +1,139 @@
-from typing import Awaitable
+import logging
+from typing import Any, AsyncIterator, Awaitable, Optional, Tuple
+from langchain_core.documents import Document
 from langchain_core.messages import (
     BaseMessage,
+    AIMessage,
+    ToolMessage,
 )
 from agntsmth_core.core.utls import log
-from lxi_framework import RootQry
+from lxi_framework import RootQry, generate_unique_name
 
-from .agent import build_graph
+from .agent import get_graph, get_conversation_graph, create_graph_config
 from .maps import dict_to_message, message_to_dict
 
 
-async def process_qry(qry: RootQry) -> Awaitable[list[BaseMessage]]:
-    log(f"{process_qry.__name__} START. qry: {qry}")
+def is_conversation_qry(qry: RootQry) -> bool:
+    return "conversation_id" in qry.qry_data or "messages" in qry.qry_data
+
+
+def prepare_qry(qry: RootQry) -> Tuple[Any, list[BaseMessage], dict, Optional[str]]:
+    """
+    Resolves the graph, input messages, config and conversation id of a qry.
+
+    A conversation qry carries a conversation_id, none starts a new conversation, and only its new "messages", the rest
+    of the history is loaded from the checkpointer. Otherwise the qry carries the whole "message_history".
+    """
 
     repo_name = qry._repo_name_()
-    graph = build_graph(repo_name)
 
-    typed_message_history = [
-        dict_to_message(m) for m in qry.qry_data["message_history"]
-    ]
+    if not is_conversation_qry(qry):
+        messages = [dict_to_message(m) for m in qry.qry_data["message_history"]]
+        return get_graph(), messages, create_graph_config(repo_name), None
+
+    conversation_id = qry.qry_data.get("conversation_id", None) or generate_unique_name("conversation-")
+    messages = [dict_to_message(m) for m in qry.qry_data.get("messages", [])]
+    return get_conversation_graph(), messages, create_graph_config(repo_name, conversation_id), conversation_id
+
+
+def create_qry_output(
+    messages: list[BaseMessage], new_messages: list[BaseMessage], conversation_id: Optional[str]
+) -> dict[str, Any]:
+    """The whole history for stateless qrys, only the messages this run added for conversations."""
+
+    if conversation_id is None:
+        return {"output": [message_to_dict(m) for m in messages + new_messages if m.content != ""]}
+
+    return {
+        "conversation_id": conversation_id,
+        "output": [message_to_dict(m) for m in new_messages if m.content != ""],
+    }
+
+
+async def process_qry(qry: RootQry) -> Awaitable[dict[str, Any]]:
+    log(f"{process_qry.__name__} START. qry: {qry}")
+
+    graph, messages, config, conversation_id = prepare_qry(qry)
 
-    state = graph.invoke(input={"message_history": typed_message_history})
+    new_messages = []
+    async for update in graph.astream(
+        input={"message_history": messages}, config=config, stream_mode="updates"
+    ):
+        for node_update in update.values():
+            new_messages.extend((node_update or {}).get("message_history", []))
 
     log(f"{process_qry.__name__} END. qry: {qry}")
 
-    return [message_to_dict(m) for m in state["message_history"] if m.content != ""]
+    return create_qry_output(messages, new_messages, conversation_id)
+
+
+def summarize_tool_result(tool_message: ToolMessage) -> list[dict]:
+    """Sources and scores of the documents a retrieval tool returned, without their content."""
+
+    artifact = tool_message.artifact
+    if not isinstance(artifact, list):
+        return []
+
+    return [
+        {"source": doc.metadata.get("source", None), "score": doc.metadata.get("score", None)}
+        for doc in artifact
+        if isinstance(doc, Document)
+    ]
+
+
+async def stream_qry(qry: RootQry) -> AsyncIterator[dict[str, Any]]:
+    """
+    Runs the agent, yielding events as they happen: "token" for LLM output, "tool_call" for each tool the LLM calls,
+    "tool_result" with a summary of what the tool returned, and a final "done" carrying the same response as /qry.
+    """
+
+    log(f"{stream_qry.__name__} START. qry: {qry}")
+
+    graph, messages, config, conversation_id = prepare_qry(qry)
+    new_messages = []
+
+    try:
+        async for stream_mode, chunk in graph.astream(
+            input={"message_history": messages},
+            config=config,
+            stream_mode=["messages", "updates"],
+        ):
+            if stream_mode == "messages":
+                message, metadata = chunk
+                if (
+                    isinstance(message, AIMessage)
+                    and metadata.get("langgraph_node", None) == "agent"
+                    and isinstance(message.content, str)
+                    and message.content
+                ):
+                    yield {"type": "token", "content": message.content}
+                continue
+
+            for node_name, update in chunk.items():
+                update_messages = (update or {}).get("message_history", [])
+                new_messages.extend(update_messages)
+
+                for message in update_messages:
+                    if isinstance(message, AIMessage):
+                        for tool_call in message.tool_calls:
+                            yield {
+                                "type": "tool_call",
+                                "id": tool_call["id"],
+                                "name": tool_call["name"],
+                                "args": tool_call["args"],
+                            }
+                    elif isinstance(message, ToolMessage):
+                        yield {
+                            "type": "tool_result",
+                            "tool_call_id": message.tool_call_id,
+                            "name": message.name,
+                            "documents": summarize_tool_result(message),
+                        }
+    except Exception as e:
+        logging.warning(f"{stream_qry.__name__} <SKIPPING> rest of stream. err: {e}")
+        yield {"type": "error", "error": str(e)}
+        return
+
+    yield {"type": "done", **create_qry_output(messages, new_messages, conversation_id)}
+
+    log(f"{stream_qry.__name__} END. qry: {qry}")
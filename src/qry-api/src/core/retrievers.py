@@ -1,26 +1,53 @@
-import requests
+from typing import Any, Dict, Optional
 from langchain.schema import BaseRetriever, Document
 from pydantic import BaseModel
 from agntsmth_core.core.utls import log
 
+from .http_client import http_client
+
 
 class RemoteEmbeddingRetriever(BaseRetriever, BaseModel):
 
     api_url: str = ""
     file_system_name: str = ""
+    search_kwargs: Dict[str, Any] = {}
 
-    def __init__(self, api_url: str, file_system_name: str, /, **kwargs):
+    def __init__(self, api_url: str, file_system_name: str, /, search_kwargs: Optional[Dict[str, Any]] = None, **kwargs):
         """
         Initializes the retriever.
 
         param api_url: Base URL of the embeddings-api.
         file_system_path: The file system path, used as context for the query.
+        search_kwargs: /qry search parameters, e.g. k, score_threshold, mmr, path_prefixes and file_exts.
         """
 
         super().__init__(**kwargs)
 
         self.api_url = api_url
         self.file_system_name = file_system_name
+        self.search_kwargs = search_kwargs or {}
+
+    def _create_qry_cmd(self, query: str) -> Dict[str, Any]:
+        return {**self.search_kwargs, "qry": query, "file_system_name": self.file_system_name}
+
+    def _create_qry_batch_cmd(self, queries: list[str]) -> Dict[str, Any]:
+        return {**self.search_kwargs, "qrys": list(queries), "file_system_name": self.file_system_name}
+
+    @staticmethod
+    def _to_document(doc: Dict[str, Any]) -> Document:
+        metadata = {"source": doc["source"]}
+        if doc.get("score", None) is not None:
+            metadata["score"] = doc["score"]
+        return Document(page_content=doc["page_content"], metadata=metadata)
+
+    def _parse_documents(self, results: Dict[str, Any]) -> list[Document]:
+        return [self._to_document(doc) for doc in results.get("output", {}).get("documents", [])]
+
+    def _parse_batch_documents(self, results: Dict[str, Any]) -> list[list[Document]]:
+        return [
+            [self._to_document(doc) for doc in result.get("documents", [])]
+            for result in results.get("output", {}).get("results", [])
+        ]
 
     def get_relevant_documents(self, query: str) -> list[Document]:
         """
@@ -29,16 +56,8 @@ class RemoteEmbeddingRetriever(BaseRetriever, BaseModel):
         :param query: The input query.
         :return: A list of relevant LangChain Document objects.
         """
-        response = requests.post(f"{self.api_url}/qry", json={"qry": query, "file_system_name": self.file_system_name})
-        response.raise_for_status()  # Ensure no HTTP errors
-        results = response.json()  # Expecting results in a specific format
-
-        # Convert API response to LangChain Documents
-        documents = [
-            Document(page_content=doc["page_content"], metadata={"source": doc["source"]})
-            for doc in results.get("output", {}).get("documents", [])
-        ]
-        return documents
+        results = http_client.post_json(f"{self.api_url}/qry", self._create_qry_cmd(query))
+        return self._parse_documents(results)
 
     async def aget_relevant_documents(self, query: str) -> list[Document]:
         """
@@ -47,14 +66,25 @@ class RemoteEmbeddingRetriever(BaseRetriever, BaseModel):
         :param query: The input query.
         :return: A list of relevant LangChain Document objects.
         """
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/qry", json={"qry": query, "file_system_name": self.file_system_name}) as response:
-                if response.status != 200:
-                    raise ValueError(f"Error from embeddings-api: {response.status}")
-                results = await response.json()
-                documents = [
-                    Document(page_content=doc["page_content"], metadata={"source": doc["source"]})
-                    for doc in results.get("documents", [])
-                ]
-                return documents
+        results = await http_client.apost_json(f"{self.api_url}/qry", self._create_qry_cmd(query))
+        return self._parse_documents(results)
+
+    def get_relevant_documents_batch(self, queries: list[str]) -> list[list[Document]]:
+        """
+        Retrieves relevant documents for several queries in one round trip.
+
+        :param queries: The input queries.
+        :return: A list of relevant LangChain Document objects per query, in order.
+        """
+        results = http_client.post_json(f"{self.api_url}/qry/batch", self._create_qry_batch_cmd(queries))
+        return self._parse_batch_documents(results)
+
+    async def aget_relevant_documents_batch(self, queries: list[str]) -> list[list[Document]]:
+        """
+        Asynchronous retrieval of relevant documents for several queries in one round trip.
+
+        :param queries: The input queries.
+        :return: A list of relevant LangChain Document objects per query, in order.
+        """
+        results = await http_client.apost_json(f"{self.api_url}/qry/batch", self._create_qry_batch_cmd(queries))
+        return self._parse_batch_documents(results)
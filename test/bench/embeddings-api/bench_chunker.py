@@ -0,0 +1,137 @@
+"""
+Benchmarks the code-aware chunker against the tiktoken RecursiveCharacterTextSplitter on this repo's src/ tree.
+
+Reports chunks/sec, and retrieval hit rate: for every documented Python def/class, and every C#/TypeScript
+declaration, the query is its docstring (or its name split into words) and a hit is a top-k chunk from the same
+file that contains the declaration line.
+
+    python test/bench/embeddings-api/bench_chunker.py [--src src] [--k 4]
+"""
+
+import argparse
+import ast
+import os
+import re
+import sys
+import time
+
+sys.path.append(
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "../../../src/embeddings-api/src")
+    )
+)
+
+os.environ.setdefault("KEY", "xyz")
+os.environ.setdefault("CONFIG_PATH", os.path.join(os.path.dirname(__file__), "../../../src/embeddings-api/src/.config/openai_config.json"))
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from core.embed import (
+    iter_file_paths,
+    decode_file_bytes,
+    create_text_splitter,
+    create_embedding_function,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_IGNORE_FOLDERS,
+    DEFAULT_IGNORE_FILE_EXTS,
+)
+from core.chunker import detect_language
+
+DECLARATION_PATTERN = re.compile(
+    r"^\s*(?:(?:export|public|private|protected|internal|static|abstract|async|override|virtual|sealed|partial)\s+)*"
+    r"(?:class|interface|record|struct|enum|function|[\w<>\[\],.?]+)\s+(\w+)\s*[({<:]"
+)
+
+
+def split_identifier(name: str) -> str:
+    return " ".join(re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", name).replace("_", " ").split()).lower()
+
+
+def load_documents(src_path: str):
+    documents = []
+    for file_path in iter_file_paths(src_path, DEFAULT_IGNORE_FOLDERS.split(","), DEFAULT_IGNORE_FILE_EXTS.split(",")):
+        with open(file_path, "rb") as f:
+            page_content = decode_file_bytes(f.read())
+        if page_content:
+            documents.append(Document(page_content=page_content, metadata={"source": file_path}))
+    return documents
+
+
+def collect_queries(documents):
+    """(query, source, declaration line) for each declaration worth searching for."""
+
+    queries = []
+    for doc in documents:
+        source = doc.metadata["source"]
+        language = detect_language(source)
+        lines = doc.page_content.splitlines()
+
+        if language == "python":
+            try:
+                tree = ast.parse(doc.page_content)
+            except SyntaxError:
+                continue
+            for node in ast.walk(tree):
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                    docstring = ast.get_docstring(node)
+                    query = docstring.splitlines()[0] if docstring else split_identifier(node.name)
+                    queries.append((query, source, lines[node.lineno - 1].strip()))
+
+        elif language in ("csharp", "typescript"):
+            for line in lines:
+                match = DECLARATION_PATTERN.match(line)
+                if match and len(match.group(1)) > 3:
+                    queries.append((split_identifier(match.group(1)), source, line.strip()))
+
+    return queries
+
+
+def bench_splitter(name, splitter, documents, queries, embedding_function, k):
+    started = time.perf_counter()
+    chunks = splitter.split_documents(documents)
+    elapsed = time.perf_counter() - started
+
+    vectors = np.array(embedding_function.embed_documents([c.page_content for c in chunks]), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+
+    query_vectors = np.array(embedding_function.embed_documents([q for q, _, _ in queries]), dtype=np.float32)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True) + 1e-12
+
+    hits = 0
+    for (_, source, declaration), scores in zip(queries, query_vectors @ vectors.T):
+        top = np.argsort(-scores)[:k]
+        if any(
+            chunks[i].metadata["source"] == source and declaration in chunks[i].page_content
+            for i in top
+        ):
+            hits += 1
+
+    print(
+        f"{name:<10} chunks: {len(chunks):>6}  split: {elapsed:7.3f}s  "
+        f"chunks/sec: {len(chunks) / elapsed:10.1f}  hit@{k}: {hits / max(1, len(queries)):.3f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src", default=os.path.join(os.path.dirname(__file__), "../../../src"))
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+
+    documents = load_documents(os.path.abspath(args.src))
+    queries = collect_queries(documents)
+    print(f"files: {len(documents)}, queries: {len(queries)}")
+
+    embedding_function = create_embedding_function()
+
+    baseline = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP
+    )
+    bench_splitter("recursive", baseline, documents, queries, embedding_function, args.k)
+    bench_splitter("code", create_text_splitter(), documents, queries, embedding_function, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmarks embedding backends on chunks of this repo's src/ tree.
+
+Reports chunks/sec for torch, ONNX Runtime fp32 and ONNX Runtime int8, and the min/mean cosine similarity of
+each ONNX backend against the torch vectors.
+
+    python test/bench/embeddings-api/bench_embedding_backends.py [--src src] [--limit 2000] [--threads 0]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "../../../src/embeddings-api/src")
+    )
+)
+
+os.environ.setdefault("KEY", "xyz")
+os.environ.setdefault("CONFIG_PATH", os.path.join(os.path.dirname(__file__), "../../../src/embeddings-api/src/.config/openai_config.json"))
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_huggingface import HuggingFaceEmbeddings
+from core.embed import (
+    iter_file_paths,
+    decode_file_bytes,
+    create_text_splitter,
+    DEFAULT_EMBEDDING_MODEL_NAME,
+    DEFAULT_EMBED_BATCH_SIZE,
+    DEFAULT_IGNORE_FOLDERS,
+    DEFAULT_IGNORE_FILE_EXTS,
+)
+from core.backends import OnnxEmbeddings, ensure_onnx_model, DEFAULT_ONNX_CACHE_DIR
+
+
+def load_chunks(src_path: str, limit: int):
+    documents = []
+    for file_path in iter_file_paths(src_path, DEFAULT_IGNORE_FOLDERS.split(","), DEFAULT_IGNORE_FILE_EXTS.split(",")):
+        with open(file_path, "rb") as f:
+            page_content = decode_file_bytes(f.read())
+        if page_content:
+            documents.append(Document(page_content=page_content, metadata={"source": file_path}))
+
+    chunks = create_text_splitter().split_documents(documents)
+    return [chunk.page_content for chunk in chunks[:limit]]
+
+
+def bench_backend(name, embeddings, texts, reference=None):
+    # warm up, first calls allocate arenas and load kernels...
+    embeddings.embed_documents(texts[:8])
+
+    started = time.perf_counter()
+    vectors = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+    elapsed = time.perf_counter() - started
+
+    line = f"{name:<10} chunks/sec: {len(texts) / elapsed:8.1f}"
+
+    if reference is not None:
+        a = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        b = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+        cosines = (a * b).sum(axis=1)
+        line += f"  cosine min: {cosines.min():.4f}  mean: {cosines.mean():.4f}"
+
+    print(line)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src", default=os.path.join(os.path.dirname(__file__), "../../../src"))
+    parser.add_argument("--limit", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_EMBED_BATCH_SIZE)
+    args = parser.parse_args()
+
+    texts = load_chunks(os.path.abspath(args.src), args.limit)
+    print(f"chunks: {len(texts)}")
+
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    torch_embeddings = HuggingFaceEmbeddings(
+        model_name=DEFAULT_EMBEDDING_MODEL_NAME, encode_kwargs={"batch_size": args.batch_size}
+    )
+    reference = bench_backend("torch", torch_embeddings, texts)
+
+    dir_path = ensure_onnx_model(DEFAULT_EMBEDDING_MODEL_NAME, DEFAULT_ONNX_CACHE_DIR)
+    for name, quantized in (("onnx", False), ("onnx-int8", True)):
+        embeddings = OnnxEmbeddings(
+            dir_path, quantized=quantized, intra_op_threads=args.threads, batch_size=args.batch_size
+        )
+        bench_backend(name, embeddings, texts, reference)
+
+
+if __name__ == "__main__":
+    main()
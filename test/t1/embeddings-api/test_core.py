@@ -1,6 +1,9 @@
 import unittest
 import sys
 import os
+import tempfile
+import subprocess
+from unittest import mock
 
 sys.path.append(
     os.path.abspath(
@@ -12,6 +15,54 @@ sys.path.append(
 os.environ["KEY"] = "xyz"
 os.environ["CONFIG_PATH"] = config_path = os.path.join(os.path.dirname(__file__), "../../../src/embeddings-api/src/.config/openai_config.json")
 
+import chromadb
+from agntsmth_core.core.utls import generate_sha256
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from core.embed import (
+    iter_embedding_batches,
+    embed_chunks,
+    create_work_units,
+    translate_file_path_to_key,
+    split_file_paths,
+    diff_embedded_files_state,
+    delete_stale_chunks,
+    iter_file_paths,
+    create_chunk_where,
+    process_file_paths_concurrent,
+    DEFAULT_EMBEDDING_MODEL_NAME,
+)
+from core.procs import parse_qry_options, search_collection, retrieve_documents
+from core.cache import EmbeddingCache, CachedEmbeddings
+from core.git_fns import clone_mirror, fetch_mirror, git_changed_paths
+from core.pipeline import iter_in_background
+from core.filters import SkipReasons
+from core.chunker import CodeChunker
+from core.backends import export_onnx_model, OnnxEmbeddings
+from core.registry import Registry
+from core.batcher import QueryEmbeddingBatcher
+from core.qry_cache import QueryCache
+from core.lexical import LexicalIndex, tokenize, index_chunks
+from core.local_store import LocalVectorStoreClient
+from core.upsert import UpsertBuffer
+from core.embed import embed_file_system, rebuild_file_system
+from core.procs import resolve_collection_name
+
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    """Fake embedding model that records every text it is asked to embed."""
+
+    embedded_texts: list = []
+
+    def embed_documents(self, texts):
+        self.embedded_texts.extend(texts)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        self.embedded_texts.append(text)
+        return super().embed_query(text)
+
 
 class TestCore(unittest.TestCase):
     """Test core functions."""
@@ -20,6 +71,1005 @@ class TestCore(unittest.TestCase):
         """Test placeholder."""
         self.assertIsNotNone({})
 
+    def test_iter_embedding_batches_spans_files(self):
+        """Test chunks from different files share batches, bounded by count and tokens."""
+        chunks = [
+            (f"{file_path}_{i}", Document(page_content="x" * 40))
+            for file_path in ["a.py", "b.py", "c.py"]
+            for i in range(3)
+        ]
+
+        batches = list(iter_embedding_batches(chunks, batch_size=4, max_batch_tokens=1000))
+        self.assertEqual([len(b) for b in batches], [4, 4, 1])
+        self.assertEqual([c[0] for b in batches for c in b], [c[0] for c in chunks])
+
+        batches = list(iter_embedding_batches(chunks, batch_size=100, max_batch_tokens=25))
+        self.assertEqual([len(b) for b in batches], [2, 2, 2, 2, 1])
+
+    def test_embed_chunks_invokes_model_once_per_chunk(self):
+        """Test precomputed vectors are written without the store embedding the chunks again."""
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+        collection = chromadb.EphemeralClient().get_or_create_collection(
+            name="test_embed_chunks", embedding_function=None
+        )
+        chunks = [
+            (f"{file_path}_{i}", Document(page_content=f"{file_path} chunk {i}", metadata={"source": file_path}))
+            for file_path in ["a.py", "b.py"]
+            for i in range(5)
+        ]
+
+        chunk_count = embed_chunks(chunks, embedding_function, collection, batch_size=3)
+
+        self.assertEqual(chunk_count, len(chunks))
+        self.assertEqual(len(embedding_function.embedded_texts), len(chunks))
+        self.assertEqual(collection.count(), len(chunks))
+
+        stored = collection.get(ids=["b.py_4"], include=["embeddings", "documents"])
+        self.assertEqual(stored["documents"], ["b.py chunk 4"])
+        self.assertEqual(
+            [round(v, 5) for v in stored["embeddings"][0]],
+            [round(v, 5) for v in embedding_function.embed_query("b.py chunk 4")],
+        )
+
+    def test_upsert_buffer_batches_across_files_and_retries(self):
+        """Test buffered upserts span files, respect the client's max batch size and bytes, and retry idempotently."""
+        collection = chromadb.EphemeralClient().get_or_create_collection(
+            name="test_upsert_buffer", embedding_function=None
+        )
+        upserted_batches = []
+
+        class FlakyCollection:
+            """Collection whose client caps batches at 4 records and whose first upsert fails after writing."""
+
+            _client = mock.Mock(get_max_batch_size=mock.Mock(return_value=4))
+
+            def upsert(self, ids, **kwargs):
+                collection.upsert(ids=ids, **kwargs)
+                upserted_batches.append(ids)
+                if len(upserted_batches) == 1:
+                    raise ConnectionError("connection reset")
+
+        chunks = [
+            (f"{file_path}_{i}", Document(page_content=f"{file_path} chunk {i}", metadata={"source": file_path}))
+            for file_path in ["a.py", "b.py", "c.py", "d.py", "e.py"]
+            for i in range(2)
+        ]
+        embeddings = [[float(i)] * 8 for i in range(len(chunks))]
+
+        with UpsertBuffer(FlakyCollection(), batch_size=100, max_in_flight=2, backoff_seconds=0) as upsert_buffer:
+            upsert_buffer.add([chunk_id for chunk_id, _ in chunks], embeddings, [doc for _, doc in chunks])
+
+        # 10 records in batches of 4, the failed first batch sent again...
+        self.assertEqual(upsert_buffer.upserted_count, len(chunks))
+        self.assertEqual(upsert_buffer.request_count, 3)
+        self.assertEqual(sorted(len(ids) for ids in upserted_batches), [2, 4, 4, 4])
+        self.assertEqual(collection.count(), len(chunks))
+
+        upserted_batches.clear()
+        with UpsertBuffer(collection, max_batch_bytes=1) as upsert_buffer:
+            upsert_buffer.add(["a.py_0", "a.py_1"], embeddings[:2], [doc for _, doc in chunks[:2]])
+        self.assertEqual(upsert_buffer.request_count, 2)
+
+        failing_collection = mock.Mock(spec=["upsert"])
+        failing_collection.upsert.side_effect = ConnectionError("connection refused")
+        with self.assertRaises(ConnectionError):
+            with UpsertBuffer(failing_collection, retries=1, backoff_seconds=0) as upsert_buffer:
+                upsert_buffer.add(["a.py_0"], embeddings[:1], [chunks[0][1]])
+        self.assertEqual(failing_collection.upsert.call_count, 2)
+
+    def test_create_work_units_sized_by_bytes(self):
+        """Test work units are packed by file size, largest first, with their own actor state slice."""
+        with tempfile.TemporaryDirectory() as dir_path:
+            file_paths = []
+            for name, size in [("big.py", 900), ("mid.py", 500), ("small_a.py", 200), ("small_b.py", 150)]:
+                file_path = os.path.join(dir_path, name)
+                with open(file_path, "w") as f:
+                    f.write("x" * size)
+                file_paths.append(file_path)
+
+            small_a_key = translate_file_path_to_key(file_paths[2])
+            actor_state = {small_a_key: {"hash": "abc"}, "unrelated": {"hash": "def"}}
+
+            work_units = create_work_units(file_paths, actor_state, max_unit_bytes=1000)
+
+            self.assertEqual(
+                [[os.path.basename(p) for p in unit_file_paths] for unit_file_paths, _ in work_units],
+                [["big.py"], ["mid.py", "small_a.py", "small_b.py"]],
+            )
+            self.assertEqual(work_units[0][1], {})
+            self.assertEqual(work_units[1][1], {small_a_key: {"hash": "abc"}})
+
+    def test_incremental_embed_reembeds_changed_and_deletes_stale_chunks(self):
+        """Test a second run only embeds changed files and removes chunks of removed or shrunken files."""
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+        collection = chromadb.EphemeralClient().get_or_create_collection(
+            name="test_incremental_embed", embedding_function=None
+        )
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=12, chunk_overlap=0)
+
+        def write(file_path, content):
+            with open(file_path, "w") as f:
+                f.write(content)
+
+        def embed(file_paths, actor_state):
+            state = {}
+            embed_chunks(
+                split_file_paths(file_paths, actor_state, text_splitter, state),
+                embedding_function,
+                collection,
+            )
+            return state
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            a, b, c, d = (os.path.join(dir_path, f"{n}.txt") for n in "abcd")
+            write(a, "alpha one\nalpha two\nalpha three")
+            write(b, "bravo")
+            write(d, "delta")
+
+            first_state = embed([a, b, d], {})
+            self.assertEqual(first_state[translate_file_path_to_key(a)]["chunks"], 3)
+
+            write(a, "alpha one")
+            os.remove(b)
+            write(c, "charlie")
+            embedding_function.embedded_texts.clear()
+
+            second_state = embed([a, c, d], first_state)
+            embedding_diff = diff_embedded_files_state(first_state, second_state)
+            deleted_chunks = delete_stale_chunks(collection, first_state, second_state, embedding_diff)
+
+            self.assertEqual(embedding_diff["added"], [translate_file_path_to_key(c)])
+            self.assertEqual(embedding_diff["changed"], [translate_file_path_to_key(a)])
+            self.assertEqual(embedding_diff["unchanged"], [translate_file_path_to_key(d)])
+            self.assertEqual(embedding_diff["removed"], [translate_file_path_to_key(b)])
+            self.assertEqual(sorted(embedding_function.embedded_texts), ["alpha one", "charlie"])
+            self.assertEqual(deleted_chunks, 3)
+            self.assertEqual(sorted(collection.get(include=[])["ids"]), sorted([f"{a}_0", f"{c}_0", f"{d}_0"]))
+
+    def test_cached_embeddings_only_embeds_missing_chunks(self):
+        """Test cached chunks skip the model and the cache evicts least recently used vectors past its size."""
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            cache = EmbeddingCache(os.path.join(dir_path, "cache.sqlite"), "model:1500:50", max_bytes=32 * 3)
+            cached_embeddings = CachedEmbeddings(embedding_function, cache)
+
+            first = cached_embeddings.embed_documents(["a", "b", "a"])
+            second = cached_embeddings.embed_documents(["b", "c"])
+
+            self.assertEqual(embedding_function.embedded_texts, ["a", "b", "c"])
+            self.assertEqual(first[0], first[2])
+            self.assertEqual([round(v, 5) for v in second[0]], [round(v, 5) for v in first[1]])
+
+            # a 4th vector of 8 float32s overflows the 96 bytes, "a" is the least recently used...
+            cached_embeddings.embed_documents(["d"])
+            self.assertLessEqual(cache.size_bytes(), 32 * 3)
+            self.assertNotIn(generate_sha256("a"), cache.get_many([generate_sha256("a")]))
+
+            # replacing a cached vector doesn't count its bytes twice, another worker on the file sees the same total...
+            size_bytes = cache.size_bytes()
+            cache.put_many({generate_sha256("d"): [0.5] * 8})
+            other_cache = EmbeddingCache(os.path.join(dir_path, "cache.sqlite"), "model:1500:50", max_bytes=32 * 3)
+            self.assertEqual(cache.size_bytes(), size_bytes)
+            self.assertEqual(other_cache.size_bytes(), size_bytes)
+
+            other_cache.close()
+            cache.close()
+
+    def test_git_mirror_diffs_only_changed_paths(self):
+        """Test a mirror fetched from a local bare repo reports changed and removed paths since the last commit."""
+
+        def git(cwd, *args):
+            subprocess.run(
+                ["git", "-c", "user.name=lxi", "-c", "user.email=lxi@lxi.com", *args],
+                cwd=cwd, check=True, capture_output=True,
+            )
+
+        def write(file_path, content):
+            with open(file_path, "w") as f:
+                f.write(content)
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            bare_path = os.path.join(dir_path, "origin.git")
+            work_path = os.path.join(dir_path, "work")
+            mirror_path = os.path.join(dir_path, "mirror")
+
+            git(dir_path, "init", "--bare", "-b", "main", bare_path)
+            git(dir_path, "clone", bare_path, work_path)
+            write(os.path.join(work_path, "a.py"), "a = 1")
+            write(os.path.join(work_path, "b.py"), "b = 1")
+            git(work_path, "add", "-A")
+            git(work_path, "commit", "-m", "first")
+            git(work_path, "push", "origin", "HEAD:main")
+
+            first_sha = clone_mirror(f"file://{bare_path}", mirror_path, "main")
+            self.assertIsNotNone(first_sha)
+            self.assertIsNone(git_changed_paths(mirror_path, "0" * 40, first_sha))
+
+            write(os.path.join(work_path, "a.py"), "a = 2")
+            os.remove(os.path.join(work_path, "b.py"))
+            write(os.path.join(work_path, "c.py"), "c = 1")
+            git(work_path, "add", "-A")
+            git(work_path, "commit", "-m", "second")
+            git(work_path, "push", "origin", "HEAD:main")
+
+            second_sha = fetch_mirror(f"file://{bare_path}", mirror_path, "main")
+            self.assertNotEqual(first_sha, second_sha)
+
+            changed_file_paths, removed_file_paths = git_changed_paths(mirror_path, first_sha, second_sha)
+            self.assertEqual(sorted(changed_file_paths), [f"{mirror_path}/a.py", f"{mirror_path}/c.py"])
+            self.assertEqual(removed_file_paths, [f"{mirror_path}/b.py"])
+            with open(os.path.join(mirror_path, "a.py")) as f:
+                self.assertEqual(f.read(), "a = 2")
+
+    def test_iter_in_background_bounds_and_propagates_errors(self):
+        """Test a background stage keeps order, runs at most maxsize items ahead and re-raises its errors."""
+        produced = []
+
+        def stage():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        items = iter_in_background(stage(), maxsize=4)
+        self.assertEqual(next(items), 0)
+        self.assertLessEqual(len(produced), 1 + 4 + 1)
+        self.assertEqual(list(items), list(range(1, 100)))
+
+        def failing_stage():
+            yield 1
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            list(iter_in_background(failing_stage()))
+
+    def test_file_filters_skip_binary_large_generated_and_ignored_files(self):
+        """Test the walker honours .gitignore/.gitattributes and the loader skips binary, oversized, minified and generated files."""
+
+        files = {
+            ".gitignore": "dist/\n",
+            ".gitattributes": "gen/** linguist-generated\n",
+            "ok.py": "def ok():\n    return 1\n",
+            "dist/out.js": "var a = 1;\n",
+            "gen/model.py": "x = 1\n",
+            "yarn.lock": "lock\n",
+            "blob.dat": "\0\1\2\3" * 64,
+            "big.txt": "y" * 4096,
+            "bundle.js": "var a=1;" * 200,
+            "proto.py": "# Code generated by protoc. DO NOT EDIT.\nx = 1\n",
+            "markers.py": 'GENERATED_MARKERS = ("@generated", "code generated by")\n\n\n\n\n# @generated\n',
+            "data.json": '{"blob": "' + "x" * 1500 + '"}',
+            "icon.svg": '<svg><path d="' + "M0 0 L1 1 " * 140 + '"/></svg>',
+        }
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            for relative_path, content in files.items():
+                file_path = os.path.join(dir_path, relative_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(content)
+            subprocess.run(["git", "init", "-q"], cwd=dir_path, check=True)
+
+            os.environ["EMBED_MAX_FILE_BYTES"] = "2048"
+            try:
+                skipped_files = {}
+                state = {}
+                file_paths = iter_file_paths(dir_path, [".git"], [], skipped_files)
+                text_splitter = RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=0)
+                list(split_file_paths(file_paths, {}, text_splitter, state, skipped_files))
+            finally:
+                del os.environ["EMBED_MAX_FILE_BYTES"]
+
+            embedded_paths = sorted(os.path.relpath(s["path"], dir_path) for s in state.values())
+            # markers outside the header comment, and long lines outside js and css, don't skip a file...
+            self.assertEqual(embedded_paths, [".gitattributes", ".gitignore", "data.json", "icon.svg", "markers.py", "ok.py"])
+            self.assertEqual(
+                {reason: stats["files"] for reason, stats in skipped_files.items()},
+                {
+                    SkipReasons.GITIGNORE: 1,
+                    SkipReasons.GITATTRIBUTES: 1,
+                    SkipReasons.GENERATED: 2,
+                    SkipReasons.BINARY: 1,
+                    SkipReasons.TOO_LARGE: 1,
+                    SkipReasons.MINIFIED: 1,
+                },
+            )
+            self.assertEqual(skipped_files[SkipReasons.TOO_LARGE]["bytes"], 4096)
+
+    def test_code_chunker_splits_on_declarations_and_counts_each_line_once(self):
+        """Test the code chunker cuts between functions, stays within chunk size and never re-measures text."""
+
+        measured = []
+
+        def count_tokens(text):
+            measured.append(text)
+            return len(text.split()) or 1
+
+        source = "\n\n".join(
+            f"@decorator\ndef fn_{i}(a, b):\n    x = a + b\n    y = x * 2\n    return y\n" for i in range(6)
+        )
+        chunker = CodeChunker(chunk_size=40, chunk_overlap=0, length_function=count_tokens)
+        split_docs = chunker.split_documents([Document(page_content=source, metadata={"source": "/r/fns.py"})])
+
+        self.assertEqual(len(measured), len(source.splitlines()))
+        self.assertGreater(len(split_docs), 1)
+        self.assertEqual("".join(doc.page_content for doc in split_docs), source)
+        for doc in split_docs:
+            self.assertEqual(doc.metadata, {"source": "/r/fns.py"})
+            self.assertTrue(doc.page_content.startswith("@decorator\ndef fn_"))
+            self.assertLessEqual(sum(count_tokens(line) for line in doc.page_content.splitlines()), 40)
+
+        overlapping = CodeChunker(chunk_size=40, chunk_overlap=8, length_function=count_tokens)
+        chunks = overlapping.split_text(source, "python")
+        self.assertTrue(all(chunks[i + 1].split("\n")[0] in chunks[i] for i in range(len(chunks) - 1)))
+
+    def test_onnx_backend_matches_torch_output(self):
+        """Test the exported ONNX model, plain and int8 quantized, stays within cosine 0.99 of the torch model."""
+        import numpy as np
+        import torch
+        from transformers import BertConfig, BertModel, BertTokenizerFast
+
+        words = "def class return import self value file path embed chunk query token model collection repo".split()
+        texts = [
+            "def embed chunk return value",
+            "import model",
+            "query token file path self class collection repo embed",
+        ]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            with open(os.path.join(dir_path, "vocab.txt"), "w") as f:
+                f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *words]) + "\n")
+            tokenizer = BertTokenizerFast.from_pretrained(dir_path)
+
+            torch.manual_seed(0)
+            model = BertModel(
+                BertConfig(
+                    vocab_size=len(words) + 5,
+                    hidden_size=64,
+                    num_hidden_layers=2,
+                    num_attention_heads=4,
+                    intermediate_size=128,
+                    max_position_embeddings=64,
+                )
+            )
+
+            onnx_path = os.path.join(dir_path, "onnx")
+            export_onnx_model(model, tokenizer, onnx_path, max_seq_length=32)
+
+            inputs = tokenizer(texts, padding=True, return_tensors="pt")
+            with torch.no_grad():
+                last_hidden_state = model.eval()(**inputs)[0]
+            mask = inputs["attention_mask"][..., None].float()
+            expected = torch.nn.functional.normalize((last_hidden_state * mask).sum(1) / mask.sum(1), dim=1).numpy()
+
+            for quantized in (False, True):
+                embeddings = OnnxEmbeddings(onnx_path, quantized=quantized, intra_op_threads=1, batch_size=2)
+                vectors = np.array(embeddings.embed_documents(texts))
+                self.assertTrue(np.all((expected * vectors).sum(axis=1) >= 0.99))
+                self.assertAlmostEqual(float(np.dot(embeddings.embed_query(texts[0]), vectors[0])), 1.0, places=4)
+
+    def test_concurrent_embed_merges_worker_states_and_skip_reports(self):
+        """Test two spawned workers on the onnx backend embed every unit and their states and skip reports merge."""
+        import torch
+        from transformers import BertConfig, BertModel, BertTokenizerFast
+
+        words = "def class return import self value file path embed chunk".split()
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            with open(os.path.join(dir_path, "vocab.txt"), "w") as f:
+                f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *words]) + "\n")
+            tokenizer = BertTokenizerFast.from_pretrained(dir_path)
+
+            torch.manual_seed(0)
+            model = BertModel(
+                BertConfig(
+                    vocab_size=len(words) + 5,
+                    hidden_size=32,
+                    num_hidden_layers=1,
+                    num_attention_heads=2,
+                    intermediate_size=64,
+                    max_position_embeddings=64,
+                )
+            )
+            # exported where ensure_onnx_model looks, so workers load it instead of the real model...
+            onnx_cache_dir = os.path.join(dir_path, "onnx")
+            export_onnx_model(
+                model, tokenizer, os.path.join(onnx_cache_dir, DEFAULT_EMBEDDING_MODEL_NAME.replace("/", "--")), max_seq_length=32
+            )
+
+            files = {f"src/m{i}.py": f"def embed_{i}(self):\n    return value\n" for i in range(6)}
+            files.update({"a.dat": "\0\1\2\3" * 64, "b.dat": "\0\1\2\3" * 32, "big.txt": "y" * 4096})
+            file_paths = []
+            for relative_path, content in files.items():
+                file_path = os.path.join(dir_path, "repo", relative_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(content)
+                file_paths.append(file_path)
+
+            env_vars = {
+                "EMBED_BACKEND": "onnx",
+                "EMBED_ONNX_CACHE_DIR": onnx_cache_dir,
+                "EMBED_CACHE_ENABLED": "false",
+                "EMBED_VECTOR_STORE": "local",
+                "EMBED_LOCAL_STORE_DIR": os.path.join(dir_path, "store"),
+                "EMBED_LEXICAL_INDEX_PATH": os.path.join(dir_path, "lexical.sqlite"),
+                "EMBED_MAX_FILE_BYTES": "2048",
+                "EMBED_WORKERS": "2",
+                "EMBED_WORK_UNIT_BYTES": "128",
+            }
+            skipped_files = {}
+            with mock.patch.dict(os.environ, env_vars):
+                state = process_file_paths_concurrent(
+                    file_paths, "test_concurrent", {}, skipped_files, os.path.join(dir_path, "repo")
+                )
+
+            self.assertEqual(
+                sorted(state), sorted(translate_file_path_to_key(p) for p in file_paths if p.endswith(".py"))
+            )
+            self.assertEqual(
+                skipped_files,
+                {SkipReasons.BINARY: {"files": 2, "bytes": 384}, SkipReasons.TOO_LARGE: {"files": 1, "bytes": 4096}},
+            )
+
+            stored = LocalVectorStoreClient(os.path.join(dir_path, "store")).get_collection("test_concurrent").get(include=[])
+            self.assertEqual(len(stored["ids"]), sum(file_state["chunks"] for file_state in state.values()))
+
+    def test_concurrent_embed_fails_when_a_worker_cannot_start(self):
+        """Test a worker whose initializer raises fails the run rather than being respawned forever."""
+        from concurrent.futures.process import BrokenProcessPool
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            file_path = os.path.join(dir_path, "a.py")
+            with open(file_path, "w") as f:
+                f.write("def a():\n    return 1\n")
+
+            # the model load in the initializer raises on an unknown backend...
+            env_vars = {
+                "EMBED_BACKEND": "unknown",
+                "EMBED_VECTOR_STORE": "local",
+                "EMBED_LOCAL_STORE_DIR": os.path.join(dir_path, "store"),
+                "EMBED_LEXICAL_INDEX_PATH": os.path.join(dir_path, "lexical.sqlite"),
+                "EMBED_WORKERS": "2",
+            }
+            with mock.patch.dict(os.environ, env_vars), self.assertRaises(BrokenProcessPool):
+                process_file_paths_concurrent([file_path], "test_concurrent_broken", {}, {}, dir_path)
+
+    def test_registry_shares_models_and_caches_collection_handles(self):
+        """Test the registry loads each model once and keeps an LRU of collection handles on one client."""
+        client = chromadb.EphemeralClient()
+        clients = []
+        loads = []
+
+        def create_client():
+            clients.append(client)
+            return client
+
+        def create_model():
+            loads.append(1)
+            return DeterministicFakeEmbedding(size=8)
+
+        registry = Registry(collection_cache_size=2, chroma_client_factory=create_client)
+
+        model = registry.get_model("m", create_model)
+        self.assertIs(registry.get_model("m", create_model), model)
+        self.assertEqual(len(loads), 1)
+
+        first = registry.get_collection("reg_a")
+        self.assertIs(registry.get_collection("reg_a"), first)
+        registry.get_collection("reg_b")
+        registry.get_collection("reg_c")
+        self.assertIsNot(registry.get_collection("reg_a"), first)
+
+        vector_store = registry.get_vector_store("reg_a", model)
+        self.assertIs(registry.get_vector_store("reg_a", model), vector_store)
+        self.assertEqual(len(clients), 1)
+
+        registry.warm_up("m", create_model)
+        registry.record_request(0.5)
+        registry.record_request(0.1)
+        metrics = registry.metrics()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(metrics["first_request_seconds"], 0.5)
+        self.assertEqual(metrics["collections"], 2)
+        self.assertEqual((metrics["collection_hits"], metrics["collection_misses"]), (2, 5))
+        self.assertIsNotNone(metrics["startup_seconds"])
+
+    def test_query_batcher_coalesces_concurrent_queries_off_the_loop(self):
+        """Test concurrent queries share one embed_documents call on the executor while the loop keeps running."""
+        import asyncio
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        calls = []
+        embed_thread_ids = []
+        started = threading.Event()
+        released = threading.Event()
+        model = DeterministicFakeEmbedding(size=8)
+
+        class BlockingEmbeddings(DeterministicFakeEmbedding):
+            def embed_documents(self, texts):
+                calls.append(list(texts))
+                embed_thread_ids.append(threading.get_ident())
+                started.set()
+                # held until the loop has proven it still runs, bounded so a blocked loop fails rather than hangs...
+                if not released.wait(5):
+                    raise TimeoutError("not released")
+                return model.embed_documents(texts)
+
+        async def run():
+            batcher = QueryEmbeddingBatcher(
+                lambda: BlockingEmbeddings(size=8), ThreadPoolExecutor(max_workers=1), max_batch_size=8, max_wait_seconds=0.01
+            )
+            queries = ["a", "b", "a", "c"]
+            embedding = asyncio.gather(*(batcher.embed_query(q) for q in queries))
+
+            await asyncio.to_thread(started.wait, 5)
+            loop_ran = asyncio.Event()
+            asyncio.get_running_loop().call_soon(loop_ran.set)
+            await asyncio.wait_for(loop_ran.wait(), 5)
+            released.set()
+
+            return queries, await embedding, threading.get_ident()
+
+        queries, vectors, loop_thread_id = asyncio.run(run())
+
+        self.assertEqual(calls, [["a", "b", "c"]])
+        self.assertEqual(vectors, [model.embed_query(q) for q in queries])
+        self.assertNotEqual(embed_thread_ids, [loop_thread_id])
+
+    def test_query_cache_layers_versions_ttl_and_eviction(self):
+        """Test the query cache serves repeats, orphans results on a version bump, expires entries and stays within its budget."""
+        import asyncio
+        import time
+
+        cache = QueryCache(max_bytes=2 * 1024, ttl_seconds=60, version_refresh_seconds=60)
+        embedding = [0.5, 0.25, 0.125]
+        documents = [{"source": "/r/a.py", "page_content": "a = 1"}]
+
+        self.assertIsNone(cache.get_embedding("m", "what is a"))
+        cache.put_embedding("m", "what is a", embedding)
+        self.assertEqual(cache.get_embedding("m", "what is a"), embedding)
+        self.assertIsNone(cache.get_embedding("other-model", "what is a"))
+
+        cache.put_documents("repo", 1, embedding, 4, documents)
+        self.assertEqual(cache.get_documents("repo", 1, embedding, 4), documents)
+        self.assertIsNone(cache.get_documents("repo", 1, embedding, 8))
+        self.assertIsNone(cache.get_documents("repo", 2, embedding, 4))
+
+        fetches = []
+
+        async def fetch_version():
+            fetches.append(1)
+            return 1
+
+        self.assertEqual(asyncio.run(cache.get_version("repo", fetch_version)), 1)
+        self.assertEqual(asyncio.run(cache.get_version("repo", fetch_version)), 1)
+        cache.set_version("repo", 2)
+        self.assertEqual(asyncio.run(cache.get_version("repo", fetch_version)), 2)
+        self.assertEqual(len(fetches), 1)
+
+        for i in range(20):
+            cache.put_documents("repo", 2, [float(i)], 4, [{"source": "/r/b.py", "page_content": "x" * 100}])
+        stats = cache.stats()
+        self.assertLessEqual(stats["documents"]["bytes"], 1024)
+        self.assertGreater(stats["documents"]["evictions"], 0)
+        self.assertIsNone(cache.get_documents("repo", 1, embedding, 4))
+        self.assertEqual(stats["embeddings"]["hits"], 1)
+        self.assertEqual(stats["embeddings"]["misses"], 2)
+
+        expiring = QueryCache(ttl_seconds=0.01)
+        expiring.put_embedding("m", "q", embedding)
+        time.sleep(0.02)
+        self.assertIsNone(expiring.get_embedding("m", "q"))
+
+    def test_qry_filters_pushed_into_where_and_scored(self):
+        """Test path prefix and extension filters, k, score threshold and mmr on /qry searches."""
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+        collection = chromadb.EphemeralClient().get_or_create_collection(
+            name="test_qry_filters", embedding_function=None
+        )
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+
+        self.assertIsNone(create_chunk_where([], []))
+        self.assertEqual(create_chunk_where(file_exts=["PY"]), {"ext": {"$in": [".py"]}})
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            contents = {
+                "src/core/a.py": "alpha core python",
+                "src/core/b.ts": "bravo core typescript",
+                "src/app.py": "charlie app python",
+                "docs/readme.md": "delta docs markdown",
+            }
+            file_paths = []
+            for rel_path, content in contents.items():
+                file_path = os.path.join(dir_path, rel_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(content)
+                file_paths.append(file_path)
+
+            state = {}
+            embed_chunks(
+                split_file_paths(file_paths, {}, text_splitter, state, file_system_path=dir_path),
+                embedding_function,
+                collection,
+            )
+
+            def search(qry, **options):
+                with mock.patch("core.procs.create_collection", return_value=collection):
+                    return search_collection(
+                        "test_qry_filters",
+                        embedding_function.embed_query(qry),
+                        parse_qry_options({"qry": qry, **options}),
+                    )
+
+            def sources(documents):
+                return sorted(os.path.relpath(doc["source"], dir_path) for doc in documents)
+
+            self.assertEqual(len(search("alpha core python", k=10)), 4)
+            self.assertEqual(len(search("alpha core python", k=2)), 2)
+            self.assertEqual(
+                sources(search("alpha core python", k=10, path_prefix="src/core")),
+                ["src/core/a.py", "src/core/b.ts"],
+            )
+            self.assertEqual(
+                sources(search("alpha core python", k=10, path_prefixes=["src"], file_exts=[".py"])),
+                ["src/app.py", "src/core/a.py"],
+            )
+            self.assertEqual(
+                sources(search("alpha core python", k=10, path_prefixes=["src/app.py", "docs"])),
+                ["docs/readme.md", "src/app.py"],
+            )
+            self.assertEqual(search("alpha core python", k=10, path_prefix="src/co"), [])
+
+            documents = search("charlie app python", k=10, score_threshold=0.5)
+            self.assertEqual(sources(documents), ["src/app.py"])
+            self.assertAlmostEqual(documents[0]["score"], 1.0, places=4)
+
+            documents = search("charlie app python", k=2, mmr=True)
+            self.assertEqual(len(documents), 2)
+            self.assertEqual(sources(documents[:1]), ["src/app.py"])
+
+        with self.assertRaises(ValueError):
+            parse_qry_options({"k": 0})
+
+    def test_retrieve_documents_batches_embeddings_and_chroma_queries(self):
+        """Test a batch of queries is embedded in one call and searched with one Chroma request per collection."""
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+        client = chromadb.EphemeralClient()
+        collections = {}
+        queried_collections = []
+
+        for name in ("test_batch_a", "test_batch_b"):
+            collection = client.get_or_create_collection(name=name, embedding_function=None)
+            texts = [f"{name} {i}" for i in range(3)]
+            collection.upsert(
+                ids=texts,
+                embeddings=embedding_function.embed_documents(texts),
+                documents=texts,
+                metadatas=[{"source": text} for text in texts],
+            )
+            collections[name] = collection
+
+        class RecordingCollection:
+            def __init__(self, collection):
+                self._collection = collection
+                self.metadata = collection.metadata
+
+            def query(self, **kwargs):
+                queried_collections.append((self._collection.name, len(kwargs["query_embeddings"])))
+                return self._collection.query(**kwargs)
+
+        qry_cmds = [
+            {"qry": "test_batch_a 0", "file_system_name": "test_batch_a", "k": 1},
+            {"qry": "test_batch_b 1", "file_system_name": "test_batch_b", "k": 1},
+            {"qry": "test_batch_a 2", "file_system_name": "test_batch_a", "k": 1},
+        ]
+
+        batcher = QueryEmbeddingBatcher(lambda: embedding_function, ThreadPoolExecutor(max_workers=1))
+        embedding_function.embedded_texts.clear()
+
+        with mock.patch("core.procs.qry_batcher", batcher), \
+                mock.patch("core.procs.query_cache", QueryCache()), \
+                mock.patch("core.procs.get_collection_version", mock.AsyncMock(return_value=1)), \
+                mock.patch("core.procs.resolve_collection_name", mock.AsyncMock(side_effect=lambda name: name)), \
+                mock.patch("core.procs.create_collection", lambda name: RecordingCollection(collections[name])):
+            found_documents = asyncio.run(retrieve_documents(qry_cmds))
+            cached_documents = asyncio.run(retrieve_documents(qry_cmds[:1]))
+
+        self.assertEqual([[doc["source"] for doc in documents] for documents in found_documents], [
+            ["test_batch_a 0"], ["test_batch_b 1"], ["test_batch_a 2"]
+        ])
+        self.assertEqual(cached_documents, found_documents[:1])
+        self.assertEqual(sorted(embedding_function.embedded_texts), sorted(qry_cmd["qry"] for qry_cmd in qry_cmds))
+        self.assertEqual(sorted(queried_collections), [("test_batch_a", 2), ("test_batch_b", 1)])
+
+    def test_hybrid_qry_fuses_lexical_index_with_vectors(self):
+        """Test identifier-aware BM25 finds exact identifiers, is updated per file and is fused into /qry results."""
+        self.assertEqual(tokenize("getUserById(user_id)"), ["getuserbyid", "get", "user", "by", "id", "user_id", "user", "id"])
+
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+        collection = chromadb.EphemeralClient().get_or_create_collection(name="test_hybrid", embedding_function=None)
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            lexical_index = LexicalIndex(os.path.join(dir_path, "lexical.sqlite"))
+            contents = {
+                "src/users.py": "def getUserById(user_id):\n    return db.fetch(user_id)\n",
+                "src/orders.py": "def list_orders():\n    return db.fetch_all()\n",
+                "docs/users.md": "how users are stored\n",
+            }
+            file_paths = []
+            for rel_path, content in contents.items():
+                file_path = os.path.join(dir_path, rel_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(content)
+                file_paths.append(file_path)
+
+            embed_chunks(
+                index_chunks(
+                    split_file_paths(file_paths, {}, text_splitter, {}, file_system_path=dir_path),
+                    lexical_index,
+                    "test_hybrid",
+                ),
+                embedding_function,
+                collection,
+            )
+
+            users_path, orders_path, _ = file_paths
+            self.assertEqual(lexical_index.get_sources("test_hybrid"), set(file_paths))
+            self.assertEqual([chunk_id for chunk_id, _ in lexical_index.search("test_hybrid", "getUserById", 5)], [f"{users_path}_0"])
+            self.assertEqual(
+                [chunk_id for chunk_id, _ in lexical_index.search("test_hybrid", "fetch", 5, lambda path, ext: ext == ".md")], []
+            )
+
+            def search(qry, **options):
+                with mock.patch("core.procs.create_collection", return_value=collection), \
+                        mock.patch("core.procs.get_lexical_index", return_value=lexical_index):
+                    return search_collection(
+                        "test_hybrid",
+                        embedding_function.embed_query(qry),
+                        parse_qry_options({"qry": qry, **options}),
+                        qry,
+                    )
+
+            # hybrid is opt in, per query or by env...
+            self.assertFalse(parse_qry_options({"qry": "q"})["hybrid"])
+            with mock.patch.dict(os.environ, {"QRY_HYBRID": "true"}):
+                self.assertTrue(parse_qry_options({"qry": "q"})["hybrid"])
+
+            vector_documents = search("where is getUserById", k=3)
+            self.assertTrue(all("rrf_score" not in doc for doc in vector_documents))
+            vector_scores = {doc["source"]: doc["score"] for doc in vector_documents[:2]}
+
+            # fusion ranks by rrf_score, score stays the similarity, None for lexical only hits...
+            documents = search("where is getUserById", k=2, hybrid=True)
+            self.assertIn(users_path, [doc["source"] for doc in documents])
+            self.assertTrue(all(0 < doc["rrf_score"] <= 1 for doc in documents))
+            rrf_scores = [doc["rrf_score"] for doc in documents]
+            self.assertEqual(rrf_scores, sorted(rrf_scores, reverse=True))
+            self.assertTrue(all(doc["score"] == vector_scores.get(doc["source"], None) for doc in documents))
+            self.assertNotIn(
+                users_path, [doc["source"] for doc in search("where is getUserById", k=3, file_exts=["md"], hybrid=True)]
+            )
+
+            # a threshold is on similarity, lexical hits below it don't sneak in through fusion...
+            self.assertFalse(parse_qry_options({"qry": "q", "score_threshold": 0.5, "hybrid": True})["hybrid"])
+            users_score = next(doc["score"] for doc in vector_documents if doc["source"] == users_path)
+            thresholded_documents = search("where is getUserById", k=3, score_threshold=users_score + 1e-6)
+            self.assertNotIn(users_path, [doc["source"] for doc in thresholded_documents])
+            self.assertEqual(
+                thresholded_documents, [doc for doc in vector_documents if doc["score"] >= users_score + 1e-6]
+            )
+
+            # a changed file replaces its postings, a removed one drops them...
+            lexical_index.replace_source(
+                "test_hybrid", users_path, [(f"{users_path}_0", Document(page_content="def findUser(): pass", metadata={}))]
+            )
+            self.assertEqual([chunk_id for chunk_id, _ in lexical_index.search("test_hybrid", "fetch", 5)], [f"{orders_path}_0"])
+            lexical_index.delete_sources("test_hybrid", [orders_path])
+            self.assertEqual(lexical_index.search("test_hybrid", "fetch", 5), [])
+            self.assertEqual(lexical_index.get_sources("test_hybrid"), set(file_paths) - {orders_path})
+            lexical_index.close()
+
+    def test_local_vector_store_matches_chroma_and_reloads_on_demand(self):
+        """Test the in-process store answers /qry like Chroma, through the graph too, and survives LRU eviction."""
+        from langchain_chroma import Chroma
+
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+        chroma_collection = chromadb.EphemeralClient().get_or_create_collection(name="test_local", embedding_function=None)
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            contents = {f"src/m{i}/f{i}.py": f"module {i} code" for i in range(12)}
+            contents.update({f"docs/d{i}.md": f"doc {i} text" for i in range(4)})
+            file_paths = []
+            for rel_path, content in contents.items():
+                file_path = os.path.join(dir_path, "repo", rel_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(content)
+                file_paths.append(file_path)
+
+            store_path = os.path.join(dir_path, "store")
+            # exact scans only for the first client, the graph only for the second...
+            exact_client = LocalVectorStoreClient(store_path, max_loaded_collections=1, exact_max_vectors=1000)
+            local_collection = exact_client.get_or_create_collection("test_local")
+            for collection in (chroma_collection, local_collection):
+                embed_chunks(
+                    split_file_paths(file_paths, {}, text_splitter, {}, file_system_path=os.path.join(dir_path, "repo")),
+                    embedding_function,
+                    collection,
+                )
+            self.assertEqual(local_collection.count(), 16)
+
+            def search(collection, qry, **options):
+                with mock.patch("core.procs.create_collection", return_value=collection):
+                    return search_collection(
+                        "test_local", embedding_function.embed_query(qry), parse_qry_options({"qry": qry, **options})
+                    )
+
+            queries = [
+                ("module 3 code", {"k": 5}),
+                ("doc 1 text", {"k": 3, "path_prefix": "docs"}),
+                ("module 7 code", {"k": 4, "file_exts": ["py"], "mmr": True}),
+            ]
+            expected = [search(chroma_collection, qry, **options) for qry, options in queries]
+
+            for qry_index, (qry, options) in enumerate(queries):
+                documents = search(local_collection, qry, **options)
+                self.assertEqual([d["source"] for d in documents], [d["source"] for d in expected[qry_index]])
+                for document, expected_document in zip(documents, expected[qry_index]):
+                    self.assertAlmostEqual(document["score"], expected_document["score"], places=4)
+
+            # loading another collection evicts and persists this one...
+            exact_client.get_or_create_collection("test_other")
+            graph_client = LocalVectorStoreClient(store_path, max_loaded_collections=1, exact_max_vectors=0)
+            reloaded_collection = graph_client.get_collection("test_local")
+            self.assertEqual(
+                [d["source"] for d in search(reloaded_collection, *queries[0][:1], **queries[0][1])],
+                [d["source"] for d in expected[0]],
+            )
+
+            reloaded_collection.delete(where={"source": file_paths[0]})
+            self.assertEqual(reloaded_collection.get(ids=[f"{file_paths[0]}_0"])["ids"], [])
+            self.assertEqual(reloaded_collection.count(), 15)
+
+            vector_store = Chroma(client=graph_client, collection_name="test_local", embedding_function=embedding_function)
+            documents = vector_store.as_retriever(search_kwargs={"k": 2}).invoke("module 5 code")
+            self.assertEqual(documents[0].metadata["source"], file_paths[5])
+            graph_client.persist()
+
+    def test_local_vector_store_clients_sharing_a_directory_see_each_others_writes(self):
+        """Test two clients on one directory, e.g. two uvicorn workers, read fresh data and don't clobber slots."""
+        with tempfile.TemporaryDirectory() as dir_path:
+            writer = LocalVectorStoreClient(dir_path, exact_max_vectors=0)
+            reader = LocalVectorStoreClient(dir_path, exact_max_vectors=0)
+
+            writer.get_or_create_collection("test_shared").upsert(
+                ids=["a", "b"], embeddings=[[1.0, 0.0], [0.0, 1.0]], metadatas=[{"source": "a"}, {"source": "b"}]
+            )
+            reader_collection = reader.get_collection("test_shared")
+            self.assertEqual(reader_collection.query(query_embeddings=[[1.0, 0.1]], n_results=1)["ids"], [["a"]])
+
+            # written by the other client while this one has the collection loaded...
+            writer.get_collection("test_shared").upsert(
+                ids=["c"], embeddings=[[1.0, 0.2]], metadatas=[{"source": "c"}]
+            )
+            writer.get_collection("test_shared").delete(ids=["a"])
+            self.assertEqual(reader_collection.count(), 2)
+            self.assertEqual(reader_collection.query(query_embeddings=[[1.0, 0.1]], n_results=1)["ids"], [["c"]])
+
+            reader_collection.upsert(ids=["d"], embeddings=[[-1.0, 0.0]], metadatas=[{"source": "d"}])
+            stored = writer.get_collection("test_shared").get(include=["embeddings"])
+            self.assertEqual(sorted(stored["ids"]), ["b", "c", "d"])
+            self.assertEqual(
+                {chunk_id: [round(v, 5) for v in embedding] for chunk_id, embedding in zip(stored["ids"], stored["embeddings"])},
+                {"b": [0.0, 1.0], "c": [1.0, 0.2], "d": [-1.0, 0.0]},
+            )
+
+    def test_rebuild_writes_shadow_collection_swaps_alias_and_drops_old_version(self):
+        """Test a full rebuild leaves the active collection alone until it swaps the alias, then drops the old version."""
+        import asyncio
+
+        client = chromadb.EphemeralClient()
+        embedding_function = CountingEmbeddings(size=8, embedded_texts=[])
+
+        class FakeActor:
+            """Embedding actor keeping state and metadata in memory."""
+
+            state = {}
+            metadata = {}
+
+            async def get_state(self):
+                return dict(self.state)
+
+            async def set_state(self, data):
+                FakeActor.state = data
+
+            async def get_metadata(self):
+                return dict(self.metadata)
+
+            async def set_metadata(self, data):
+                FakeActor.metadata = data
+
+            async def set_state_and_metadata(self, data):
+                FakeActor.state, FakeActor.metadata = data["state"], data["metadata"]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            repo_path = os.path.join(dir_path, "repo")
+            os.makedirs(repo_path)
+            for name in ["a.py", "b.py"]:
+                with open(os.path.join(repo_path, name), "w") as f:
+                    f.write(f"def {name[0]}(): pass")
+
+            lexical_index = LexicalIndex(os.path.join(dir_path, "lexical.sqlite"))
+            registry = Registry(chroma_client_factory=lambda: client)
+
+            async def rebuild():
+                await embed_file_system(repo_path, "test_bluegreen")
+                self.assertEqual(client.get_collection("test_bluegreen").count(), 2)
+
+                os.remove(os.path.join(repo_path, "b.py"))
+                with open(os.path.join(repo_path, "c.py"), "w") as f:
+                    f.write("def c(): pass")
+
+                embedding_function.embedded_texts.clear()
+                embedding_report = await rebuild_file_system(repo_path, "test_bluegreen")
+
+                # swapped, the old version still there for readers that haven't seen the swap yet...
+                self.assertEqual(FakeActor.metadata["active_collection"], "test_bluegreen-v1")
+                self.assertEqual(FakeActor.metadata["retired_collections"], ["test_bluegreen"])
+                # seeded from the active version, only the new file is split and embedded...
+                self.assertEqual(embedding_report["copied_chunks"], 2)
+                self.assertEqual(
+                    [embedding_report[key] for key in ("added", "changed", "unchanged", "removed")], [1, 0, 1, 1]
+                )
+                self.assertEqual(embedding_function.embedded_texts, ["def c(): pass"])
+                self.assertEqual(client.get_collection("test_bluegreen").count(), 2)
+                self.assertEqual(
+                    sorted(m["source"] for m in client.get_collection("test_bluegreen-v1").get()["metadatas"]),
+                    [os.path.join(repo_path, "a.py"), os.path.join(repo_path, "c.py")],
+                )
+                self.assertEqual(
+                    sorted(file_state["path"] for file_state in FakeActor.state.values()),
+                    [os.path.join(repo_path, "a.py"), os.path.join(repo_path, "c.py")],
+                )
+
+                with mock.patch("core.procs.query_cache", QueryCache()):
+                    self.assertEqual(await resolve_collection_name("test_bluegreen"), "test_bluegreen-v1")
+
+                await asyncio.sleep(0.2)
+                self.assertNotIn("test_bluegreen", client.list_collections())
+                self.assertEqual(lexical_index.get_sources("test_bluegreen"), set())
+                self.assertEqual(
+                    lexical_index.get_sources("test_bluegreen-v1"),
+                    {os.path.join(repo_path, "a.py"), os.path.join(repo_path, "c.py")},
+                )
+
+                # the next rebuild writes the next version, nothing changed so nothing is embedded...
+                embedding_function.embedded_texts.clear()
+                embedding_report = await rebuild_file_system(repo_path, "test_bluegreen")
+                self.assertEqual(embedding_report["active_collection"], "test_bluegreen-v2")
+                self.assertEqual(embedding_report["retired_collection"], "test_bluegreen-v1")
+                self.assertEqual(embedding_report["unchanged"], 2)
+                self.assertEqual(embedding_function.embedded_texts, [])
+                self.assertEqual(client.get_collection("test_bluegreen-v2").count(), 2)
+
+            with mock.patch("core.embed.create_embedding_actor_proxy", lambda name: FakeActor()), \
+                    mock.patch("core.procs.create_embedding_actor_proxy", lambda name: FakeActor()), \
+                    mock.patch("core.embed.registry", registry), \
+                    mock.patch("core.embed.get_lexical_index", return_value=lexical_index), \
+                    mock.patch("core.embed.get_ingestion_embedding_function", return_value=embedding_function), \
+                    mock.patch("core.embed.create_text_splitter", return_value=RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)), \
+                    mock.patch.dict(os.environ, {"EMBED_COLLECTION_GC_DELAY_SECONDS": "0.05"}):
+                asyncio.run(rebuild())
+
 
 if __name__ == "__main__":
     unittest.main()
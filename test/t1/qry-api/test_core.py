@@ -1,6 +1,10 @@
 import unittest
 import sys
 import os
+import time
+import asyncio
+import json
+from unittest import mock
 
 sys.path.append(
     os.path.abspath(
@@ -12,6 +16,109 @@ sys.path.append(
 os.environ["KEY"] = "xyz"
 os.environ["CONFIG_PATH"] = config_path = os.path.join(os.path.dirname(__file__), "../../../src/qry-api/src/.config/openai_config.json")
 
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from agntsmth_core.core.tools import RetrieveAdditionalContextTool
+import core.agent
+from core.agent import invoke_tools, get_graph, get_llm, get_conversation_graph, create_graph_config
+from core.retrievers import RemoteEmbeddingRetriever
+from core.procs import stream_qry, process_qry
+from core.conversations import DaprCheckpointSaver
+from core.http_client import PooledHttpClient, CircuitOpenError
+from core.compaction import compact_tool_messages, estimate_token_count, NO_NEW_DOCUMENTS
+import httpx
+import grpc
+from dapr.clients.grpc._state import Concurrency
+from langgraph.checkpoint.base import empty_checkpoint
+from lxi_framework import RootQry
+
+
+class BatchRecordingRetriever(RemoteEmbeddingRetriever):
+    """Retriever that answers batches locally and records them."""
+
+    batches: list = []
+
+    async def aget_relevant_documents_batch(self, queries):
+        self.batches.append(list(queries))
+        return [[Document(page_content=f"doc for {query}", metadata={"source": query})] for query in queries]
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Chat model replaying scripted responses, picked by the number of AI turns so far, streamed word by word."""
+
+    responses: list = []
+
+    @property
+    def _llm_type(self):
+        return "fake-streaming"
+
+    def _response(self, messages):
+        return self.responses[len([m for m in messages if m.type == "ai"])]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self._response(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self._response(messages)
+        if response.tool_calls:
+            tool_call_chunks = [
+                {"name": c["name"], "args": json.dumps(c["args"]), "id": c["id"], "index": i}
+                for i, c in enumerate(response.tool_calls)
+            ]
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=tool_call_chunks))
+            return
+
+        for word in response.content.split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=f"{word} "))
+
+
+class FakeDaprStateItem:
+    def __init__(self, data, etag=""):
+        self.data = data
+        self.etag = etag
+
+
+class FakeEtagMismatchError(Exception):
+    def code(self):
+        return grpc.StatusCode.ABORTED
+
+
+class FakeDaprClient:
+    """Dict backed stand-in for the Dapr state API, checking etags of first-write saves."""
+
+    def __init__(self):
+        self.states = {}
+        self.etags = {}
+
+    def get_state(self, store_name, key, state_metadata=None):
+        return FakeDaprStateItem(self.states.get((store_name, key), b""), self.etags.get((store_name, key), ""))
+
+    def save_state(self, store_name, key, value, etag=None, options=None, state_metadata=None):
+        current_etag = self.etags.get((store_name, key), None)
+        if options is not None and options.concurrency == Concurrency.first_write and etag != current_etag:
+            raise FakeEtagMismatchError(f"possible etag mismatch, key: {key}")
+        self.states[(store_name, key)] = value.encode()
+        self.etags[(store_name, key)] = str(int(current_etag or 0) + 1)
+
+    def delete_state(self, store_name, key):
+        self.states.pop((store_name, key), None)
+        self.etags.pop((store_name, key), None)
+
+
+class SleepingTool:
+    """Minimal sync tool that sleeps before answering."""
+
+    def __init__(self, name, seconds):
+        self.name = name
+        self.seconds = seconds
+
+    def invoke(self, args):
+        time.sleep(self.seconds)
+        return f"{self.name} {args['query']}"
+
 
 class TestCore(unittest.TestCase):
     """Test core functions."""
@@ -20,6 +127,360 @@ class TestCore(unittest.TestCase):
         """Test placeholder."""
         self.assertIsNotNone({})
 
+    def test_invoke_tools_batches_retrieval_calls(self):
+        """Test retrieval tool calls of one turn are answered by a single batch request, in tool call order."""
+        retriever = BatchRecordingRetriever("http://embeddings-api", "repo", batches=[])
+        tools = {"retrieve_additional_context": RetrieveAdditionalContextTool(retriever)}
+        message = AIMessage(
+            content="",
+            tool_calls=[
+                {"name": "retrieve_additional_context", "args": {"query": "a"}, "id": "call_a"},
+                {"name": "unknown_tool", "args": {}, "id": "call_u"},
+                {"name": "retrieve_additional_context", "args": {"query": "b"}, "id": "call_b"},
+            ],
+        )
+
+        tool_messages = asyncio.run(invoke_tools({"message_history": [message]}, tools))["message_history"]
+
+        self.assertEqual(retriever.batches, [["a", "b"]])
+        self.assertEqual([m.tool_call_id for m in tool_messages], ["call_a", "call_u", "call_b"])
+        self.assertIn("doc for a", tool_messages[0].content)
+        self.assertEqual(tool_messages[1].content, "Tool unknown_tool not found")
+        self.assertIn("doc for b", tool_messages[2].content)
+
+    def test_invoke_tools_runs_calls_concurrently_in_order_with_timeouts(self):
+        """Test tool calls of one turn overlap, keep their tool_call_id order and time out individually."""
+        tools = {
+            "slow": SleepingTool("slow", 0.3),
+            "fast": SleepingTool("fast", 0.05),
+            "stuck": SleepingTool("stuck", 2),
+        }
+        message = AIMessage(
+            content="",
+            tool_calls=[
+                {"name": "slow", "args": {"query": "1"}, "id": "call_1"},
+                {"name": "fast", "args": {"query": "2"}, "id": "call_2"},
+                {"name": "slow", "args": {"query": "3"}, "id": "call_3"},
+                {"name": "stuck", "args": {"query": "4"}, "id": "call_4"},
+            ],
+        )
+
+        async def timed_invoke_tools(max_concurrency):
+            # timed inside the loop, asyncio.run also waits for the abandoned stuck thread on exit...
+            started = time.perf_counter()
+            result = await invoke_tools(
+                {"message_history": [message]}, tools, max_concurrency=max_concurrency, timeout_seconds=0.5
+            )
+            return result["message_history"], time.perf_counter() - started
+
+        tool_messages, elapsed = asyncio.run(timed_invoke_tools(4))
+
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual([m.tool_call_id for m in tool_messages], ["call_1", "call_2", "call_3", "call_4"])
+        self.assertEqual([m.content for m in tool_messages[:3]], ["slow 1", "fast 2", "slow 3"])
+        self.assertIn("timed out", tool_messages[3].content)
+
+        _, elapsed = asyncio.run(timed_invoke_tools(1))
+        self.assertGreater(elapsed, 0.6)
+
+    def test_graph_compiled_once_and_routes_tools_by_repo(self):
+        """Test the graph and LLM are built once and each run's tool calls go to the retriever of its repo."""
+        llm_creations = []
+        queried_repos = []
+
+        async def fake_llm(message_history):
+            if isinstance(message_history[-1], HumanMessage):
+                return AIMessage(
+                    content="",
+                    tool_calls=[{"name": "retrieve_additional_context", "args": {"query": "q"}, "id": "call_q"}],
+                )
+            return AIMessage(content="done")
+
+        def create_llm(tools):
+            llm_creations.append([tool.name for tool in tools])
+            return RunnableLambda(fake_llm)
+
+        class RecordingRetriever(RemoteEmbeddingRetriever):
+            def get_relevant_documents(self, query):
+                queried_repos.append(self.file_system_name)
+                return []
+
+        get_graph.cache_clear()
+        get_llm.cache_clear()
+        core.agent._repo_tools.clear()
+        try:
+            with mock.patch.object(core.agent.ModelFactory, "create", create_llm), \
+                    mock.patch.object(core.agent, "RemoteEmbeddingRetriever", RecordingRetriever):
+                for repo_name in ("repo_a", "repo_b", "repo_a"):
+                    state = asyncio.run(get_graph().ainvoke(
+                        {"message_history": [HumanMessage(content="hi")]}, config=create_graph_config(repo_name)
+                    ))
+                    self.assertEqual(state["message_history"][-1].content, "done")
+        finally:
+            get_graph.cache_clear()
+            get_llm.cache_clear()
+            core.agent._repo_tools.clear()
+
+        self.assertEqual(llm_creations, [["retrieve_additional_context"]])
+        self.assertEqual(queried_repos, ["repo_a", "repo_b", "repo_a"])
+
+    def test_stream_qry_emits_tool_calls_document_summaries_and_tokens(self):
+        """Test the streaming variant yields tool calls, retrieved document summaries, LLM tokens and the final output."""
+        llm = FakeStreamingChatModel(responses=[
+            AIMessage(
+                content="",
+                tool_calls=[{"name": "retrieve_additional_context", "args": {"query": "q"}, "id": "call_q"}],
+            ),
+            AIMessage(content="found it here"),
+        ])
+
+        class ScoredRetriever(RemoteEmbeddingRetriever):
+            def get_relevant_documents(self, query):
+                return [Document(page_content="code", metadata={"source": "src/a.py", "score": 0.9})]
+
+        qry = RootQry(
+            qry_data={"message_history": [{"type": "human", "content": "where?"}]},
+            qry_metadata={"repo_name": "repo"},
+        )
+
+        async def collect():
+            return [event async for event in stream_qry(qry)]
+
+        get_graph.cache_clear()
+        get_llm.cache_clear()
+        core.agent._repo_tools.clear()
+        try:
+            with mock.patch.object(core.agent.ModelFactory, "create", lambda tools: llm), \
+                    mock.patch.object(core.agent, "RemoteEmbeddingRetriever", ScoredRetriever):
+                events = asyncio.run(collect())
+        finally:
+            get_graph.cache_clear()
+            get_llm.cache_clear()
+            core.agent._repo_tools.clear()
+
+        self.assertEqual([event["type"] for event in events], [
+            "tool_call", "tool_result", "token", "token", "token", "done"
+        ])
+        self.assertEqual(events[0]["args"], {"query": "q"})
+        self.assertEqual(events[1]["documents"], [{"source": "src/a.py", "score": 0.9}])
+        self.assertEqual("".join(event["content"] for event in events[2:5]), "found it here ")
+        self.assertEqual(events[-1]["output"][-1], {"type": "ai", "content": "found it here "})
+
+    def test_pooled_http_client_retries_breaks_and_parses_sync_and_async_alike(self):
+        """Test transient failures are retried, repeated failures open the circuit, and both retriever paths parse /qry."""
+        statuses = [503, 503, 200]
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(json.loads(request.content))
+            status = statuses.pop(0) if statuses else 200
+            return httpx.Response(status, json={"output": {"documents": [
+                {"source": "src/a.py", "page_content": "code", "score": 0.8}
+            ]}})
+
+        transport = httpx.MockTransport(handler)
+        client = PooledHttpClient(retries=2, backoff_seconds=0.001, transport=transport, async_transport=transport)
+        retriever = RemoteEmbeddingRetriever("http://embeddings-api", "repo", search_kwargs={"k": 2})
+
+        with mock.patch("core.retrievers.http_client", client):
+            documents = retriever.get_relevant_documents("q")
+            async_documents = asyncio.run(retriever.aget_relevant_documents("q"))
+
+        self.assertEqual(len(requests_seen), 4)
+        self.assertEqual(requests_seen[0], {"k": 2, "qry": "q", "file_system_name": "repo"})
+        self.assertEqual(documents, async_documents)
+        self.assertEqual(documents[0].metadata, {"source": "src/a.py", "score": 0.8})
+
+        connects = []
+
+        def refusing_handler(request):
+            connects.append(request.url.host)
+            raise httpx.ConnectError("refused", request=request)
+
+        refusing_transport = httpx.MockTransport(refusing_handler)
+        client = PooledHttpClient(
+            retries=1,
+            backoff_seconds=0.001,
+            breaker_failures=2,
+            breaker_reset_seconds=60,
+            transport=refusing_transport,
+        )
+
+        for _ in range(2):
+            with self.assertRaises(httpx.ConnectError):
+                client.post_json("http://down/qry", {})
+        with self.assertRaises(CircuitOpenError):
+            client.post_json("http://down/qry", {})
+
+        self.assertEqual(len(connects), 4)
+        self.assertFalse(client.get_breaker("http://up/qry").is_open)
+
+    def test_cancelled_half_open_call_lets_the_next_trial_through(self):
+        """Test a trial call cancelled by a timeout doesn't leave the circuit open for good."""
+        hanging = True
+
+        async def handler(request):
+            if hanging:
+                await asyncio.sleep(60)
+            return httpx.Response(200, json={"output": {"documents": []}})
+
+        client = PooledHttpClient(
+            retries=0, breaker_failures=1, breaker_reset_seconds=0, async_transport=httpx.MockTransport(handler)
+        )
+        breaker = client.get_breaker("http://slow/qry")
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+
+        async def call():
+            nonlocal hanging
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.apost_json("http://slow/qry", {}), timeout=0.05)
+
+            # half open again, not stuck behind the cancelled trial...
+            hanging = False
+            return await client.apost_json("http://slow/qry", {})
+
+        self.assertEqual(asyncio.run(call()), {"output": {"documents": []}})
+        self.assertFalse(breaker.is_open)
+
+    def test_conversations_keep_history_server_side_and_return_deltas(self):
+        """Test conversation qrys send and receive only new messages while the LLM still sees the whole history."""
+        seen_histories = []
+
+        async def fake_llm(message_history):
+            seen_histories.append([m.content for m in message_history])
+            return AIMessage(content=f"answer {len(seen_histories)}")
+
+        def run(qry_data, checkpointer):
+            get_graph.cache_clear()
+            get_llm.cache_clear()
+            get_conversation_graph.cache_clear()
+            try:
+                with mock.patch.object(core.agent.ModelFactory, "create", lambda tools: RunnableLambda(fake_llm)), \
+                        mock.patch.object(core.agent, "create_checkpointer", lambda: checkpointer):
+                    return asyncio.run(process_qry(RootQry(qry_data=qry_data, qry_metadata={"repo_name": "repo"})))
+            finally:
+                get_graph.cache_clear()
+                get_llm.cache_clear()
+                get_conversation_graph.cache_clear()
+
+        from langgraph.checkpoint.memory import InMemorySaver
+
+        for checkpointer in (InMemorySaver(), DaprCheckpointSaver("statestore-conversations", FakeDaprClient)):
+            seen_histories.clear()
+
+            first = run({"messages": [{"type": "human", "content": "q1"}]}, checkpointer)
+            self.assertEqual(first["output"], [{"type": "ai", "content": "answer 1"}])
+
+            second = run(
+                {"conversation_id": first["conversation_id"], "messages": [{"type": "human", "content": "q2"}]},
+                checkpointer,
+            )
+            self.assertEqual(second["conversation_id"], first["conversation_id"])
+            self.assertEqual(second["output"], [{"type": "ai", "content": "answer 2"}])
+            self.assertEqual(seen_histories[-1], ["q1", "answer 1", "q2"])
+
+        seen_histories.clear()
+        stateless = run({"message_history": [{"type": "human", "content": "q"}]}, InMemorySaver())
+        self.assertEqual(stateless, {"output": [
+            {"type": "human", "content": "q"}, {"type": "ai", "content": "answer 1"}
+        ]})
+
+    def test_checkpoint_writes_of_parallel_tasks_all_land(self):
+        """Test pending writes two tasks save at once both survive, the losing save retrying on top of the other."""
+        client = FakeDaprClient()
+        checkpointer = DaprCheckpointSaver("statestore-conversations", lambda: client)
+        config = checkpointer.put({"configurable": {"thread_id": "t", "checkpoint_ns": ""}}, empty_checkpoint(), {}, {})
+
+        get_state = client.get_state
+        raced = []
+
+        def racing_get_state(store_name, key, state_metadata=None):
+            state_item = get_state(store_name, key, state_metadata)
+            if key.endswith("|writes") and not raced:
+                raced.append(key)
+                # the other task reads and saves between this read and its save...
+                checkpointer.put_writes(config, [("b", 2)], "task-b")
+            return state_item
+
+        client.get_state = racing_get_state
+        with self.assertLogs(level="WARNING") as logs:
+            checkpointer.put_writes(config, [("a", 1)], "task-a")
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(
+            sorted(checkpointer.get_tuple(config).pending_writes), [("task-a", "a", 1), ("task-b", "b", 2)]
+        )
+
+    def test_delete_thread_removes_checkpoints_of_every_namespace(self):
+        """Test deleting a conversation removes its subgraph checkpoints and writes too, and no other thread's."""
+        client = FakeDaprClient()
+        checkpointer = DaprCheckpointSaver("statestore-conversations", lambda: client)
+
+        configs = []
+        for thread_id, checkpoint_ns in (("t", ""), ("t", "tools:1"), ("t", "tools:1|agent:2"), ("t", "tools:1"), ("u", "")):
+            config = checkpointer.put(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}}, empty_checkpoint(), {}, {}
+            )
+            checkpointer.put_writes(config, [("a", 1)], "task-a")
+            configs.append(config)
+
+        self.assertEqual(
+            json.loads(client.states[("statestore-conversations", "conversation|t|namespaces")]),
+            {"checkpoint_namespaces": ["tools:1", "tools:1|agent:2"]},
+        )
+
+        checkpointer.delete_thread("t")
+
+        self.assertTrue(all(checkpointer.get_tuple(config) is None for config in configs[:4]))
+        self.assertEqual(sorted(key for _, key in client.states), ["conversation|u|", "conversation|u||writes"])
+
+    def test_tool_results_deduped_merged_and_trimmed(self):
+        """Test retrieved chunks already in the conversation are dropped, overlapping ones merged and the rest trimmed."""
+        lines = [f"line {i} of a.py\n" for i in range(12)]
+        first_half, second_half = "".join(lines[:7]), "".join(lines[5:])
+        earlier = Document(page_content="seen before", metadata={"source": "src/b.py", "score": 0.9})
+        history = [
+            HumanMessage(content="q"),
+            ToolMessage(content="source: src/b.py\nseen before", tool_call_id="call_0", artifact=[earlier]),
+            AIMessage(content="", tool_calls=[
+                {"name": "retrieve_additional_context", "args": {"query": "q"}, "id": "call_1"},
+                {"name": "retrieve_additional_context", "args": {"query": "q"}, "id": "call_2"},
+            ]),
+        ]
+        retrieved = [
+            Document(page_content=second_half, metadata={"source": "src/a.py", "score": 0.8}),
+            Document(page_content="seen before", metadata={"source": "src/b.py", "score": 0.9}),
+            Document(page_content=first_half, metadata={"source": "src/a.py", "score": 0.7}),
+            Document(page_content="".join(f"c line {i}\n" for i in range(40)), metadata={"source": "src/c.py", "score": 0.1}),
+        ]
+        tool_messages = [
+            ToolMessage(content=str(retrieved), tool_call_id="call_1", artifact=retrieved),
+            ToolMessage(content=str(retrieved[:1]), tool_call_id="call_2", artifact=retrieved[:1]),
+            ToolMessage(content="not documents", tool_call_id="call_3"),
+        ]
+
+        compacted = compact_tool_messages(tool_messages, history, 100, estimate_token_count)
+
+        documents = compacted[0].artifact
+        self.assertEqual([d.metadata["source"] for d in documents], ["src/a.py"])
+        self.assertEqual(documents[0].page_content, "".join(lines))
+        self.assertEqual(documents[0].metadata["score"], 0.8)
+        self.assertEqual(compacted[0].content, "source: src/a.py\n" + "".join(lines))
+        self.assertEqual(compacted[0].tool_call_id, "call_1")
+        self.assertEqual(compacted[1].content, NO_NEW_DOCUMENTS)
+        self.assertEqual(compacted[2].content, "not documents")
+
+        untrimmed = compact_tool_messages(tool_messages[:1], history, 1000, estimate_token_count)[0]
+        self.assertEqual([d.metadata["source"] for d in untrimmed.artifact], ["src/a.py", "src/c.py"])
+
+        truncated = compact_tool_messages(tool_messages[:1], history[:1], 140, estimate_token_count)[0]
+        self.assertEqual([d.metadata["source"] for d in truncated.artifact], ["src/a.py", "src/b.py", "src/c.py"])
+        self.assertTrue(truncated.artifact[2].metadata["truncated"])
+        self.assertTrue(truncated.artifact[2].page_content.startswith("c line 0\n"))
+        self.assertLessEqual(sum(estimate_token_count(d.page_content) for d in truncated.artifact), 140)
+
+
 
 if __name__ == "__main__":
     unittest.main()